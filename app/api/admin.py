@@ -4,9 +4,10 @@ from rest_framework import serializers, viewsets, generics, status, exceptions
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.hashers import make_password
-from app import models
+from app import models, tilecache, timings
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -91,3 +92,19 @@ class AdminProfileViewSet(viewsets.ModelViewSet):
             raise exceptions.NotFound()
 
         return Response({'used': p.used_quota(), 'total': p.quota}, status=status.HTTP_200_OK)
+
+class AdminTilerMetrics(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        """
+        Tiler stage timings histograms and tile cache statistics
+        """
+        return Response({
+            'timings': timings.get_histograms(),
+            'tile_cache': tilecache.get_stats()
+        })
+
+    def delete(self, request):
+        timings.clear()
+        return Response(status=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,72 @@
+import numpy as np
+from functools import lru_cache
+from rio_tiler.colormap import cmap, make_lut
+from .custom_colormaps_helper import custom_colormaps
+
+colormap = cmap
+for custom_colormap in custom_colormaps:
+    colormap = colormap.register(custom_colormap)
+
+
+@lru_cache(maxsize=64)
+def get_lut(name):
+    """
+    Lookup table of a colormap, built once per process
+    (rio-tiler loads colormaps from disk and builds a
+    new table on every call otherwise)
+    :param name: colormap name
+    :return: read-only (4, 256) uint8 array with the R, G, B, A values
+        of each entry. Raises InvalidColorMapName for unknown colormaps.
+    """
+    lut = np.ascontiguousarray(make_lut(colormap.get(name)).T)
+    lut.flags.writeable = False
+    return lut
+
+
+def rescale_to_uint8(data, in_range, mask=None):
+    """
+    Rescale single band data to 0-255. The result is the same as
+    ImageData.post_process(in_range=(in_range, )), with fewer temporary arrays.
+    :param data: (1, H, W) array
+    :param in_range: (min, max) values
+    :param mask: (H, W) mask array, masked values (0) are set to 0 (optional)
+    :return: (1, H, W) uint8 array
+    """
+    imin, imax = in_range
+    arr = np.clip(data, imin, imax)
+    if not np.issubdtype(arr.dtype, np.floating):
+        arr = arr.astype(np.float64)
+    arr -= imin
+    arr = np.divide(arr, np.float64(imax - imin))
+    arr *= 255
+
+    # rio-tiler stores rescaled values in the input array
+    # before converting them to uint8
+    if arr.dtype != data.dtype:
+        arr = arr.astype(data.dtype)
+    arr = arr.astype(np.uint8)
+
+    if mask is not None:
+        np.multiply(arr, mask != 0, out=arr)
+
+    return arr
+
+
+def apply_lut(data, name):
+    """
+    Map uint8 values through a colormap
+    :param data: (1, H, W) uint8 array
+    :param name: colormap name
+    :return: (rgb, alpha) tuple of (3, H, W) and (H, W) uint8 arrays
+    """
+    rgba = np.take(get_lut(name), data[0], axis=1)
+    return rgba[:3], rgba[3]
+
+
+def apply_colormap(data, in_range, name, mask=None):
+    """
+    Rescale single band data to 0-255 and map it through a colormap.
+    Same as ImageData.post_process followed by apply_cmap.
+    :return: (rgb, alpha) tuple of (3, H, W) and (H, W) uint8 arrays
+    """
+    return apply_lut(rescale_to_uint8(data, in_range, mask), name)
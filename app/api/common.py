@@ -1,7 +1,11 @@
 from django.core.exceptions import ObjectDoesNotExist
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
 from rest_framework import exceptions
 import os
 import re
+import json
+import hashlib
 
 from app import models
 
@@ -67,4 +71,56 @@ def get_asset_download_filename(task, asset):
 
     filename = re.sub(r'[^0-9a-zA-Z-_]+', '', name.replace(" ", "-").replace("/", "-")) + ("-" if name else "") + asset
     filename = re.sub(r'-[-]+', '-', filename)
-    return filename
\ No newline at end of file
+    return filename
+
+def get_asset_etag(asset_path, *params):
+    """
+    Compute a strong ETag for a response that is generated
+    from an asset file and a set of parameters
+    :return: (etag, last modified timestamp) tuple or (None, None) if the asset does not exist
+    """
+    try:
+        st = os.stat(asset_path)
+    except FileNotFoundError:
+        return None, None
+
+    payload = json.dumps([asset_path, st.st_mtime_ns, st.st_size, st.st_ino, params], sort_keys=True, default=str)
+    return '"{}"'.format(hashlib.sha1(payload.encode('utf-8')).hexdigest()), int(st.st_mtime)
+
+def get_not_modified_response(request, etag, last_modified=None):
+    """
+    :return: a 304 response if the client's copy (If-None-Match/If-Modified-Since)
+        is still valid, None otherwise
+    """
+    if etag is None:
+        return None
+    return get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+def set_cache_headers(response, task, etag, last_modified=None, max_age=0, vary=None):
+    """
+    Add ETag, Last-Modified and Cache-Control headers to a response.
+    With a max_age of 0, clients need to revalidate before using their copy.
+    :param task: task (or project) the response belongs to
+    """
+    if etag is None:
+        return response
+
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+
+    # Shared caches (CDNs) can only store public resources
+    if isinstance(task, models.Project):
+        public = task.public
+    else:
+        public = task.public or task.project.public
+    visibility = 'public' if public else 'private'
+    if max_age > 0:
+        response['Cache-Control'] = '{}, max-age={}'.format(visibility, max_age)
+    else:
+        response['Cache-Control'] = '{}, no-cache'.format(visibility)
+
+    if vary is not None:
+        patch_vary_headers(response, vary)
+
+    return response
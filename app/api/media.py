@@ -16,7 +16,7 @@ from rest_framework.views import APIView
 from app.video import extract_jpeg_bytes_from_video, srt_file_for_video, video_file_for_srt, SrtFileParser
 from django.core.files.uploadedfile import InMemoryUploadedFile
 
-from app import models
+from app import models, vector_tiles
 from app.api.tasks import flatten_files, TaskNestedView
 from .common import get_and_check_project, check_project_perms
 from app.security import path_traversal_check, sanitize_filename
@@ -191,6 +191,8 @@ class TaskMediaUpload(TaskMediaBase):
                 task.update_size()
                 task.save()
 
+            vector_tiles.generate(task, ['media'])
+
         result = {'success': True, 'uploaded': {name: uploaded[name]['size'] for name in uploaded}, 'added': added}
         return Response(result, status=status.HTTP_200_OK)
 
@@ -232,6 +234,8 @@ class TaskMediaManage(TaskMediaBase):
 
             task.save()
 
+        vector_tiles.generate(task, ['media'])
+
         return Response({'success': True}, status=status.HTTP_200_OK)
 
     def delete(self, request, pk=None, project_pk=None, filename=None):
@@ -266,6 +270,8 @@ class TaskMediaManage(TaskMediaBase):
             task.update_size()
             task.save()
 
+        vector_tiles.generate(task, ['media'])
+
         return Response({'success': True}, status=status.HTTP_200_OK)
 
 
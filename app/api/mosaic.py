@@ -0,0 +1,193 @@
+import math
+import uuid
+import numpy as np
+from django.contrib.gis.geos import Polygon
+from django.core.exceptions import ObjectDoesNotExist
+from django.http import HttpResponse
+from django.utils.translation import gettext as _
+from rest_framework import exceptions
+from rest_framework.permissions import AllowAny
+from rest_framework.views import APIView
+
+from app import models, tilecache
+from app.timings import StageTimer
+from nodeodm import status_codes
+from webodm import settings
+from .common import get_not_modified_response, set_cache_headers
+from .tiler import get_tile_params, read_tile_image, encode_tile, get_raster_path
+
+EXTENT_FIELDS = {
+    'orthophoto': 'orthophoto_extent',
+    'dsm': 'dsm_extent',
+    'dtm': 'dtm_extent'
+}
+
+
+def get_tile_bounds(z, x, y):
+    """
+    :return: (west, south, east, north) WGS84 bounds of a web mercator tile
+    """
+    n = 2.0 ** z
+    west = x / n * 360.0 - 180.0
+    east = (x + 1) / n * 360.0 - 180.0
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return west, south, east, north
+
+
+def get_mosaic_tasks(project, tile_type, bounds, order='newest', task_ids=None, public_only=False):
+    """
+    Find the completed tasks of a project whose raster extent overlaps bounds.
+    Extent fields are spatially indexed, so this doesn't need
+    to look at the rasters of tasks that do not overlap.
+    :param order: newest or oldest (on top)
+    :param task_ids: list of task IDs to include, top layer first (optional, overrides order)
+    :param public_only: only include public tasks
+    :return: list of tasks, top layer first
+    """
+    extent = Polygon.from_bbox(bounds)
+    extent.srid = 4326
+
+    tasks = models.Task.objects.filter(project=project, status=status_codes.COMPLETED,
+                                       **{EXTENT_FIELDS[tile_type] + '__bboverlaps': extent}).select_related('project')
+    if public_only:
+        tasks = tasks.filter(public=True)
+
+    if task_ids is not None:
+        priority = {task_id: i for i, task_id in enumerate(task_ids)}
+        tasks = sorted(tasks.filter(pk__in=task_ids), key=lambda t: priority[str(t.id)])
+    else:
+        tasks = list(tasks.order_by('-created_at' if order == 'newest' else 'created_at'))
+
+    return tasks[:settings.MOSAIC_MAX_TASKS]
+
+
+def composite(layers):
+    """
+    Stack tile images, filling the transparent areas
+    of the upper layers with the lower ones
+    :param layers: iterable of (data, mask) tuples, top layer first
+    :return: (data, mask) tuple or None if there are no layers
+    """
+    data = None
+    mask = None
+
+    for layer_data, layer_mask in layers:
+        if layer_data.shape[0] == 1:
+            layer_data = np.repeat(layer_data, 3, axis=0)
+
+        if data is None:
+            data = np.array(layer_data, dtype=np.uint8)
+            mask = np.array(layer_mask, dtype=np.uint8)
+        else:
+            fill = (mask == 0) & (layer_mask != 0)
+            data[:, fill] = layer_data[:3, fill]
+            mask[fill] = layer_mask[fill]
+
+        # Lower layers would not be visible
+        if np.all(mask != 0):
+            break
+
+    if data is None:
+        return None
+
+    return data, mask
+
+
+class ProjectTiles(APIView):
+    permission_classes = (AllowAny, )
+
+    def get(self, request, project_pk=None, tile_type="", z="", x="", y="", scale=1, ext=None):
+        """
+        Get a tile image composited from the rasters of all completed
+        tasks in a project. By default newer tasks are drawn on top of older ones
+        (order=oldest reverses this) or tasks can be listed in order of priority
+        with tasks=<id1>,<id2>,... Styling parameters are the same as for task tiles.
+        """
+        timer = StageTimer()
+        try:
+            project = models.Project.objects.get(pk=project_pk, deleting=False)
+        except (ObjectDoesNotExist, ValueError):
+            raise exceptions.NotFound()
+
+        # Users that cannot view a project can still see its public tasks
+        public_only = not project.public and not request.user.has_perm('view_project', project)
+
+        order = request.query_params.get('order', 'newest')
+        if order not in ['newest', 'oldest']:
+            raise exceptions.ValidationError(_("Invalid order parameter"))
+
+        task_ids = request.query_params.get('tasks')
+        if task_ids is not None:
+            try:
+                task_ids = [str(uuid.UUID(t.strip())) for t in task_ids.split(",") if t.strip() != ""]
+            except ValueError:
+                raise exceptions.ValidationError(_("Invalid tasks parameter"))
+
+        # 512px tiles are read one zoom level lower
+        try:
+            read_z = int(z) - 1 if request.query_params.get('size') == '512' else int(z)
+            x = int(x)
+            y = int(y)
+            scale = int(scale)
+        except ValueError:
+            raise exceptions.NotFound()
+
+        tasks = get_mosaic_tasks(project, tile_type, get_tile_bounds(read_z, x, y), order, task_ids, public_only)
+        timer.lap('db')
+        if len(tasks) == 0:
+            raise exceptions.NotFound()
+
+        accept_webp = 'image/webp' in request.headers.get('Accept', '')
+        layers = [(task, get_tile_params(task, tile_type, z, scale, request.query_params)) for task in tasks]
+
+        # The cache key changes with any of the layers (or their assets),
+        # so it's also used as ETag
+        cache_key = tilecache.get_mosaic_key(project.id, [get_raster_path(task, tile_type) for task, _discard_ in layers], {
+            'tile_type': tile_type,
+            'z': read_z, 'x': x, 'y': y,
+            'layers': [[str(task.id), params, task.crop.wkt if params['crop'] and task.crop is not None else None, task.epsg]
+                       for task, params in layers],
+            'ext': ext,
+            'webp': accept_webp if ext is None else None
+        })
+        if cache_key is None:
+            raise exceptions.NotFound()
+
+        etag = '"{}"'.format(cache_key.split("/")[1])
+        vary = ['Accept'] if ext is None else None
+        timer.group = "mosaic/{}".format(tile_type)
+
+        not_modified = get_not_modified_response(request, etag)
+        timer.lap('etag')
+        if not_modified is not None:
+            timer.group += "/not_modified"
+            return timer.finish(set_cache_headers(not_modified, project, etag, None, settings.TILE_HTTP_MAX_AGE, vary))
+
+        cached = tilecache.get(cache_key) if settings.TILE_CACHE else None
+        timer.lap('cache')
+        if cached is not None:
+            content, ext = cached
+            timer.group += "/cached"
+        else:
+            def read_layers():
+                for task, params in layers:
+                    try:
+                        yield read_tile_image(task, tile_type, x, y, params, timer)
+                    except exceptions.NotFound:
+                        pass
+
+            image = composite(read_layers())
+            timer.lap('composite')
+            if image is None:
+                raise exceptions.NotFound(_("Outside of bounds"))
+
+            content, ext = encode_tile(image[0], image[1], ext, accept_webp)
+            timer.lap('encode')
+
+            if settings.TILE_CACHE:
+                tilecache.set(cache_key, content, ext)
+                timer.lap('store')
+
+        return timer.finish(set_cache_headers(HttpResponse(content, content_type="image/{}".format(ext)),
+                                              project, etag, None, settings.TILE_HTTP_MAX_AGE, vary))
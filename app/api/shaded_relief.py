@@ -0,0 +1,98 @@
+import threading
+import numpy as np
+from .hillshade import LightSource
+
+# Scratch buffers are reused across calls (one set per thread and shape)
+_buffers = threading.local()
+MAX_BUFFER_SHAPES = 4
+
+
+def _get_buffers(shape):
+    cache = getattr(_buffers, 'cache', None)
+    if cache is None:
+        cache = _buffers.cache = {}
+
+    buffers = cache.get(shape)
+    if buffers is None:
+        if len(cache) >= MAX_BUFFER_SHAPES:
+            cache.clear()
+        buffers = cache[shape] = {
+            'gx': np.empty(shape, dtype=np.float32),
+            'gy': np.empty(shape, dtype=np.float32),
+            'norm': np.empty(shape, dtype=np.float32),
+            'tmp': np.empty(shape, dtype=np.float32),
+            'maxc': np.empty(shape, dtype=np.uint8),
+            'black': np.empty(shape, dtype=np.bool_)
+        }
+    return buffers
+
+
+def shaded_relief(rgb, elevation, dx, dy, vert_exag=1, pad=1, azdeg=315, altdeg=45):
+    """
+    Shade colored elevation data. This is equivalent to computing
+    LightSource.hillshade on the padded elevation and replacing the value
+    component of the colors with the resulting intensity (hsv_blend),
+    but without intermediate normal vectors and HSV arrays.
+
+    Replacing V in HSV space while keeping hue and saturation
+    scales each channel by intensity / max(r, g, b) (black stays gray),
+    so no conversion to and from HSV is needed.
+    :param rgb: (3, H, W) uint8 array of colors
+    :param elevation: (H + pad * 2, W + pad * 2) array of elevation values
+    :param dx: x-spacing of the elevation grid
+    :param dy: y-spacing of the elevation grid
+    :param vert_exag: vertical exaggeration
+    :param pad: number of elevation values around the colored area (at least 1)
+    :return: (3, H, W) uint8 array of shaded colors
+    """
+    if pad < 1:
+        raise ValueError("pad must be at least 1")
+
+    height, width = rgb.shape[1:]
+    if elevation.shape != (height + pad * 2, width + pad * 2):
+        raise ValueError("Elevation and color shapes do not match")
+
+    b = _get_buffers((height, width))
+    gx, gy, norm, tmp = b['gx'], b['gy'], b['norm'], b['tmp']
+    direction = LightSource(azdeg, altdeg).direction
+
+    # Central differences (only where they are needed)
+    np.subtract(elevation[pad:pad + height, pad + 1:pad + width + 1],
+                elevation[pad:pad + height, pad - 1:pad + width - 1], out=gx, casting='unsafe')
+    np.multiply(gx, vert_exag / (2.0 * dx), out=gx)
+    np.subtract(elevation[pad + 1:pad + height + 1, pad:pad + width],
+                elevation[pad - 1:pad + height - 1, pad:pad + width], out=gy, casting='unsafe')
+    np.multiply(gy, vert_exag / (2.0 * dy), out=gy)
+
+    # Length of the normal vectors (-gx, -gy, 1)
+    np.multiply(gx, gx, out=norm)
+    np.multiply(gy, gy, out=tmp)
+    norm += tmp
+    norm += 1
+    np.sqrt(norm, out=norm)
+
+    # Intensity (0-255) = normal . light direction
+    np.multiply(gx, -direction[0], out=gx)
+    np.multiply(gy, -direction[1], out=gy)
+    gx += gy
+    gx += direction[2]
+    gx /= norm
+    np.clip(gx, 0, 1, out=gx)
+    gx *= 255.0
+    intensity = gx
+
+    # Scale channels by intensity / max(r, g, b), or by intensity
+    # alone for black pixels (which have no hue or saturation)
+    maxc, black = b['maxc'], b['black']
+    np.maximum(rgb[0], rgb[1], out=maxc)
+    np.maximum(maxc, rgb[2], out=maxc)
+    np.equal(maxc, 0, out=black)
+    np.add(maxc, black, out=tmp, dtype=np.float32)
+    np.divide(intensity, tmp, out=tmp)
+
+    out = np.empty((3, height, width), dtype=np.uint8)
+    for i in range(3):
+        np.add(rgb[i], black, out=norm, dtype=np.float32)
+        np.multiply(norm, tmp, out=out[i], casting='unsafe')
+
+    return out
@@ -28,11 +28,12 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from django.db.models import Q
 
-from app import models, pending_actions
+from app import models, pending_actions, tilecache, raster_pool
 from nodeodm import status_codes
 from nodeodm.models import ProcessingNode
 from worker import tasks as worker_tasks
-from .common import get_and_check_project, get_asset_download_filename, check_project_perms
+from .common import get_and_check_project, get_asset_download_filename, check_project_perms, \
+    get_asset_etag, get_not_modified_response, set_cache_headers
 from .tags import TagsField
 from app.security import path_traversal_check
 from django.utils.translation import gettext_lazy as _
@@ -426,6 +427,10 @@ class TaskViewSet(viewsets.ViewSet):
         serializer.is_valid(raise_exception=True)
         serializer.save()
 
+        # Cached tiles might have been rendered with the previous crop area
+        if 'crop' in request.data:
+            tilecache.clear_task(task.id)
+
         # Process task right away
         worker_tasks.process_task.delay(task.id)
 
@@ -546,7 +551,17 @@ class TaskThumbnail(TaskNestedView):
         except ValueError:
             pass
 
-        with rasterio.open(orthophoto_path, "r") as raster:
+        accept_webp = 'image/webp' in request.META.get('HTTP_ACCEPT', '')
+        etag, last_modified = get_asset_etag(orthophoto_path, thumb_size, accept_webp,
+                                             task.crop.wkt if task.crop is not None else None)
+        if task.crop is not None:
+            last_modified = None
+
+        not_modified = get_not_modified_response(request, etag, last_modified)
+        if not_modified is not None:
+            return set_cache_headers(not_modified, task, etag, last_modified, vary=['Accept'])
+
+        with raster_pool.open_raster(orthophoto_path) as raster:
             ci = raster.colorinterp
             indexes = (1, 2, 3,)
 
@@ -628,7 +643,7 @@ class TaskThumbnail(TaskNestedView):
         img = Image.fromarray(img)
         output = io.BytesIO()
 
-        if 'image/webp' in request.META.get('HTTP_ACCEPT', ''):
+        if accept_webp:
             img.save(output, format='WEBP')
             res = HttpResponse(content_type="image/webp")
         else:
@@ -636,7 +651,7 @@ class TaskThumbnail(TaskNestedView):
             res = HttpResponse(content_type="image/png")
 
         res['Content-Disposition'] = 'inline'
-        res['Cache-Control'] = 'no-store'
+        set_cache_headers(res, task, etag, last_modified, vary=['Accept'])
         res.write(output.getvalue())
         output.close()
 
@@ -6,34 +6,38 @@ from rasterio.features import bounds as featureBounds
 from rasterio.errors import NotGeoreferencedWarning
 import urllib
 import os
-from .common import get_asset_download_filename
+import re
+import uuid
+from .common import get_asset_download_filename, get_asset_etag, get_not_modified_response, set_cache_headers
 from django.http import HttpResponse
 from rio_tiler.errors import TileOutsideBounds
 from rio_tiler.utils import has_alpha_band, \
     non_alpha_indexes, render, create_cutline
-from rio_tiler.utils import _stats as raster_stats
-from rio_tiler.models import ImageStatistics, ImageData
-from rio_tiler.models import Metadata as RioMetadata
+from rio_tiler.models import ImageData
 from rio_tiler.profiles import img_profiles
-from rio_tiler.colormap import cmap as colormap, apply_cmap
-from rio_tiler.io import COGReader
 from rio_tiler.errors import InvalidColorMapName, AlphaBandWarning
 import numpy as np
-from .custom_colormaps_helper import custom_colormaps
-from app.raster_utils import extension_for_export_format, ZOOM_EXTRA_LEVELS
-from .hsvblend import hsv_blend
-from .hillshade import LightSource
+from .colormaps import colormap, get_lut, apply_colormap
+from app.raster_utils import extension_for_export_format, cog_compression_options, ZOOM_EXTRA_LEVELS
+from .shaded_relief import shaded_relief
 from .formulas import lookup_formula, get_algorithm_list, get_auto_bands
 from .tasks import TaskNestedView
 from app.geoutils import geom_transform_wkt_bbox, get_rasterio_to_meters_factor
 from rest_framework import exceptions
 from rest_framework.response import Response
-from worker.tasks import export_raster, export_pointcloud
+from worker.tasks import export_raster, export_pointcloud, export_tiles, export_batch, TestSafeAsyncResult
 from django.utils.translation import gettext as _
+from app import tilecache, exportcache, raster_pool, raster_stats, vector_tiles
+from app.mbtiles import get_export_ranges, count_tiles
+from app.timings import StageTimer
+from webodm import settings
 import warnings
+import logging
 from functools import lru_cache
 from osgeo import osr
 
+logger = logging.getLogger('app.logger')
+
 # Disable: NotGeoreferencedWarning: Dataset has no geotransform, gcps, or rpcs. The identity matrix be returned.
 warnings.filterwarnings("ignore", category=NotGeoreferencedWarning)
 
@@ -46,9 +50,6 @@ warnings.filterwarnings("ignore", category=UserWarning)
 # Disable: RuntimeWarning: overflow encountered in reduce
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 
-for custom_colormap in custom_colormaps:
-    colormap = colormap.register(custom_colormap)
-
 @lru_cache(maxsize=128)
 def get_colormap_encoded_values(cmap):
     values = colormap.get(cmap).values()
@@ -106,6 +107,12 @@ def get_raster_path(task, tile_type):
 def get_pointcloud_path(task):
     return task.get_asset_download_path("georeferenced_model.laz")
 
+def get_request_etag(task, asset_path, request, *params):
+    # Include all task fields that can change the response
+    return get_asset_etag(asset_path, str(task.project.id), task.name, task.epsg,
+                          task.crop.wkt if task.crop is not None else None,
+                          task.orthophoto_bands, sorted(request.query_params.lists()), *params)
+
 
 class TileJson(TaskNestedView):
     def get(self, request, pk=None, project_pk=None, tile_type=""):
@@ -118,10 +125,15 @@ class TileJson(TaskNestedView):
         if not os.path.isfile(raster_path):
             raise exceptions.NotFound()
 
-        with COGReader(raster_path) as src:
+        etag, _discard_ = get_request_etag(task, raster_path, request, 'tilejson', tile_type)
+        not_modified = get_not_modified_response(request, etag)
+        if not_modified is not None:
+            return set_cache_headers(not_modified, task, etag)
+
+        with raster_pool.open_cog(raster_path) as src:
             minzoom, maxzoom = get_zoom_safe(src)
 
-        return Response({
+        return set_cache_headers(Response({
             'tilejson': '2.1.0',
             'name': task.name,
             'version': '1.0.0',
@@ -130,7 +142,7 @@ class TileJson(TaskNestedView):
             'minzoom': minzoom - ZOOM_EXTRA_LEVELS,
             'maxzoom': maxzoom + ZOOM_EXTRA_LEVELS,
             'bounds': get_extent(task, tile_type).extent
-        })
+        }), task, etag)
 
 
 class Bounds(TaskNestedView):
@@ -140,10 +152,15 @@ class Bounds(TaskNestedView):
         """
         task = self.get_and_check_task(request, pk)
 
-        return Response({
+        etag, _discard_ = get_request_etag(task, get_raster_path(task, tile_type), request, 'bounds', tile_type)
+        not_modified = get_not_modified_response(request, etag)
+        if not_modified is not None:
+            return set_cache_headers(not_modified, task, etag)
+
+        return set_cache_headers(Response({
             'url': get_tile_url(task, tile_type, self.request.query_params),
             'bounds': get_extent(task, tile_type).extent
-        })
+        }), task, etag)
 
 
 class Metadata(TaskNestedView):
@@ -151,7 +168,9 @@ class Metadata(TaskNestedView):
         """
         Get the metadata for this tasks's asset type
         """
+        timer = StageTimer()
         task = self.get_and_check_task(request, pk)
+        timer.lap('db')
         formula = self.request.query_params.get('formula')
         bands = self.request.query_params.get('bands')
         defined_range = self.request.query_params.get('range')
@@ -186,9 +205,17 @@ class Metadata(TaskNestedView):
         if not os.path.isfile(raster_path):
             raise exceptions.NotFound()
 
+        etag, _discard_ = get_request_etag(task, raster_path, request, 'metadata', tile_type)
+        not_modified = get_not_modified_response(request, etag)
+        timer.lap('etag')
+        if not_modified is not None:
+            timer.group = "metadata/{}/not_modified".format(tile_type)
+            return timer.finish(set_cache_headers(not_modified, task, etag))
+
         to_meter = 1.0
         try:
-            with COGReader(raster_path) as src:
+            with raster_pool.open_cog(raster_path) as src:
+                timer.lap('open')
 
                 band_count = src.dataset.meta['count']
                 if boundaries_feature is not None:
@@ -219,25 +246,35 @@ class Metadata(TaskNestedView):
 
                 if has_alpha_band(src.dataset):
                     band_count -= 1
-                nodata = None
-                # Workaround for https://github.com/WebODM/WebODM/issues/894
-                if tile_type == 'orthophoto':
-                    nodata = 0
-                histogram_options = {"bins": 255, "range": hrange}
-                if expr is not None:
-                    data, mask = src.preview(expression=expr, vrt_options=vrt_options)
-                    data = np.ma.array(data)
-                    data.mask = mask == 0
-                    stats = {
-                        str(b + 1): raster_stats(data[b], percentiles=(pmin, pmax), bins=255, range=hrange)
-                        for b in range(data.shape[0])
-                    }
-                    stats = {b: ImageStatistics(**s) for b, s in stats.items()}
-                    metadata = RioMetadata(statistics=stats, **src.info().dict())
+                timer.lap('prepare')
+
+                # Use precomputed statistics, or memoized ones
+                # for ad-hoc areas (crops, boundaries)
+                cache_key = None
+                if cutline is None:
+                    info = raster_stats.get(task, tile_type, expr, hrange)
                 else:
-                    metadata = src.metadata(pmin=pmin, pmax=pmax, hist_options=histogram_options, nodata=nodata,
-                                            bounds=bounds, vrt_options=vrt_options)
-                info = json.loads(metadata.json())
+                    cache_key = raster_stats.get_cache_key(task, tile_type, expr, hrange,
+                                                           boundaries_feature if boundaries_feature is not None else task.crop)
+                    info = raster_stats.cache_get(cache_key)
+                timer.lap('lookup')
+
+                timing_source = "cached"
+                if info is None:
+                    timing_source = "computed"
+                    info = raster_stats.compute_metadata(src, tile_type, expr, hrange, pmin=pmin, pmax=pmax,
+                                                         bounds=bounds, vrt_options=vrt_options)
+                    if cache_key is not None:
+                        raster_stats.cache_set(cache_key, info)
+                    elif cutline is None and defined_range is None:
+                        try:
+                            raster_stats.put(task, tile_type, {(expr, hrange): info})
+                        except OSError as e:
+                            logger.warning("Cannot store raster statistics for {}: {}".format(task, str(e)))
+                    timer.lap('statistics')
+
+                timing_options = [k for k, v in [('formula', expr), ('cutline', cutline is not None)] if v]
+                timer.group = "metadata/{}/{}/{}".format(tile_type, "+".join(timing_options) or "default", timing_source)
         except IndexError as e:
             # Caught when trying to get an invalid raster metadata
             # or when the crop area is defined improperly. In order
@@ -325,8 +362,406 @@ class Metadata(TaskNestedView):
         info['minzoom'] -= ZOOM_EXTRA_LEVELS
         info['bounds'] = {'value': bounds if bounds is not None else src.bounds, 
                           'crs': f"EPSG:{task.epsg}" if task.epsg is not None else task.wkt}
+        timer.lap('finalize')
+
+        return timer.finish(set_cache_headers(Response(info), task, etag))
+
+
+def get_tile_params(task, tile_type, z, scale=1, query_params={}):
+    """
+    Parse and validate the styling parameters of a tile request
+    :param query_params: styling parameters (formula, bands, rescale, color_map, hillshade, size, crop, boundaries)
+    :return: dictionary of parameters, including the zoom level and tile size
+        at which the tile needs to be read
+    """
+    z = int(z)
+    scale = int(scale)
+
+    formula = query_params.get('formula')
+    bands = query_params.get('bands')
+    rescale = query_params.get('rescale')
+    color_map = query_params.get('color_map')
+    hillshade = query_params.get('hillshade')
+    tilesize = query_params.get('size')
+    crop = query_params.get('crop') == '1'
+
+    boundaries_feature = query_params.get('boundaries')
+    if boundaries_feature == '':
+        boundaries_feature = None
+    if boundaries_feature is not None:
+        try:
+            boundaries_feature = json.loads(boundaries_feature)
+        except json.JSONDecodeError:
+            raise exceptions.ValidationError(_("Invalid boundaries parameter"))
+
+    if formula == '': formula = None
+    if bands == '': bands = None
+    if rescale == '': rescale = None
+    if color_map == '': color_map = None
+    if hillshade == '' or hillshade == '0': hillshade = None
+    if tilesize == '' or tilesize is None: tilesize = 256
+    if bands == 'auto' and formula:
+        bands, _discard_ = get_auto_bands(task.orthophoto_bands, formula)
+
+    try:
+        tilesize = int(tilesize)
+        if tilesize != 256 and tilesize != 512:
+            raise ValueError("Invalid size")
+
+        if tilesize == 512:
+            z -= 1
+    except ValueError:
+        raise exceptions.ValidationError(_("Invalid tile size parameter"))
+
+    try:
+        expr, _discard_ = lookup_formula(formula, bands)
+    except ValueError as e:
+        raise exceptions.ValidationError(str(e))
+
+    if tile_type in ['dsm', 'dtm'] and rescale is None:
+        rescale = "0,1000"
+    if tile_type == 'orthophoto' and rescale is None:
+        rescale = "0,255"
+
+    if tile_type in ['dsm', 'dtm'] and color_map is None:
+        color_map = "gray"
+
+    if tile_type == 'orthophoto' and formula is not None:
+        if color_map is None:
+            color_map = "gray"
+        if rescale is None:
+            rescale = "-1,1"
+
+    return {
+        'z': z,
+        'tilesize': scale * tilesize,
+        'formula': formula,
+        'bands': bands,
+        'expr': expr,
+        'rescale': rescale,
+        'color_map': color_map,
+        'hillshade': hillshade,
+        'crop': crop,
+        'boundaries': boundaries_feature
+    }
+
+
+def read_tile_image(task, tile_type, x, y, params, timer=None):
+    """
+    Read and style a tile of a task's raster
+    :param params: tile parameters (as returned by get_tile_params)
+    :param timer: StageTimer to record the rendering stages with (optional)
+    :return: (data, mask) tuple of uint8 arrays. Raises NotFound if the
+        raster is missing or if it doesn't cover the tile.
+    """
+    if timer is None:
+        timer = StageTimer(False)
+
+    x = int(x)
+    y = int(y)
+    url = get_raster_path(task, tile_type)
+    if not os.path.isfile(url):
+        raise exceptions.NotFound()
+
+    z = params['z']
+    tilesize = params['tilesize']
+    expr = params['expr']
+    rescale = params['rescale']
+    color_map = params['color_map']
+    hillshade = params['hillshade']
+    boundaries_feature = params['boundaries']
+    crop = params['crop']
+
+    indexes = None
+    nodata = None
+    to_meter = 1.0
+    with raster_pool.open_cog(url) as src:
+        timer.lap('open')
+        if not src.tile_exists(z, x, y):
+            raise exceptions.NotFound(_("Outside of bounds"))
+
+        minzoom, maxzoom = get_zoom_safe(src)
+        has_alpha = has_alpha_band(src.dataset)
+        if z < minzoom - ZOOM_EXTRA_LEVELS or z > maxzoom + ZOOM_EXTRA_LEVELS:
+            raise exceptions.NotFound()
+
+        if boundaries_feature is not None:
+            try:
+                cutline = create_cutline(src.dataset, boundaries_feature, CRS.from_string('EPSG:4326'))
+            except:
+                raise exceptions.ValidationError(_("Invalid boundaries"))
+        elif crop and task.crop is not None:
+            cutline, bounds = geom_transform_wkt_bbox(task.crop, src.dataset)
+        else:
+            cutline = None
+        
+        if cutline is not None:
+            vrt_options = {'cutline': cutline}
+        else:
+            vrt_options = None
+
+        if tile_type in ['dsm', 'dtm']:
+            to_meter = get_rasterio_to_meters_factor(src.dataset)
+
+        # Handle N-bands datasets for orthophotos (not plant health)
+        if tile_type == 'orthophoto' and expr is None:
+            ci = src.dataset.colorinterp
+            # More than 4 bands?
+            if len(ci) > 4:
+                # Try to find RGBA band order
+                if ColorInterp.red in ci and \
+                        ColorInterp.green in ci and \
+                        ColorInterp.blue in ci:
+                    indexes = (ci.index(ColorInterp.red) + 1,
+                               ci.index(ColorInterp.green) + 1,
+                               ci.index(ColorInterp.blue) + 1,)
+                else:
+                    # Fallback to first three
+                    indexes = (1, 2, 3,)
+            elif has_alpha:
+                indexes = non_alpha_indexes(src.dataset)
+
+        # Workaround for https://github.com/WebODM/WebODM/issues/894
+        if nodata is None and tile_type == 'orthophoto':
+            nodata = 0
+
+        resampling = "nearest"
+        padding = 0
+        tile_buffer = None
+
+        if tile_type in ["dsm", "dtm"]:
+            resampling = "bilinear"
+            padding = 16
+
+            # WarpedVRT is really slow with compound CRSes
+            # so we override the CRS to the 2D version for speed
+            # in case there's one
+            if vrt_options is None:
+                vrt_options = {}
+
+            if task.epsg is not None:
+                vrt_options['src_crs'] = f"EPSG:{task.epsg}"
+
+        # Hillshading is not a local tile operation and
+        # requires neighbor tiles to be rendered seamlessly
+        if hillshade is not None:
+            tile_buffer = 16
+
+        timer.lap('prepare')
+
+        try:
+            if expr is not None:
+                tile = src.tile(x, y, z, expression=expr, tilesize=tilesize, nodata=nodata,
+                                padding=padding,
+                                tile_buffer=tile_buffer,
+                                resampling_method=resampling, vrt_options=vrt_options)
+            else:
+                tile = src.tile(x, y, z, indexes=indexes, tilesize=tilesize, nodata=nodata,
+                                padding=padding,
+                                tile_buffer=tile_buffer,
+                                resampling_method=resampling, vrt_options=vrt_options)
+        except TileOutsideBounds:
+            raise exceptions.NotFound(_("Outside of bounds"))
+        timer.lap('read')
+        
+        if color_map:
+            try:
+                get_lut(color_map)
+            except InvalidColorMapName:
+                raise exceptions.ValidationError(_("Not a valid color_map value"))
+        
+        elevation = None
+        try:
+            rescale_arr = list(map(float, rescale.split(",")))
+            if len(rescale_arr) != 2:
+                raise ValueError("Invalid rescale")
+            if tile_type in ['dsm', 'dtm']:
+                rescale_arr = [v / to_meter for v in rescale_arr]
+        except ValueError:
+            raise exceptions.ValidationError(_("Invalid rescale value"))
+
+        if hillshade is not None:
+            try:
+                hillshade = float(hillshade)
+                if hillshade <= 0:
+                    hillshade = 1.0
+            except ValueError:
+                raise exceptions.ValidationError(_("Invalid hillshade value"))
+            if tile.data.shape[0] != 1:
+                raise exceptions.ValidationError(
+                    _("Cannot compute hillshade of non-elevation raster (multiple bands found)"))
+            delta_scale = (maxzoom + ZOOM_EXTRA_LEVELS + 1 - z) ** 2
+            dx = src.dataset.meta["transform"][0] * delta_scale
+            dy = src.dataset.meta["transform"][4] * delta_scale
+
+            # Remove elevation data from edge buffer tiles
+            # (to keep intensity uniform across tiles)
+            elevation = tile.data[0]
+            elevation[0:tile_buffer, 0:tile_buffer] = nodata
+            elevation[tile_buffer+tilesize:tile_buffer*2+tilesize, 0:tile_buffer] = nodata
+            elevation[0:tile_buffer, tile_buffer+tilesize:tile_buffer*2+tilesize] = nodata
+            elevation[tile_buffer+tilesize:tile_buffer*2+tilesize, tile_buffer+tilesize:tile_buffer*2+tilesize] = nodata
+
+        if elevation is not None:
+            if color_map is None:
+                raise exceptions.ValidationError(
+                    _("Cannot process tile: intensity image provided, but no RGB data was computed."))
+            mask = tile.mask[tile_buffer:tilesize+tile_buffer, tile_buffer:tilesize+tile_buffer]
+            rgb, _discard_ = apply_colormap(tile.data[:,tile_buffer:tilesize+tile_buffer, tile_buffer:tilesize+tile_buffer],
+                                            rescale_arr, color_map, mask)
+            timer.lap('colormap')
+            rgb = shaded_relief(rgb, elevation, dx, dy, vert_exag=hillshade, pad=tile_buffer)
+            timer.lap('hillshade')
+            return rgb, mask
+        elif color_map is not None and tile.data.shape[0] == 1:
+            # Single band: rescale and map through the colormap in one pass
+            data, alpha = apply_colormap(tile.data, rescale_arr, color_map, tile.mask)
+            mask = np.bitwise_and(tile.mask, alpha)
+            timer.lap('colormap')
+            return data, mask
+        else:
+            rgb = tile.post_process(in_range=(rescale_arr,))
+            timer.lap('rescale')
+            return rgb.data, rgb.mask
+
+
+def render_tile(task, tile_type, z, x, y, scale=1, ext=None, query_params={}, accept_webp=False, timer=None):
+    """
+    Render a tile image (or fetch it from the tile cache)
+    :param query_params: styling parameters (formula, bands, rescale, color_map, hillshade, size, crop, boundaries)
+    :param accept_webp: whether the WebP format can be used when ext is None
+    :param timer: StageTimer to record the rendering stages with (optional)
+    :return: (content, ext) tuple
+    """
+    if timer is None:
+        timer = StageTimer(False)
+
+    params = get_tile_params(task, tile_type, z, scale, query_params)
+    x = int(x)
+    y = int(y)
+
+    url = get_raster_path(task, tile_type)
+    if not os.path.isfile(url):
+        raise exceptions.NotFound()
+
+    crop_wkt = task.crop.wkt if params['crop'] and task.crop is not None else None
+    cache_key = None
+    if settings.TILE_CACHE:
+        cache_key = tilecache.get_key(task.id, url, {
+            'tile_type': tile_type,
+            'z': params['z'], 'x': x, 'y': y,
+            'tilesize': params['tilesize'],
+            'formula': params['formula'],
+            'bands': params['bands'],
+            'rescale': params['rescale'],
+            'color_map': params['color_map'],
+            'hillshade': params['hillshade'],
+            'crop': crop_wkt,
+            'boundaries': params['boundaries'],
+            'epsg': task.epsg,
+            'ext': ext,
+            # Only relevant when the format is negotiated
+            'webp': accept_webp if ext is None else None,
+        })
+
+    # Group timings by the options that affect rendering
+    timing_options = [k for k, v in [('formula', params['formula']), ('color_map', params['color_map']), ('hillshade', params['hillshade']),
+                                     ('cutline', params['boundaries'] is not None or crop_wkt is not None)] if v]
+    timer.group = "tile/{}/{}/{}".format(tile_type, params['tilesize'], "+".join(timing_options) or "default")
+    timer.lap('params')
+
+    if cache_key is not None:
+        cached = tilecache.get(cache_key)
+        timer.lap('cache')
+        if cached is not None:
+            timer.group += "/cached"
+            return cached
+
+    data, mask = read_tile_image(task, tile_type, x, y, params, timer)
+    content, ext = encode_tile(data, mask, ext, accept_webp)
+    timer.lap('encode')
+
+    tilecache.set(cache_key, content, ext)
+    timer.lap('store')
+
+    return content, ext
+
+
+def encode_tile(data, mask, ext=None, accept_webp=False):
+    """
+    :param ext: image format (png, jpg, webp) or None to choose
+        based on transparency and on accept_webp
+    :return: (content, ext) tuple
+    """
+    if ext is None:
+        # Check for transparency
+        if np.equal(mask, 255).all():
+            ext = "jpg"
+        else:
+            if accept_webp:
+                ext = "webp"
+            else:
+                ext = "png"
+
+    driver = "jpeg" if ext == "jpg" else ext
+    options = img_profiles.get(driver, {})
+
+    return render(data, mask, img_format=driver, **options), ext
+
+
+def format_rescale_value(v):
+    # Match the formatting of the map client (JavaScript), so that
+    # seeded tiles have the same cache keys as requested tiles
+    v = float(v)
+    if v.is_integer():
+        return str(int(v))
+    else:
+        return repr(v)
+
+
+def get_seed_tiles(task, max_zoom_levels, max_tiles):
+    """
+    List the tiles that the map client requests with default styling,
+    starting from the minimum zoom level
+    :param max_zoom_levels: maximum number of zoom levels to include
+    :param max_tiles: maximum number of tiles to include (only whole zoom levels are included)
+    :return: list of (tile_type, z, x, y, query_params) tuples
+    """
+    tiles = []
+    TILESIZE = 512 # Same as the map client
+
+    for tile_type in ['orthophoto', 'dsm', 'dtm']:
+        raster_path = get_raster_path(task, tile_type)
+        if not os.path.isfile(raster_path):
+            continue
 
-        return Response(info)
+        with raster_pool.open_cog(raster_path) as src:
+            minzoom, maxzoom = get_zoom_safe(src)
+            to_meter = get_rasterio_to_meters_factor(src.dataset) if tile_type in ['dsm', 'dtm'] else 1.0
+
+            md = raster_stats.get(task, tile_type)
+            if md is None:
+                md = raster_stats.compute_metadata(src, tile_type, vrt_options=raster_stats.get_vrt_options(task, tile_type))
+
+            # The client uses the min/max of the last band
+            band_stats = md['statistics'][sorted(md['statistics'].keys(), key=int)[-1]]
+            query_params = {
+                'rescale': "{},{}".format(format_rescale_value(band_stats['min'] * to_meter),
+                                          format_rescale_value(band_stats['max'] * to_meter)),
+                'size': str(TILESIZE)
+            }
+            if tile_type in ['dsm', 'dtm']:
+                query_params['hillshade'] = '6'
+                query_params['color_map'] = 'viridis'
+
+            # 512px tiles are rendered one zoom level lower
+            for z in range(minzoom, min(maxzoom, minzoom + max_zoom_levels - 1) + 1):
+                zoom_tiles = [(tile_type, t.z + 1, t.x, t.y, query_params) for t in src.tms.tiles(*src.bounds, [z])]
+                if len(tiles) + len(zoom_tiles) > max_tiles:
+                    break
+                tiles += zoom_tiles
+
+    return tiles
 
 
 class Tiles(TaskNestedView):
@@ -334,248 +769,426 @@ class Tiles(TaskNestedView):
         """
         Get a tile image
         """
+        timer = StageTimer()
         task = self.get_and_check_task(request, pk)
-        
-        z = int(z)
-        x = int(x)
-        y = int(y)
+        timer.lap('db')
+        accept_webp = 'image/webp' in request.headers.get('Accept', '')
+
+        # Tiles only depend on the asset and on the request, unless there's a crop
+        etag, last_modified = get_request_etag(task, get_raster_path(task, tile_type), request, 'tile', tile_type,
+                                               z, x, y, scale, ext, accept_webp if ext is None else None)
+        if task.crop is not None:
+            last_modified = None
+        vary = ['Accept'] if ext is None else None
+
+        not_modified = get_not_modified_response(request, etag, last_modified)
+        timer.lap('etag')
+        if not_modified is not None:
+            timer.group = "tile/{}/not_modified".format(tile_type)
+            return timer.finish(set_cache_headers(not_modified, task, etag, last_modified, settings.TILE_HTTP_MAX_AGE, vary))
+
+        content, ext = render_tile(task, tile_type, z, x, y, scale, ext, request.query_params, accept_webp, timer)
+
+        return timer.finish(set_cache_headers(HttpResponse(content, content_type="image/{}".format(ext)),
+                                 task, etag, last_modified, settings.TILE_HTTP_MAX_AGE, vary))
+
 
+class TilesBatch(TaskNestedView):
+    def get(self, request, pk=None, project_pk=None, tile_type=""):
+        """
+        Get multiple tile images with the same styling in a single
+        multipart/mixed response. Tiles are listed in the "tiles" parameter
+        as comma separated z/x/y values. The (optional) "scale" parameter
+        (1-4) requests high-DPI tiles, like @<scale>x does for single tiles.
+        Each part has a Content-Location header with its z/x/y value and tiles
+        that cannot be found are returned as empty parts with a X-Tile-Status: 404 header.
+        """
+        task = self.get_and_check_task(request, pk)
+        if not os.path.isfile(get_raster_path(task, tile_type)):
+            raise exceptions.NotFound()
+
+        tiles = request.query_params.get('tiles', '')
+        ext = request.query_params.get('ext')
+        if ext == '': ext = None
+        if ext is not None and not ext in ['png', 'jpg', 'webp']:
+            raise exceptions.ValidationError(_("Invalid ext parameter"))
+
+        scale = request.query_params.get('scale', '1')
+        if re.match(r"^\d+$", scale) is None or not 1 <= int(scale) <= 4:
+            raise exceptions.ValidationError(_("Invalid scale parameter"))
         scale = int(scale)
 
-        indexes = None
-        nodata = None
-        rgb_tile = None
+        coords = []
+        for t in tiles.split(","):
+            m = re.match(r"^(\d+)/(\d+)/(\d+)$", t.strip())
+            if m is None:
+                raise exceptions.ValidationError(_("Invalid tiles parameter"))
+            coords.append(m.groups())
 
-        formula = self.request.query_params.get('formula')
-        bands = self.request.query_params.get('bands')
-        rescale = self.request.query_params.get('rescale')
-        color_map = self.request.query_params.get('color_map')
-        hillshade = self.request.query_params.get('hillshade')
-        tilesize = self.request.query_params.get('size')
-        crop = self.request.query_params.get('crop') == '1'
+        if len(coords) > settings.TILE_BATCH_MAX_TILES:
+            raise exceptions.ValidationError(_("Too many tiles (max: %(value)s)") % {'value': settings.TILE_BATCH_MAX_TILES})
 
-        boundaries_feature = self.request.query_params.get('boundaries')
-        if boundaries_feature == '':
-            boundaries_feature = None
-        if boundaries_feature is not None:
+        accept_webp = 'image/webp' in request.headers.get('Accept', '')
+        boundary = uuid.uuid4().hex
+        parts = []
+
+        # Tiles are rendered sequentially, so they
+        # all reuse the same pooled dataset handle
+        for z, x, y in coords:
+            headers = ["Content-Location: {}/{}/{}".format(z, x, y)]
             try:
-                boundaries_feature = json.loads(boundaries_feature)
-            except json.JSONDecodeError:
-                raise exceptions.ValidationError(_("Invalid boundaries parameter"))
+                content, tile_ext = render_tile(task, tile_type, z, x, y, scale, ext, request.query_params, accept_webp)
+                headers.insert(0, "Content-Type: image/{}".format(tile_ext))
+            except exceptions.NotFound:
+                content = b""
+                headers.append("X-Tile-Status: 404")
+
+            parts.append("--{}\r\n{}\r\n\r\n".format(boundary, "\r\n".join(headers)).encode('ascii') + content + b"\r\n")
+
+        parts.append("--{}--\r\n".format(boundary).encode('ascii'))
+
+        return HttpResponse(b"".join(parts), content_type='multipart/mixed; boundary="{}"'.format(boundary))
 
-        if formula == '': formula = None
-        if bands == '': bands = None
-        if rescale == '': rescale = None
-        if color_map == '': color_map = None
-        if hillshade == '' or hillshade == '0': hillshade = None
-        if tilesize == '' or tilesize is None: tilesize = 256
-        if bands == 'auto' and formula:
-            bands, _discard_ = get_auto_bands(task.orthophoto_bands, formula)
 
+class VectorTiles(TaskNestedView):
+    def get(self, request, pk=None, project_pk=None, z="", x="", y=""):
+        """
+        Get a Mapbox Vector Tile with the camera shots, ground control points
+        and media locations of a task. Layers can be restricted
+        with layers=<layer1>,<layer2>,...
+        """
+        timer = StageTimer()
+        timer.group = "vector"
+        task = self.get_and_check_task(request, pk)
+        timer.lap('db')
+
+        z = int(z)
+        x = int(x)
+        y = int(y)
+        if z > vector_tiles.INDEX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+            raise exceptions.NotFound()
+
+        layers = request.query_params.get('layers')
+        if layers is not None:
+            layers = [l.strip() for l in layers.split(",") if l.strip() != ""]
+            for l in layers:
+                if not l in vector_tiles.LAYERS:
+                    raise exceptions.ValidationError(_("Invalid layers parameter"))
+
+        index_path = vector_tiles.get_index_path(task)
+        if not os.path.isfile(index_path):
+            vector_tiles.generate(task)
+            timer.lap('index')
+
+        etag, last_modified = get_asset_etag(index_path, str(task.id), z, x, y, layers)
+        not_modified = get_not_modified_response(request, etag, last_modified)
+        timer.lap('etag')
+        if not_modified is not None:
+            timer.group += "/not_modified"
+            return timer.finish(set_cache_headers(not_modified, task, etag, last_modified, settings.TILE_HTTP_MAX_AGE))
+
+        content = vector_tiles.get_tile(task, z, x, y, layers)
+        timer.lap('encode')
+
+        return timer.finish(set_cache_headers(HttpResponse(content, content_type="application/vnd.mapbox-vector-tile"),
+                                              task, etag, last_modified, settings.TILE_HTTP_MAX_AGE))
+
+EXPORT_ASSETS = ['orthophoto', 'dsm', 'dtm', 'georeferenced_model']
+
+
+def get_export_cache_key(task, asset_path, job, args, opts):
+    """
+    :return: export cache key of a job or None if the export cache is disabled
+    """
+    return exportcache.get_key(task.id, asset_path, job.name, {
+        'args': args,
+        'opts': opts,
+        'crop': task.crop.wkt if task.crop is not None else None
+    }) if settings.EXPORT_CACHE else None
+
+
+def start_export(task, asset_path, job, args, opts):
+    """
+    Start an export job, unless an identical export (same asset and options)
+    is already running or has finished and its result is still cached
+    :param job: celery task (export_raster, export_tiles, export_pointcloud)
+    :return: celery task ID
+    """
+    cache_key = get_export_cache_key(task, asset_path, job, args, opts)
+    if cache_key is None:
+        return job.delay(*args, **opts).task_id
+
+    job_id = exportcache.get_job(cache_key)
+    if job_id is not None:
+        res = TestSafeAsyncResult(job_id)
+        if not res.ready():
+            # Attach to the running job
+            return job_id
+
+        try:
+            result = res.get()
+        except Exception:
+            result = None
+
+        if isinstance(result, dict) and isinstance(result.get('file'), str) and exportcache.touch(result['file']):
+            return job_id
+
+        # Failed or evicted
+        exportcache.forget_job(cache_key)
+
+    job_id = str(uuid.uuid4())
+    if not exportcache.set_job(cache_key, job_id, only_new=True):
+        # An identical job was started in the meantime
+        running_job_id = exportcache.get_job(cache_key)
+        if running_job_id is not None:
+            return running_job_id
+
+    return job.apply_async(args=args, kwargs=dict(opts, cache_key=cache_key), task_id=job_id).task_id
+
+
+def plan_export(task, asset_type, data, stats=None):
+    """
+    Validate the parameters of an export
+    :param data: export parameters (formula, bands, format, epsg, ...)
+    :param stats: dictionary of raster statistics shared between the
+        exports of a batch (optional)
+    :return: dictionary with the filename of the export and either the url of an asset
+        that can be downloaded as-is or the celery job to run (with its args and opts)
+    """
+    formula = data.get('formula')
+    bands = data.get('bands')
+    rescale = data.get('rescale')
+    export_format = data.get('format', 'laz' if asset_type == 'georeferenced_model' else 'gtiff')
+    epsg = data.get('epsg')
+    proj = data.get('proj')
+    color_map = data.get('color_map')
+    hillshade = data.get('hillshade')
+    resample = data.get('resample', 0)
+    minzoom = data.get('minzoom')
+    maxzoom = data.get('maxzoom')
+    bbox = data.get('bbox')
+    tile_format = data.get('tile_format', 'png')
+    compress = data.get('compress')
+
+    if formula == '': formula = None
+    if bands == '': bands = None
+    if rescale == '': rescale = None
+    if epsg == '': epsg = None
+    if proj == '': proj = None
+    if color_map == '': color_map = None
+    if hillshade == '': hillshade = None
+    if resample == '': resample = 0
+    if minzoom == '': minzoom = None
+    if maxzoom == '': maxzoom = None
+    if bbox == '': bbox = None
+    if compress == '': compress = None
+
+    if epsg is not None:
+        proj = None
+
+    expr = None
+
+    if asset_type in ['orthophoto', 'dsm', 'dtm'] and not export_format in ['gtiff', 'gtiff-rgb', 'cog', 'jpg', 'png', 'kmz', 'mbtiles']:
+        raise exceptions.ValidationError(_("Unsupported format: %(value)s") % {'value': export_format})
+    if asset_type == 'georeferenced_model' and not export_format in ['laz', 'las', 'ply', 'csv']:
+        raise exceptions.ValidationError(_("Unsupported format: %(value)s") % {'value': export_format})
+    
+    # Default color map, hillshade
+    if asset_type in ['dsm', 'dtm'] and not export_format in ['gtiff', 'cog']:
+        if color_map is None:
+            color_map = 'viridis'
+        if hillshade is None:
+            hillshade = 6
+    
+    if color_map is not None:
         try:
-            tilesize = int(tilesize)
-            if tilesize != 256 and tilesize != 512:
-                raise ValueError("Invalid size")
+            get_lut(color_map)
+        except InvalidColorMapName:
+            raise exceptions.ValidationError(_("Not a valid color_map value"))
 
-            if tilesize == 512:
-                z -= 1
+    if resample is not None:
+        try:
+            resample = float(resample)
         except ValueError:
-            raise exceptions.ValidationError(_("Invalid tile size parameter"))
+            raise exceptions.ValidationError(_("Invalid resample value: %(value)s") % {'value': resample})
 
+    if epsg is not None:
         try:
-            expr, _discard_ = lookup_formula(formula, bands)
-        except ValueError as e:
-            raise exceptions.ValidationError(str(e))
+            epsg = int(epsg)
+        except ValueError:
+            raise exceptions.ValidationError(_("Invalid EPSG code: %(value)s") % {'value': epsg})
+    
+    if proj is not None:
+        try:
+            srs = osr.SpatialReference()
+            if srs.ImportFromProj4(proj) != 0:
+                raise exceptions.ValidationError(_("Invalid PROJ string: %(value)s") % {'value': proj})
+        except Exception as e:
+            raise exceptions.ValidationError(_("Invalid PROJ string: %(value)s") % {'value': proj})
 
-        if tile_type in ['dsm', 'dtm'] and rescale is None:
-            rescale = "0,1000"
-        if tile_type == 'orthophoto' and rescale is None:
-            rescale = "0,255"
+    if (formula and not bands) or (not formula and bands):
+        raise exceptions.ValidationError(_("Both formula and bands parameters are required"))
 
-        if tile_type in ['dsm', 'dtm'] and color_map is None:
-            color_map = "gray"
+    if formula and bands:
+        if bands == 'auto':
+            bands, _discard_ = get_auto_bands(task.orthophoto_bands, formula)
 
-        if tile_type == 'orthophoto' and formula is not None:
-            if color_map is None:
-                color_map = "gray"
-            if rescale is None:
-                rescale = "-1,1"
-
-        if nodata is not None:
-            nodata = np.nan if nodata == "nan" else float(nodata)
-        tilesize = scale * tilesize
-        url = get_raster_path(task, tile_type)
-        if not os.path.isfile(url):
-            raise exceptions.NotFound()
+        try:
+            expr, _discard_ = lookup_formula(formula, bands)
+        except ValueError as e:
+            raise exceptions.ValidationError(str(e))
+    
+    if export_format in ['gtiff-rgb', 'jpg', 'png']:
+        if formula is not None and rescale is None:
+            rescale = "-1,1"
+    
+    if export_format in ['gtiff', 'cog']:
+        rescale = None
+
+    if export_format == 'cog' and compress is not None:
+        compress = str(compress).upper()
+        if not compress in cog_compression_options(asset_type, expr):
+            raise exceptions.ValidationError(_("Unsupported compression: %(value)s") % {'value': compress})
+    else:
+        compress = None
+    
+    if rescale is not None:
+        rescale = rescale.replace("%2C", ",")
+        try:
+            rescale = list(map(float, rescale.split(",")))
+        except ValueError:
+            raise exceptions.ValidationError(_("Invalid rescale value: %(value)s") % {'value': rescale})
+    elif export_format in ['gtiff-rgb', 'jpg', 'png', 'kmz'] and asset_type in raster_stats.RASTER_ASSETS and task.crop is None:
+        # Use precomputed statistics if available
+        # (the export computes them otherwise)
+        if stats is not None and asset_type in stats:
+            md = stats[asset_type]
+        else:
+            md = raster_stats.get(task, asset_type)
+            if stats is not None:
+                stats[asset_type] = md
+        if md is not None:
+            rescale = [md['statistics']['1']['min'], md['statistics']['1']['max']]
+    
+    if hillshade is not None:
+        try:
+            hillshade = float(hillshade)
+            if hillshade < 0:
+                raise Exception("Hillshade must be > 0")
+        except:
+            raise exceptions.ValidationError(_("Invalid hillshade value: %(value)s") % {'value': hillshade})
+    
+    if asset_type == 'georeferenced_model':
+        url = get_pointcloud_path(task)
+    else:
+        url = get_raster_path(task, asset_type)
 
-        to_meter = 1.0
-        with COGReader(url) as src:
-            if not src.tile_exists(z, x, y):
-                raise exceptions.NotFound(_("Outside of bounds"))
+    if not os.path.isfile(url):
+        raise exceptions.NotFound()
 
-            minzoom, maxzoom = get_zoom_safe(src)
-            has_alpha = has_alpha_band(src.dataset)
-            if z < minzoom - ZOOM_EXTRA_LEVELS or z > maxzoom + ZOOM_EXTRA_LEVELS:
-                raise exceptions.NotFound()
+    if epsg is not None and (task.epsg is None and task.wkt is None):
+        raise exceptions.ValidationError(_("Cannot use epsg on non-georeferenced dataset"))
 
-            if boundaries_feature is not None:
-                try:
-                    cutline = create_cutline(src.dataset, boundaries_feature, CRS.from_string('EPSG:4326'))
-                except:
-                    raise exceptions.ValidationError(_("Invalid boundaries"))
-            elif crop and task.crop is not None:
-                cutline, bounds = geom_transform_wkt_bbox(task.crop, src.dataset)
-            else:
-                cutline = None
-            
-            if cutline is not None:
-                vrt_options = {'cutline': cutline}
-            else:
-                vrt_options = None
+    if export_format == 'mbtiles':
+        if not tile_format in ['png', 'jpg', 'webp']:
+            raise exceptions.ValidationError(_("Unsupported tile format: %(value)s") % {'value': tile_format})
+        if rescale is not None and len(rescale) != 2:
+            raise exceptions.ValidationError(_("Invalid rescale value: %(value)s") % {'value': rescale})
 
-            if tile_type in ['dsm', 'dtm']:
-                to_meter = get_rasterio_to_meters_factor(src.dataset)
-
-            # Handle N-bands datasets for orthophotos (not plant health)
-            if tile_type == 'orthophoto' and expr is None:
-                ci = src.dataset.colorinterp
-                # More than 4 bands?
-                if len(ci) > 4:
-                    # Try to find RGBA band order
-                    if ColorInterp.red in ci and \
-                            ColorInterp.green in ci and \
-                            ColorInterp.blue in ci:
-                        indexes = (ci.index(ColorInterp.red) + 1,
-                                   ci.index(ColorInterp.green) + 1,
-                                   ci.index(ColorInterp.blue) + 1,)
-                    else:
-                        # Fallback to first three
-                        indexes = (1, 2, 3,)
-                elif has_alpha:
-                    indexes = non_alpha_indexes(src.dataset)
-
-            # Workaround for https://github.com/WebODM/WebODM/issues/894
-            if nodata is None and tile_type == 'orthophoto':
-                nodata = 0
-
-            resampling = "nearest"
-            padding = 0
-            tile_buffer = None
-
-            if tile_type in ["dsm", "dtm"]:
-                resampling = "bilinear"
-                padding = 16
-
-                # WarpedVRT is really slow with compound CRSes
-                # so we override the CRS to the 2D version for speed
-                # in case there's one
-                if vrt_options is None:
-                    vrt_options = {}
-
-                if task.epsg is not None:
-                    vrt_options['src_crs'] = f"EPSG:{task.epsg}"
-
-            # Hillshading is not a local tile operation and
-            # requires neighbor tiles to be rendered seamlessly
-            if hillshade is not None:
-                tile_buffer = 16
+        try:
+            if minzoom is not None: minzoom = int(minzoom)
+            if maxzoom is not None: maxzoom = int(maxzoom)
+        except ValueError:
+            raise exceptions.ValidationError(_("Invalid zoom level"))
 
+        if bbox is not None:
             try:
-                if expr is not None:
-                    tile = src.tile(x, y, z, expression=expr, tilesize=tilesize, nodata=nodata,
-                                    padding=padding,
-                                    tile_buffer=tile_buffer,
-                                    resampling_method=resampling, vrt_options=vrt_options)
-                else:
-                    tile = src.tile(x, y, z, indexes=indexes, tilesize=tilesize, nodata=nodata,
-                                    padding=padding,
-                                    tile_buffer=tile_buffer,
-                                    resampling_method=resampling, vrt_options=vrt_options)
-            except TileOutsideBounds:
-                raise exceptions.NotFound(_("Outside of bounds"))
-            
-            if color_map:
-                try:
-                    colormap.get(color_map)
-                except InvalidColorMapName:
-                    raise exceptions.ValidationError(_("Not a valid color_map value"))
-            
-            intensity = None
-            try:
-                rescale_arr = list(map(float, rescale.split(",")))
-                if tile_type in ['dsm', 'dtm']:
-                    rescale_arr = [v / to_meter for v in rescale_arr]
+                bbox = list(map(float, str(bbox).replace("%2C", ",").split(",")))
+                if len(bbox) != 4:
+                    raise ValueError("Invalid bbox")
             except ValueError:
-                raise exceptions.ValidationError(_("Invalid rescale value"))
+                raise exceptions.ValidationError(_("Invalid bbox value: %(value)s") % {'value': bbox})
 
-            # Auto?
-            if ext is None:
-                # Check for transparency
-                if np.equal(tile.mask, 255).all():
-                    ext = "jpg"
-                else:
-                    if 'image/webp' in request.headers.get('Accept', ''):
-                        ext = "webp"
-                    else:
-                        ext = "png"
+        # Tiles are always in web mercator
+        with raster_pool.open_cog(url) as src:
+            try:
+                ranges, _discard_ = get_export_ranges(src, minzoom, maxzoom, bbox, max_tiles=settings.TILE_EXPORT_MAX_TILES)
+            except ValueError as e:
+                raise exceptions.ValidationError(str(e))
 
-            driver = "jpeg" if ext == "jpg" else ext
+        # Without a maxzoom, the export stops at the highest
+        # zoom level that fits (the UI has no zoom inputs)
+        maxzoom = ranges[-1][0]
 
-            options = img_profiles.get(driver, {})
-            if hillshade is not None:
-                try:
-                    hillshade = float(hillshade)
-                    if hillshade <= 0:
-                        hillshade = 1.0
-                except ValueError:
-                    raise exceptions.ValidationError(_("Invalid hillshade value"))
-                if tile.data.shape[0] != 1:
-                    raise exceptions.ValidationError(
-                        _("Cannot compute hillshade of non-elevation raster (multiple bands found)"))
-                delta_scale = (maxzoom + ZOOM_EXTRA_LEVELS + 1 - z) ** 2
-                dx = src.dataset.meta["transform"][0] * delta_scale
-                dy = src.dataset.meta["transform"][4] * delta_scale
-                ls = LightSource(azdeg=315, altdeg=45)
-                
-                # Remove elevation data from edge buffer tiles
-                # (to keep intensity uniform across tiles)
-                elevation = tile.data[0]
-                elevation[0:tile_buffer, 0:tile_buffer] = nodata
-                elevation[tile_buffer+tilesize:tile_buffer*2+tilesize, 0:tile_buffer] = nodata
-                elevation[0:tile_buffer, tile_buffer+tilesize:tile_buffer*2+tilesize] = nodata
-                elevation[tile_buffer+tilesize:tile_buffer*2+tilesize, tile_buffer+tilesize:tile_buffer*2+tilesize] = nodata
-
-                intensity = ls.hillshade(elevation, dx=dx, dy=dy, vert_exag=hillshade)
-                intensity = intensity[tile_buffer:tile_buffer+tilesize, tile_buffer:tile_buffer+tilesize]
-
-            if intensity is not None:
-                rgb = tile.post_process(in_range=(rescale_arr,))
-                rgb_data = rgb.data[:,tile_buffer:tilesize+tile_buffer, tile_buffer:tilesize+tile_buffer]
-                if colormap:
-                    rgb, _discard_ = apply_cmap(rgb_data, colormap.get(color_map))
-                if rgb.data.shape[0] != 3:
-                    raise exceptions.ValidationError(
-                        _("Cannot process tile: intensity image provided, but no RGB data was computed."))
-                intensity = intensity * 255.0
-                rgb = hsv_blend(rgb, intensity)
-                if rgb is not None:
-                    mask = tile.mask[tile_buffer:tilesize+tile_buffer, tile_buffer:tilesize+tile_buffer]
-                    return HttpResponse(
-                        render(rgb, mask, img_format=driver, **options),
-                        content_type="image/{}".format(ext)
-                    )
-
-            if color_map is not None:
-                return HttpResponse(
-                    tile.post_process(in_range=(rescale_arr,)).render(img_format=driver, colormap=colormap.get(color_map),
-                                                                    **options),
-                    content_type="image/{}".format(ext)
+        if count_tiles(ranges) > settings.TILE_EXPORT_MAX_TILES:
+            raise exceptions.ValidationError(_("Too many tiles (max: %(value)s)") % {'value': settings.TILE_EXPORT_MAX_TILES})
+    
+    # Strip unsafe chars, append suffix
+    extension = extension_for_export_format(export_format)
+    filename = "{}{}.{}".format(
+                    get_asset_download_filename(task, asset_type),
+                    "-{}".format(formula) if expr is not None else "",
+                    extension
                 )
 
-            return HttpResponse(
-                tile.post_process(in_range=(rescale_arr,)).render(img_format=driver, **options),
-                content_type="image/{}".format(ext)
-            )
+    plan = {
+        'asset_type': asset_type,
+        'asset_path': url,
+        'filename': filename,
+        'url': None,
+        'job': None,
+        'args': None,
+        'opts': None
+    }
+
+    if asset_type in ['orthophoto', 'dsm', 'dtm']:
+        # Shortcut the process if no processing is required
+        if export_format == 'gtiff' and ((task.epsg is not None and epsg == task.epsg) or epsg is None) and (proj is None) and expr is None and task.crop is None:
+            plan['url'] = '/api/projects/{}/tasks/{}/download/{}.tif'.format(task.project.id, task.id, asset_type)
+        elif export_format == 'mbtiles':
+            plan.update(job=export_tiles, args=[str(task.id), asset_type], opts={
+                                                'query_params': {
+                                                    'formula': formula,
+                                                    'bands': bands,
+                                                    'rescale': "{},{}".format(*rescale) if rescale is not None else None,
+                                                    'color_map': color_map,
+                                                    'hillshade': str(hillshade) if hillshade else None,
+                                                    'crop': '1' if task.crop is not None else None
+                                                },
+                                                'minzoom': minzoom,
+                                                'maxzoom': maxzoom,
+                                                'bounds': bbox,
+                                                'ext': tile_format
+                                            })
+        else:
+            plan.update(job=export_raster, args=[url], opts={
+                                                    'epsg': epsg,
+                                                    'proj': proj,
+                                                    'expression': expr,
+                                                    'format': export_format,
+                                                    'rescale': rescale,
+                                                    'color_map': color_map,
+                                                    'hillshade': hillshade,
+                                                    'asset_type': asset_type,
+                                                    'name': task.name,
+                                                    'crop': task.crop.wkt if task.crop is not None else None,
+                                                    'compress': compress
+                                                })
+    elif asset_type == 'georeferenced_model':
+        # Shortcut the process if no processing is required
+        if export_format == 'laz' and ((task.epsg is not None and epsg == task.epsg) or epsg is None) and (proj is None) and (resample is None or resample == 0) and task.crop is None:
+            plan['url'] = '/api/projects/{}/tasks/{}/download/{}.laz'.format(task.project.id, task.id, asset_type)
+        else:
+            plan.update(job=export_pointcloud, args=[url], opts={
+                                                        'epsg': epsg,
+                                                        'proj': proj,
+                                                        'format': export_format,
+                                                        'resample': resample,
+                                                        'crop': task.crop.wkt if task.crop is not None else None,
+                                                        'crop_reference': task.get_reference_raster() if task.crop is not None else None
+                                                    })
+
+    return plan
 
 
 class Export(TaskNestedView):
@@ -585,147 +1198,64 @@ class Export(TaskNestedView):
         formulas, shading, reprojections
         """
         task = self.get_and_check_task(request, pk)
+        plan = plan_export(task, asset_type, request.data)
 
-        formula = request.data.get('formula')
-        bands = request.data.get('bands')
-        rescale = request.data.get('rescale')
-        export_format = request.data.get('format', 'laz' if asset_type == 'georeferenced_model' else 'gtiff')
-        epsg = request.data.get('epsg')
-        proj = request.data.get('proj')
-        color_map = request.data.get('color_map')
-        hillshade = request.data.get('hillshade')
-        resample = request.data.get('resample', 0)
-
-        if formula == '': formula = None
-        if bands == '': bands = None
-        if rescale == '': rescale = None
-        if epsg == '': epsg = None
-        if proj == '': proj = None
-        if color_map == '': color_map = None
-        if hillshade == '': hillshade = None
-        if resample == '': resample = 0
-
-        if epsg is not None:
-            proj = None
-
-        expr = None
-
-        if asset_type in ['orthophoto', 'dsm', 'dtm'] and not export_format in ['gtiff', 'gtiff-rgb', 'jpg', 'png', 'kmz']:
-            raise exceptions.ValidationError(_("Unsupported format: %(value)s") % {'value': export_format})
-        if asset_type == 'georeferenced_model' and not export_format in ['laz', 'las', 'ply', 'csv']:
-            raise exceptions.ValidationError(_("Unsupported format: %(value)s") % {'value': export_format})
-        
-        # Default color map, hillshade
-        if asset_type in ['dsm', 'dtm'] and export_format != 'gtiff':
-            if color_map is None:
-                color_map = 'viridis'
-            if hillshade is None:
-                hillshade = 6
-        
-        if color_map is not None:
-            try:
-                colormap.get(color_map)
-            except InvalidColorMapName:
-                raise exceptions.ValidationError(_("Not a valid color_map value"))
-
-        if resample is not None:
-            try:
-                resample = float(resample)
-            except ValueError:
-                raise exceptions.ValidationError(_("Invalid resample value: %(value)s") % {'value': resample})
+        if plan['job'] is None:
+            return Response({'url': plan['url'], 'filename': plan['filename']})
 
-        if epsg is not None:
-            try:
-                epsg = int(epsg)
-            except ValueError:
-                raise exceptions.ValidationError(_("Invalid EPSG code: %(value)s") % {'value': epsg})
-        
-        if proj is not None:
-            try:
-                srs = osr.SpatialReference()
-                if srs.ImportFromProj4(proj) != 0:
-                    raise exceptions.ValidationError(_("Invalid PROJ string: %(value)s") % {'value': proj})
-            except Exception as e:
-                raise exceptions.ValidationError(_("Invalid PROJ string: %(value)s") % {'value': proj})
+        celery_task_id = start_export(task, plan['asset_path'], plan['job'], plan['args'], plan['opts'])
+        return Response({'celery_task_id': celery_task_id, 'filename': plan['filename']})
 
-        if (formula and not bands) or (not formula and bands):
-            raise exceptions.ValidationError(_("Both formula and bands parameters are required"))
 
-        if formula and bands:
-            if bands == 'auto':
-                bands, _discard_ = get_auto_bands(task.orthophoto_bands, formula)
-
-            try:
-                expr, _discard_ = lookup_formula(formula, bands)
-            except ValueError as e:
-                raise exceptions.ValidationError(str(e))
-        
-        if export_format in ['gtiff-rgb', 'jpg', 'png']:
-            if formula is not None and rescale is None:
-                rescale = "-1,1"
-        
-        if export_format == 'gtiff':
-            rescale = None
-        
-        if rescale is not None:
-            rescale = rescale.replace("%2C", ",")
-            try:
-                rescale = list(map(float, rescale.split(",")))
-            except ValueError:
-                raise exceptions.ValidationError(_("Invalid rescale value: %(value)s") % {'value': rescale})
-        
-        if hillshade is not None:
-            try:
-                hillshade = float(hillshade)
-                if hillshade < 0:
-                    raise Exception("Hillshade must be > 0")
-            except:
-                raise exceptions.ValidationError(_("Invalid hillshade value: %(value)s") % {'value': hillshade})
-        
-        if asset_type == 'georeferenced_model':
-            url = get_pointcloud_path(task)
-        else:
-            url = get_raster_path(task, asset_type)
-
-        if not os.path.isfile(url):
-            raise exceptions.NotFound()
+class ExportBatch(TaskNestedView):
+    def post(self, request, pk=None, project_pk=None):
+        """
+        Export multiple assets in a single job. Items are exported concurrently
+        and share opened datasets and statistics.
+        The body is a list of export parameters (see Export), each with an "asset" key,
+        or an object with an "items" list. The result of the job can be downloaded
+        as a single zip archive or one item at a time (?item=<index>).
+        """
+        task = self.get_and_check_task(request, pk)
 
-        if epsg is not None and (task.epsg is None and task.wkt is None):
-            raise exceptions.ValidationError(_("Cannot use epsg on non-georeferenced dataset"))
-        
-        # Strip unsafe chars, append suffix
-        extension = extension_for_export_format(export_format)
-        filename = "{}{}.{}".format(
-                        get_asset_download_filename(task, asset_type),
-                        "-{}".format(formula) if expr is not None else "",
-                        extension
-                    )
-
-        if asset_type in ['orthophoto', 'dsm', 'dtm']:
-            # Shortcut the process if no processing is required
-            if export_format == 'gtiff' and ((task.epsg is not None and epsg == task.epsg) or epsg is None) and (proj is None) and expr is None and task.crop is None:
-                return Response({'url': '/api/projects/{}/tasks/{}/download/{}.tif'.format(task.project.id, task.id, asset_type), 'filename': filename})
+        items = request.data.get('items') if isinstance(request.data, dict) else request.data
+        if not isinstance(items, list) or len(items) == 0:
+            raise exceptions.ValidationError(_("No items to export"))
+        if len(items) > settings.EXPORT_BATCH_MAX_ITEMS:
+            raise exceptions.ValidationError(_("Too many items (max: %(value)s)") % {'value': settings.EXPORT_BATCH_MAX_ITEMS})
+
+        stats = {}
+        filenames = set()
+        batch = []
+        for item in items:
+            if not isinstance(item, dict) or not item.get('asset') in EXPORT_ASSETS:
+                raise exceptions.ValidationError(_("Invalid asset: %(value)s") % {'value': item.get('asset') if isinstance(item, dict) else item})
+
+            plan = plan_export(task, item['asset'], item, stats)
+
+            # Items of the same asset must not overwrite each other in the archive
+            filename = plan['filename']
+            base, ext = os.path.splitext(filename)
+            i = 1
+            while filename in filenames:
+                i += 1
+                filename = "{}-{}{}".format(base, i, ext)
+            filenames.add(filename)
+
+            if plan['job'] is None:
+                batch.append({'filename': filename, 'file': plan['asset_path']})
             else:
-                celery_task_id = export_raster.delay(url, epsg=epsg,
-                                                        proj=proj, 
-                                                        expression=expr, 
-                                                        format=export_format, 
-                                                        rescale=rescale, 
-                                                        color_map=color_map,
-                                                        hillshade=hillshade,
-                                                        asset_type=asset_type,
-                                                        name=task.name,
-                                                        crop=task.crop.wkt if task.crop is not None else None).task_id
-                return Response({'celery_task_id': celery_task_id, 'filename': filename})
-        elif asset_type == 'georeferenced_model':
-            # Shortcut the process if no processing is required
-            if export_format == 'laz' and ((task.epsg is not None and epsg == task.epsg) or epsg is None) and (proj is None) and (resample is None or resample == 0) and task.crop is None:
-                return Response({'url': '/api/projects/{}/tasks/{}/download/{}.laz'.format(task.project.id, task.id, asset_type), 'filename': filename})
-            else:
-                celery_task_id = export_pointcloud.delay(url, epsg=epsg,
-                                                            proj=proj, 
-                                                            format=export_format,
-                                                            resample=resample,
-                                                            crop=task.crop.wkt if task.crop is not None else None,
-                                                            crop_reference=task.get_reference_raster() if task.crop is not None else None).task_id
-                return Response({'celery_task_id': celery_task_id, 'filename': filename})
+                batch.append({
+                    'filename': filename,
+                    'job': plan['job'].name,
+                    'args': plan['args'],
+                    'opts': plan['opts'],
+                    'cache_key': get_export_cache_key(task, plan['asset_path'], plan['job'], plan['args'], plan['opts'])
+                })
+
+        celery_task_id = export_batch.delay(batch).task_id
+        return Response({
+            'celery_task_id': celery_task_id,
+            'filename': get_asset_download_filename(task, "export.zip"),
+            'items': [b['filename'] for b in batch]
+        })
@@ -9,6 +9,12 @@ from rest_framework import status, permissions
 from django.http import FileResponse
 from django.http import HttpResponse
 from wsgiref.util import FileWrapper
+from zipstream.ng import ZipStream
+
+from app import exportcache
+from .tasks import download_file_stream
+
+mimetypes.add_type("application/vnd.sqlite3", ".mbtiles")
 
 class CheckTask(APIView):
     permission_classes = (permissions.AllowAny,)
@@ -39,6 +45,9 @@ class CheckTask(APIView):
             if isinstance(result.get('file'), str) and not os.path.isfile(result.get('file')):
                 return Response({'ready': True, 'error': "Cannot generate file"})
 
+            if isinstance(result.get('files'), list) and not all(os.path.isfile(f['file']) for f in result['files']):
+                return Response({'ready': True, 'error': "Cannot generate file"})
+
             return Response({'ready': True})
 
     def on_error(self, result):
@@ -58,15 +67,44 @@ class GetTaskResult(APIView):
         if res.ready():
             result = res.get()
             file = result.get('file', None) # File path
+            files = result.get('files', None) # List of {'filename', 'file'} (batch exports)
             output = result.get('output', None) # String/object
         else:
             return Response({'error': 'Task not ready'})
 
+        default_filename = os.path.basename(file) if file is not None else None
+
+        if files is not None:
+            item = request.query_params.get('item')
+            if item is None:
+                # Cached exports might have been evicted in the meantime
+                if not all(exportcache.touch(f['file']) for f in files):
+                    return Response({'error': 'File not found, please export it again'}, status=status.HTTP_404_NOT_FOUND)
+
+                # All files in a single (streamed) zip
+                zs = ZipStream(sized=True)
+                for f in files:
+                    zs.add_path(f['file'], f['filename'])
+                return download_file_stream(request, zs, 'attachment', request.query_params.get('filename', 'export.zip'))
+
+            try:
+                item = files[int(item)]
+            except (ValueError, IndexError):
+                return Response({'error': 'Invalid item'})
+
+            file = item['file']
+            default_filename = item['filename']
+
         if file is not None:
-            filename = request.query_params.get('filename', os.path.basename(file))
-            filesize = os.stat(file).st_size
+            filename = request.query_params.get('filename', default_filename)
 
-            f = open(file, "rb")
+            # Cached exports might have been evicted in the meantime
+            try:
+                exportcache.touch(file)
+                filesize = os.stat(file).st_size
+                f = open(file, "rb")
+            except FileNotFoundError:
+                return Response({'error': 'File not found, please export it again'}, status=status.HTTP_404_NOT_FOUND)
 
             # More than 100mb, normal http response, otherwise stream
             # Django docs say to avoid streaming when possible
@@ -0,0 +1,543 @@
+import os
+import time
+import uuid
+import shutil
+import tempfile
+import platform
+import logging
+import tracemalloc
+import numpy as np
+import rasterio
+import rio_tiler
+from rio_tiler.models import ImageData
+from rio_tiler.errors import TileOutsideBounds
+from rio_tiler.colormap import apply_cmap
+from rasterio.enums import ColorInterp
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import GEOSGeometry
+from rest_framework.test import APIRequestFactory, force_authenticate
+from app import raster_pool, raster_stats
+from app.api.tiler import Tiles, Metadata, get_zoom_safe, get_raster_path
+from app.api.tasks import TaskThumbnail
+from app.api.hillshade import LightSource
+from app.api.hsvblend import hsv_blend
+from app.api.shaded_relief import shaded_relief
+from app.api.colormaps import colormap, apply_colormap
+from app.cogeo import assure_cogeo, translate_cogeo, is_profile_compatible, COG_PROFILES
+from app.raster_utils import export_raster
+from app.geoutils import get_raster_bounds_wkt
+from app.models import Project, Task
+from nodeodm import status_codes
+from webodm import settings
+
+logger = logging.getLogger('app.logger')
+
+FIXTURE_TYPES = ['rgb', 'multispectral', 'dsm']
+KERNELS = ['hillshade', 'colormap', 'export', 'cogeo']
+
+# Synthetic rasters are placed in UTM 15N with a typical drone GSD
+FIXTURE_EPSG = 32615
+FIXTURE_ORIGIN = (500000, 4500000)
+FIXTURE_RESOLUTION = {
+    'rgb': 0.05,
+    'multispectral': 0.1,
+    'dsm': 0.2
+}
+MULTISPECTRAL_BANDS = ['blue', 'green', 'red', 'nir', 'rededge']
+DSM_NODATA = -9999
+BLOCK_ROWS = 512
+
+
+def make_synthetic_raster(path, fixture_type, size, seed=0, cogeo=True):
+    """
+    Write a synthetic raster similar to the ones produced by ODM
+    and turn it into a Cloud Optimized GeoTIFF
+    :param fixture_type: one of rgb (4 bands uint8 with alpha),
+        multispectral (5 bands uint16 with alpha) or dsm (float32)
+    :param size: width and height in pixels
+    :param cogeo: whether to turn the raster into a Cloud Optimized GeoTIFF
+    """
+    rng = np.random.default_rng(seed)
+    resolution = FIXTURE_RESOLUTION[fixture_type]
+
+    profile = {
+        'driver': 'GTiff',
+        'width': size,
+        'height': size,
+        'crs': 'EPSG:{}'.format(FIXTURE_EPSG),
+        'transform': from_origin(FIXTURE_ORIGIN[0], FIXTURE_ORIGIN[1], resolution, resolution),
+        'tiled': True,
+        'blockxsize': 256,
+        'blockysize': 256,
+        'compress': 'deflate'
+    }
+
+    if fixture_type == 'rgb':
+        profile.update(count=4, dtype='uint8')
+        colorinterp = [ColorInterp.red, ColorInterp.green, ColorInterp.blue, ColorInterp.alpha]
+    elif fixture_type == 'multispectral':
+        profile.update(count=len(MULTISPECTRAL_BANDS) + 1, dtype='uint16')
+        colorinterp = [ColorInterp.gray] + [ColorInterp.undefined] * (len(MULTISPECTRAL_BANDS) - 1) + [ColorInterp.alpha]
+    elif fixture_type == 'dsm':
+        profile.update(count=1, dtype='float32', nodata=DSM_NODATA)
+        colorinterp = [ColorInterp.gray]
+    else:
+        raise ValueError("Invalid fixture type: {}".format(fixture_type))
+
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.colorinterp = colorinterp
+        if fixture_type == 'multispectral':
+            for i, band in enumerate(MULTISPECTRAL_BANDS):
+                dst.set_band_description(i + 1, band)
+
+        # Write in blocks of rows to keep memory usage low
+        x = np.arange(size, dtype=np.float32)[np.newaxis, :]
+        for row in range(0, size, BLOCK_ROWS):
+            rows = min(BLOCK_ROWS, size - row)
+            y = np.arange(row, row + rows, dtype=np.float32)[:, np.newaxis]
+
+            # Elliptical footprint, like a flight area
+            footprint = ((x - size / 2) / (size * 0.48)) ** 2 + ((y - size / 2) / (size * 0.42)) ** 2 <= 1
+            pattern = np.sin(x / 37.0) * np.cos(y / 53.0) + np.sin((x + y) / 211.0)
+            noise = rng.standard_normal((rows, size)).astype(np.float32)
+            window = Window(0, row, size, rows)
+
+            if fixture_type == 'dsm':
+                elevation = 250 + 20 * pattern + 0.01 * (x + y) + 0.2 * noise
+                dst.write(np.where(footprint, elevation, DSM_NODATA).astype(np.float32), 1, window=window)
+            else:
+                count = profile['count'] - 1
+                max_value = 255 if fixture_type == 'rgb' else 65535
+                for b in range(count):
+                    value = 0.5 + 0.3 * np.sin(pattern + b) + 0.05 * noise
+                    band = np.clip(value * max_value, 1, max_value).astype(profile['dtype'])
+                    dst.write(band, b + 1, window=window)
+                dst.write((footprint * max_value).astype(profile['dtype']), count + 1, window=window)
+
+    if cogeo:
+        assure_cogeo(path, 'dsm' if fixture_type == 'dsm' else 'orthophoto')
+
+
+def create_task(user, fixture_type, size):
+    """
+    Create a completed task with a synthetic raster asset
+    :return: Task
+    """
+    project = Project.objects.create(owner=user, name="Benchmark ({})".format(fixture_type))
+    task = Task.objects.create(project=project, name="Benchmark ({}, {}px)".format(fixture_type, size),
+                               status=status_codes.COMPLETED)
+
+    asset = 'dsm.tif' if fixture_type == 'dsm' else 'orthophoto.tif'
+    raster_path = task.assets_path(task.ASSETS_MAP[asset])
+    os.makedirs(os.path.dirname(raster_path), exist_ok=True)
+    make_synthetic_raster(raster_path, fixture_type, size)
+
+    extent_field = 'dsm_extent' if fixture_type == 'dsm' else 'orthophoto_extent'
+    setattr(task, extent_field, GEOSGeometry(get_raster_bounds_wkt(raster_path), srid=4326))
+    task.update_available_assets_field()
+    task.update_georef_fields()
+    task.update_orthophoto_bands_field()
+    task.save()
+
+    return task
+
+
+def delete_task(task):
+    project = task.project
+    task.delete()
+    project.delete()
+
+
+def get_tiles(task, tile_type, zoom_levels):
+    """
+    :return: dictionary of zoom level --> list of (x, y) tiles, for
+        the highest zoom_levels zoom levels of the raster
+    """
+    result = {}
+    with raster_pool.open_cog(get_raster_path(task, tile_type)) as src:
+        minzoom, maxzoom = get_zoom_safe(src)
+        for z in range(max(minzoom, maxzoom - zoom_levels + 1), maxzoom + 1):
+            result[z] = [(t.x, t.y) for t in src.tms.tiles(*src.bounds, [z])]
+    return result
+
+
+def get_cases(task, fixture_type, zoom_levels):
+    """
+    :return: list of benchmark cases, each a dictionary with a name, a view,
+        view arguments, query parameters and an optional setup function
+        called before each request
+    """
+    tile_type = 'dsm' if fixture_type == 'dsm' else 'orthophoto'
+    view_kwargs = {'pk': str(task.id), 'project_pk': task.project.id}
+
+    if fixture_type == 'rgb':
+        styles = [('default', {}),
+                  ('vari', {'formula': 'VARI', 'bands': 'auto', 'color_map': 'rdylgn'})]
+    elif fixture_type == 'multispectral':
+        styles = [('default', {}),
+                  ('ndvi', {'formula': 'NDVI', 'bands': 'auto', 'color_map': 'rdylgn'})]
+    else:
+        styles = [('default', {}),
+                  ('hillshade', {'color_map': 'viridis', 'hillshade': '6', 'rescale': '200,300'})]
+
+    def clear_stats():
+        stats_path = raster_stats.get_stats_path(task)
+        if os.path.isfile(stats_path):
+            os.remove(stats_path)
+
+    cases = []
+    tiles = get_tiles(task, tile_type, zoom_levels)
+    for style, query_params in styles:
+        for tilesize in [256, 512]:
+            for z, zoom_tiles in tiles.items():
+                # 512px tiles are requested one zoom level higher
+                tile_z = z + 1 if tilesize == 512 else z
+                cases.append({
+                    'name': 'tiles/{}/{}/z{}'.format(tilesize, style, tile_z),
+                    'view': Tiles.as_view(),
+                    'requests': [dict(view_kwargs, tile_type=tile_type, z=str(tile_z), x=str(x), y=str(y)) for x, y in zoom_tiles],
+                    'query_params': dict(query_params, size=str(tilesize))
+                })
+
+        metadata_params = {k: v for k, v in query_params.items() if k in ['formula', 'bands']}
+        if style != 'default' and not metadata_params:
+            continue
+
+        cases.append({
+            'name': 'metadata/{}/computed'.format(style),
+            'view': Metadata.as_view(),
+            'requests': [dict(view_kwargs, tile_type=tile_type)],
+            'query_params': metadata_params,
+            'setup': clear_stats
+        })
+        cases.append({
+            'name': 'metadata/{}/cached'.format(style),
+            'view': Metadata.as_view(),
+            'requests': [dict(view_kwargs, tile_type=tile_type)],
+            'query_params': metadata_params
+        })
+
+    if tile_type == 'orthophoto':
+        for size in [256, 1024]:
+            cases.append({
+                'name': 'thumbnail/{}'.format(size),
+                'view': TaskThumbnail.as_view(),
+                'requests': [view_kwargs],
+                'query_params': {'size': str(size)}
+            })
+
+    return cases
+
+
+def run_case(user, case, iterations):
+    """
+    Call a case's view iterations times (cycling through its requests),
+    after a warmup request that is not measured
+    :return: (list of durations in seconds, number of failed requests)
+    """
+    factory = APIRequestFactory()
+    durations = []
+    errors = 0
+
+    for i in range(iterations + 1):
+        view_kwargs = case['requests'][i % len(case['requests'])]
+        request = factory.get('/', case['query_params'], HTTP_ACCEPT='image/png,*/*')
+        force_authenticate(request, user=user)
+
+        if case.get('setup') is not None:
+            case['setup']()
+
+        start = time.perf_counter()
+        response = case['view'](request, **view_kwargs)
+        if hasattr(response, 'render'):
+            response.render()
+        duration = time.perf_counter() - start
+
+        if i == 0:
+            continue
+        if response.status_code != 200:
+            errors += 1
+        durations.append(duration)
+
+    return durations, errors
+
+
+def summarize(durations, errors):
+    if len(durations) == 0:
+        return {'requests': 0, 'errors': errors}
+
+    ms = np.array(durations) * 1000
+    return {
+        'requests': len(durations),
+        'errors': errors,
+        'p50': float(np.percentile(ms, 50)),
+        'p95': float(np.percentile(ms, 95)),
+        'mean': float(ms.mean()),
+        'max': float(ms.max()),
+        'per_second': len(durations) / float(np.sum(durations))
+    }
+
+
+def run_hillshade_kernel(iterations=50, tilesizes=(256, 512), pad=16, progress=None):
+    """
+    Compare the shaded relief kernel with the LightSource.hillshade + hsv_blend
+    implementation, measuring latency and peak memory per tile
+    :return: list of summaries
+    """
+    rng = np.random.default_rng(0)
+    results = []
+
+    for tilesize in tilesizes:
+        size = tilesize + pad * 2
+        y, x = np.mgrid[0:size, 0:size].astype(np.float32)
+        elevation = (250 + 20 * np.sin(x / 37.0) * np.cos(y / 53.0) + rng.standard_normal((size, size))).astype(np.float32)
+        rgb = rng.integers(0, 256, (3, tilesize, tilesize), dtype=np.uint8)
+        dx, dy = 0.8, -0.8
+
+        def legacy():
+            intensity = LightSource(azdeg=315, altdeg=45).hillshade(elevation, dx=dx, dy=dy, vert_exag=6)
+            intensity = intensity[pad:pad+tilesize, pad:pad+tilesize] * 255.0
+            return hsv_blend(rgb, intensity)
+
+        def fused():
+            return shaded_relief(rgb, elevation, dx, dy, vert_exag=6, pad=pad)
+
+        for name, kernel in [('legacy', legacy), ('shaded_relief', fused)]:
+            results.append(run_kernel('hillshade/{}/{}'.format(tilesize, name), kernel, iterations, progress))
+
+    return results
+
+
+def run_colormap_kernel(iterations=50, tilesizes=(256, 512), color_map='viridis', progress=None):
+    """
+    Compare the colormap lookup table path with ImageData.post_process + apply_cmap
+    on float32 single band tiles, measuring latency and peak memory per tile
+    :return: list of summaries
+    """
+    rng = np.random.default_rng(0)
+    results = []
+    in_range = (200.0, 300.0)
+
+    for tilesize in tilesizes:
+        data = (250 + 60 * rng.standard_normal((1, tilesize, tilesize))).astype(np.float32)
+        mask = np.full((tilesize, tilesize), 255, dtype=np.uint8)
+
+        def legacy():
+            rgb = ImageData(data, mask).post_process(in_range=(in_range,))
+            return apply_cmap(rgb.data, colormap.get(color_map))
+
+        def lut():
+            return apply_colormap(data, in_range, color_map, mask)
+
+        for name, kernel in [('legacy', legacy), ('lut', lut)]:
+            results.append(run_kernel('colormap/{}/{}'.format(tilesize, name), kernel, iterations, progress))
+
+    return results
+
+
+def run_export_kernel(iterations=3, size=4096, threads=None, progress=None):
+    """
+    Compare the fixed and block aligned window planners of export_raster
+    on synthetic rasters, measuring latency and peak memory per export
+    :return: list of summaries
+    """
+    tmpdir = tempfile.mkdtemp()
+    results = []
+
+    try:
+        dsm = os.path.join(tmpdir, "dsm.tif")
+        make_synthetic_raster(dsm, 'dsm', size)
+        rgb = os.path.join(tmpdir, "rgb.tif")
+        make_synthetic_raster(rgb, 'rgb', size)
+
+        cases = [
+            ('dsm-hillshade', dsm, {'format': 'gtiff-rgb', 'color_map': 'viridis', 'hillshade': 6, 'rescale': [240, 280], 'asset_type': 'dsm'}),
+            ('dsm', dsm, {'format': 'gtiff', 'asset_type': 'dsm'}),
+            ('rgb', rgb, {'format': 'gtiff', 'asset_type': 'orthophoto'}),
+        ]
+        if threads is not None:
+            cases = [(name, input, dict(opts, threads=threads)) for name, input, opts in cases]
+
+        for name, input, opts in cases:
+            output = os.path.join(tmpdir, "export.tif")
+            for planner in ['fixed', 'blocks']:
+                def kernel():
+                    export_raster(input, output, window_planner=planner, **opts)
+                results.append(run_kernel('export/{}/{}'.format(name, planner), kernel, iterations, progress))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results
+
+
+def run_cogeo_kernel(iterations=50, size=4096, tilesize=256, progress=None):
+    """
+    Compare the COG profiles on synthetic rasters, measuring the file size,
+    the conversion time and the latency of tile reads (full resolution and overviews)
+    :return: list of summaries
+    """
+    tmpdir = tempfile.mkdtemp()
+    results = []
+
+    try:
+        for fixture_type in FIXTURE_TYPES:
+            input = os.path.join(tmpdir, "{}.tif".format(fixture_type))
+            make_synthetic_raster(input, fixture_type, size, cogeo=False)
+
+            for profile in COG_PROFILES:
+                if not is_profile_compatible(input, profile):
+                    continue
+
+                output = os.path.join(tmpdir, "{}-{}.tif".format(fixture_type, profile))
+                start = time.perf_counter()
+                if not translate_cogeo(input, output, profile):
+                    logger.warning("Cannot benchmark COG profile {} for {}".format(profile, fixture_type))
+                    continue
+                conversion_time = time.perf_counter() - start
+
+                with raster_pool.open_cog(output) as src:
+                    minzoom, maxzoom = get_zoom_safe(src)
+                    west, south, east, north = src.bounds
+                    tiles = []
+                    for z in sorted({max(minzoom, maxzoom - 2), maxzoom}):
+                        center = src.tms.tile((west + east) / 2, (south + north) / 2, z)
+                        tiles += [(center.x + dx, center.y + dy, z) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+                i = 0
+                def kernel():
+                    nonlocal i
+                    x, y, z = tiles[i % len(tiles)]
+                    i += 1
+                    with raster_pool.open_cog(output) as src:
+                        try:
+                            src.tile(x, y, z, tilesize=tilesize)
+                        except TileOutsideBounds:
+                            pass
+
+                summary = run_kernel('cogeo/{}/{}'.format(fixture_type, profile), kernel, iterations)
+                summary['file_size'] = os.path.getsize(output)
+                summary['conversion_time'] = conversion_time
+                if progress is not None:
+                    progress(summary['fixture'], summary['case'], summary)
+                results.append(summary)
+    finally:
+        raster_pool.invalidate(tmpdir)
+        shutil.rmtree(tmpdir)
+
+    return results
+
+
+def run_kernel(case, kernel, iterations, progress=None):
+    """
+    Time a function and measure its peak memory usage
+    :return: summary
+    """
+    kernel() # Warmup
+
+    durations = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        kernel()
+        durations.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        kernel()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    summary = summarize(durations, 0)
+    summary['fixture'] = 'kernel'
+    summary['case'] = case
+    summary['peak_memory'] = peak_memory
+    if progress is not None:
+        progress(summary['fixture'], summary['case'], summary)
+
+    return summary
+
+
+def run(fixture_types=FIXTURE_TYPES, size=4096, iterations=50, zoom_levels=4, tile_cache=False, kernels=[], progress=None):
+    """
+    Run the tiler benchmark on synthetic rasters
+    :param fixture_types: list of fixtures to benchmark (see FIXTURE_TYPES)
+    :param size: width and height of the synthetic rasters in pixels
+    :param iterations: number of measured requests per case
+    :param zoom_levels: number of zoom levels to benchmark tiles for
+    :param tile_cache: whether to keep the tile cache enabled
+    :param kernels: list of image processing kernels to benchmark (see KERNELS)
+    :param progress: function called with (fixture_type, case name, summary) after each case (optional)
+    :return: results dictionary (JSON serializable)
+    """
+    results = []
+
+    if len(fixture_types) > 0:
+        user = User.objects.create_user(username="benchmark-{}".format(uuid.uuid4().hex[:8]), password=uuid.uuid4().hex)
+        tile_cache_setting = settings.TILE_CACHE
+        settings.TILE_CACHE = settings.TILE_CACHE and tile_cache
+
+        try:
+            for fixture_type in fixture_types:
+                start = time.perf_counter()
+                task = create_task(user, fixture_type, size)
+                logger.info("Created {} benchmark fixture in {:.1f}s".format(fixture_type, time.perf_counter() - start))
+
+                try:
+                    for case in get_cases(task, fixture_type, zoom_levels):
+                        summary = summarize(*run_case(user, case, iterations))
+                        summary['fixture'] = fixture_type
+                        summary['case'] = case['name']
+                        results.append(summary)
+                        if progress is not None:
+                            progress(fixture_type, case['name'], summary)
+                finally:
+                    delete_task(task)
+        finally:
+            settings.TILE_CACHE = tile_cache_setting
+            user.delete()
+
+    if 'hillshade' in kernels:
+        results += run_hillshade_kernel(iterations, progress=progress)
+    if 'colormap' in kernels:
+        results += run_colormap_kernel(iterations, progress=progress)
+    if 'export' in kernels:
+        # Exports are slow, a few iterations are enough
+        results += run_export_kernel(max(1, min(iterations, 5)), size, progress=progress)
+    if 'cogeo' in kernels:
+        results += run_cogeo_kernel(iterations, size, progress=progress)
+
+    return {
+        'created_at': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        'parameters': {
+            'size': size,
+            'iterations': iterations,
+            'zoom_levels': zoom_levels,
+            'tile_cache': tile_cache
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'gdal': rasterio.__gdal_version__,
+            'rasterio': rasterio.__version__,
+            'rio_tiler': rio_tiler.__version__,
+            'cpus': os.cpu_count()
+        },
+        'results': results
+    }
+
+
+def compare(results, baseline):
+    """
+    Compare two benchmark results
+    :return: list of (fixture, case, baseline p50, p50, relative change) tuples
+        for the cases present in both results
+    """
+    baseline_cases = {(r['fixture'], r['case']): r for r in baseline['results']}
+    comparison = []
+    for r in results['results']:
+        b = baseline_cases.get((r['fixture'], r['case']))
+        if b is None or b.get('p50') is None or r.get('p50') is None:
+            continue
+        comparison.append((r['fixture'], r['case'], b['p50'], r['p50'], (r['p50'] - b['p50']) / b['p50'] if b['p50'] > 0 else 0))
+    return comparison
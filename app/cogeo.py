@@ -1,4 +1,7 @@
 import os
+import json
+import struct
+import hashlib
 import logging
 import tempfile
 import shutil
@@ -11,12 +14,64 @@ from webodm import settings
 
 logger = logging.getLogger('app.logger')
 
-def valid_cogeo(src_path):
+GHOST_HEADER_PREFIX = b"GDAL_STRUCTURAL_METADATA_SIZE="
+TIFFTAG_IMAGEWIDTH = 256
+TIFFTAG_IMAGELENGTH = 257
+TIFFTAG_TILEWIDTH = 322
+
+# Creation options of the GDAL COG driver
+COG_PROFILES = {
+    'default': {'BLOCKSIZE': 256, 'COMPRESS': 'DEFLATE', 'RESAMPLING': 'NEAREST'},
+
+    # Lossless
+    'deflate': {'BLOCKSIZE': 256, 'COMPRESS': 'DEFLATE', 'PREDICTOR': 'YES', 'RESAMPLING': 'AVERAGE'},
+    'zstd': {'BLOCKSIZE': 256, 'COMPRESS': 'ZSTD', 'LEVEL': 9, 'PREDICTOR': 'YES', 'RESAMPLING': 'AVERAGE'},
+    'lerc': {'BLOCKSIZE': 256, 'COMPRESS': 'LERC_ZSTD', 'MAX_Z_ERROR': 0, 'RESAMPLING': 'BILINEAR'},
+
+    # Lossy, 8-bit RGB(A) only. The COG driver stores
+    # JPEG tiles in YCbCr and alpha bands as masks
+    'jpeg': {'BLOCKSIZE': 256, 'COMPRESS': 'JPEG', 'QUALITY': 90, 'RESAMPLING': 'AVERAGE'},
+    'webp': {'BLOCKSIZE': 256, 'COMPRESS': 'WEBP', 'QUALITY': 90, 'RESAMPLING': 'AVERAGE'},
+}
+
+RGB8_COMPRESSION = ['JPEG', 'WEBP']
+
+def valid_cogeo(src_path, use_cache=True):
     """
-    Validate a Cloud Optimized GeoTIFF
+    Validate a Cloud Optimized GeoTIFF. Verdicts are cached until the file changes
+    and most files are decided by reading their header only.
     :param src_path: path to GeoTIFF
+    :param use_cache: use (and store) cached verdicts
     :return: true if the GeoTIFF is a cogeo, false otherwise
     """
+    try:
+        file_key = get_file_key(src_path)
+    except OSError:
+        file_key = None
+
+    if use_cache and file_key is not None:
+        verdict = get_verdict(src_path, file_key)
+        if verdict is not None:
+            return verdict
+
+    verdict = precheck_cogeo(src_path)
+    if verdict is None:
+        verdict = validate_cogeo(src_path)
+        if verdict is None:
+            # No validator available, don't remember
+            return False
+
+    if use_cache and file_key is not None:
+        set_verdict(src_path, file_key, verdict)
+
+    return verdict
+
+
+def validate_cogeo(src_path):
+    """
+    Validate a Cloud Optimized GeoTIFF by reading all of its IFDs and block offsets
+    :return: true if the GeoTIFF is a cogeo, false otherwise, None if no validator is available
+    """
     try:
         from app.vendor.validate_cloud_optimized_geotiff import validate
         warnings, errors, details = validate(src_path, full_check=True)
@@ -27,17 +82,181 @@ def valid_cogeo(src_path):
             from rio_cogeo.cogeo import cog_validate
         except ModuleNotFoundError:
             logger.warning("Cannot use cog_validate (rio_cogeo is not installed)")
-            return False
+            return None
         # Legacy
         return cog_validate(src_path, strict=True)
 
 
-def assure_cogeo(src_path):
+def read_tiff_header(src_path):
+    """
+    Read the GDAL structural metadata and the first IFD of a TIFF file
+    :return: dictionary with the width, height, tiled, has_overviews and layout
+        (GDAL structural metadata) keys, or None if the file is not a TIFF
+    """
+    with open(src_path, "rb") as f:
+        head = f.read(16 + 1024)
+        if len(head) < 16 or head[:2] not in (b"II", b"MM"):
+            return None
+
+        bo = "<" if head[:2] == b"II" else ">"
+        version = struct.unpack(bo + "H", head[2:4])[0]
+        if version == 42:
+            ifd_offset = struct.unpack(bo + "I", head[4:8])[0]
+            ghost_offset = 8
+            count_fmt, entry_size, offset_fmt = "H", 12, "I"
+        elif version == 43:
+            ifd_offset = struct.unpack(bo + "Q", head[8:16])[0]
+            ghost_offset = 16
+            count_fmt, entry_size, offset_fmt = "Q", 20, "Q"
+        else:
+            return None
+
+        # GDAL_STRUCTURAL_METADATA_SIZE=XXXXXX bytes\n followed by KEY=VALUE lines
+        layout = {}
+        ghost = head[ghost_offset:]
+        if ghost.startswith(GHOST_HEADER_PREFIX):
+            try:
+                size = int(ghost[len(GHOST_HEADER_PREFIX):len(GHOST_HEADER_PREFIX) + 6])
+                first_line = ghost.index(b"\n") + 1
+            except ValueError:
+                size, first_line = 0, 0
+            for line in ghost[first_line:first_line + size].decode('ascii', 'ignore').split("\n"):
+                if "=" in line:
+                    k, v = line.split("=", 1)
+                    layout[k.strip()] = v.strip()
+
+        f.seek(ifd_offset)
+        count_size = struct.calcsize(count_fmt)
+        count = struct.unpack(bo + count_fmt, f.read(count_size))[0]
+        entries = f.read(count * entry_size)
+        next_ifd = struct.unpack(bo + offset_fmt, f.read(struct.calcsize(offset_fmt)))[0]
+
+    tags = {}
+    for i in range(count):
+        entry = entries[i * entry_size:(i + 1) * entry_size]
+        tag, typ = struct.unpack(bo + "HH", entry[:4])
+        value = entry[8:] if version == 42 else entry[12:]
+        if typ == 3: # SHORT
+            tags[tag] = struct.unpack(bo + "H", value[:2])[0]
+        elif typ == 4: # LONG
+            tags[tag] = struct.unpack(bo + "I", value[:4])[0]
+        elif typ == 16: # LONG8
+            tags[tag] = struct.unpack(bo + "Q", value[:8])[0]
+
+    if not TIFFTAG_IMAGEWIDTH in tags or not TIFFTAG_IMAGELENGTH in tags:
+        return None
+
+    return {
+        'width': tags[TIFFTAG_IMAGEWIDTH],
+        'height': tags[TIFFTAG_IMAGELENGTH],
+        'tiled': TIFFTAG_TILEWIDTH in tags,
+        'has_overviews': next_ifd != 0,
+        'layout': layout
+    }
+
+
+def precheck_cogeo(src_path):
+    """
+    Decide whether a GeoTIFF is a cogeo from its header only: large files
+    must be tiled and have overviews, while files written by GDAL's COG driver
+    (and not edited afterwards) declare their layout in the header
+    :return: true or false, None if a full validation is required
+    """
+    try:
+        header = read_tiff_header(src_path)
+    except (OSError, struct.error):
+        return None
+
+    if header is None:
+        return None
+
+    if header['width'] > 512 or header['height'] > 512:
+        if not header['tiled'] or not header['has_overviews']:
+            return False
+
+    layout = header['layout']
+    if header['tiled'] and layout.get('LAYOUT') == 'IFDS_BEFORE_DATA' and \
+       layout.get('BLOCK_ORDER') == 'ROW_MAJOR' and layout.get('KNOWN_INCOMPATIBLE_EDITION') == 'NO':
+        return True
+
+    return None
+
+
+def get_file_key(src_path):
+    st = os.stat(src_path)
+    return {'size': st.st_size, 'mtime': st.st_mtime_ns, 'inode': st.st_ino}
+
+
+def get_verdict_path(src_path):
+    return os.path.join(settings.MEDIA_CACHE, "cogeo", hashlib.sha1(os.path.abspath(src_path).encode('utf-8')).hexdigest() + ".json")
+
+
+def get_verdict(src_path, file_key):
+    """
+    :return: cached validation result for the file or None
+    """
+    try:
+        with open(get_verdict_path(src_path), "r") as f:
+            cached = json.load(f)
+        if cached.get('path') == os.path.abspath(src_path) and cached.get('key') == file_key:
+            return cached['valid']
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def set_verdict(src_path, file_key, valid):
+    verdict_path = get_verdict_path(src_path)
+    try:
+        os.makedirs(os.path.dirname(verdict_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(verdict_path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({'path': os.path.abspath(src_path), 'key': file_key, 'valid': valid}, f)
+        os.replace(tmp_path, verdict_path)
+    except OSError as e:
+        logger.warning("Cannot cache cogeo validation for %s: %s" % (src_path, str(e)))
+
+
+def is_rgb8(src_path):
+    """
+    :return: true if the raster is 8-bit RGB (with optional alpha)
+    """
+    with rasterio.open(src_path) as f:
+        return all(dt == 'uint8' for dt in f.dtypes) and (f.count == 3 or (f.count == 4 and has_alpha_band(f)))
+
+
+def is_profile_compatible(src_path, profile):
+    return not COG_PROFILES[profile]['COMPRESS'] in RGB8_COMPRESSION or is_rgb8(src_path)
+
+
+def get_profile(src_path, asset_type=None):
+    """
+    :param asset_type: orthophoto, dsm or dtm. Orthophotos that are not
+        8-bit RGB use the multispectral profile
+    :return: name of the COG profile to use for the raster (see settings.COG_ASSET_PROFILES)
+    """
+    if asset_type == 'orthophoto' and not is_rgb8(src_path):
+        asset_type = 'multispectral'
+
+    profile = settings.COG_ASSET_PROFILES.get(asset_type, 'default')
+    if not profile in COG_PROFILES:
+        logger.warning("Invalid COG profile %s for %s, using default" % (profile, asset_type))
+        return 'default'
+
+    if not is_profile_compatible(src_path, profile):
+        logger.warning("Cannot use COG profile %s for %s (not 8-bit RGB), using default" % (profile, src_path))
+        return 'default'
+
+    return profile
+
+
+def assure_cogeo(src_path, asset_type=None):
     """
     Guarantee that the .tif passed as an argument is a Cloud Optimized GeoTIFF (cogeo)
     If the path is not a cogeo, it is destructively converted into a cogeo.
     If the file cannot be converted, the function does not change the file
     :param src_path: path to GeoTIFF (cogeo or not)
+    :param asset_type: orthophoto, dsm or dtm, selects the COG profile used for the conversion
     :return: None
     """
 
@@ -72,7 +291,7 @@ def assure_cogeo(src_path):
         logger.warning("Using legacy implementation (GDAL >= 3.1 not found)")
         return make_cogeo_legacy(src_path)
     else:
-        return make_cogeo_gdal(src_path)
+        return make_cogeo_gdal(src_path, get_profile(src_path, asset_type))
 
 def get_gdal_version():
     # Bit of a hack without installing 
@@ -91,28 +310,39 @@ def get_gdal_version():
     return tuple(map(int, m.groups()))
 
 
-def make_cogeo_gdal(src_path):
+def translate_cogeo(src_path, dst_path, profile='default'):
     """
-    Make src_path a Cloud Optimized GeoTIFF.
+    Write a copy of src_path as a Cloud Optimized GeoTIFF.
     Requires GDAL >= 3.1
+    :param profile: COG profile (see COG_PROFILES)
+    :return: true if dst_path was created
     """
-
-    tmpfile = tempfile.mktemp('_cogeo.tif', dir=settings.MEDIA_TMP)
-    swapfile = tempfile.mktemp('_cogeo_swap.tif', dir=settings.MEDIA_TMP)
+    params = ["gdal_translate", "-of", "COG"]
+    for k, v in COG_PROFILES[profile].items():
+        params += ["-co", "{}={}".format(k, v)]
 
     try:
-        subprocess.run(["gdal_translate", "-of", "COG",
-                        "-co", "BLOCKSIZE=256",
-                        "-co", "COMPRESS=deflate",
-                        "-co", "NUM_THREADS=ALL_CPUS",
+        subprocess.run(params + ["-co", "NUM_THREADS=ALL_CPUS",
                         "-co", "BIGTIFF=IF_SAFER",
-                        "-co", "RESAMPLING=NEAREST",
                         "--config", "GDAL_NUM_THREADS", "ALL_CPUS",
-                        quote(src_path), quote(tmpfile)])
+                        quote(src_path), quote(dst_path)])
     except Exception as e:
         logger.warning("Cannot create Cloud Optimized GeoTIFF: %s" % str(e))
 
-    if os.path.isfile(tmpfile):
+    return os.path.isfile(dst_path)
+
+
+def make_cogeo_gdal(src_path, profile='default'):
+    """
+    Make src_path a Cloud Optimized GeoTIFF.
+    Requires GDAL >= 3.1
+    :param profile: COG profile (see COG_PROFILES)
+    """
+
+    tmpfile = tempfile.mktemp('_cogeo.tif', dir=settings.MEDIA_TMP)
+    swapfile = tempfile.mktemp('_cogeo_swap.tif', dir=settings.MEDIA_TMP)
+
+    if translate_cogeo(src_path, tmpfile, profile):
         shutil.move(src_path, swapfile) # Move to swap location
 
         try:
@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import hashlib
+import logging
+import redis
+from webodm import settings
+
+logger = logging.getLogger('app.logger')
+redis_client = redis.Redis.from_url(settings.CELERY_BROKER_URL)
+
+REDIS_KEY_PREFIX = 'export_cache_job_'
+
+
+def cache_dir(*args):
+    return os.path.join(settings.MEDIA_CACHE, "exports", *args)
+
+
+def get_key(task_id, asset_path, job, params):
+    """
+    Compute a content-addressed key for an export
+    :param task_id: task ID
+    :param asset_path: path to the asset that is exported
+    :param job: name of the export job
+    :param params: dictionary with all the options of the export job (must be JSON serializable)
+    :return: cache key (string) or None if the asset cannot be found
+    """
+    try:
+        st = os.stat(asset_path)
+    except FileNotFoundError:
+        return None
+
+    # Any change to the asset changes the key,
+    # so stale exports are never served
+    payload = json.dumps({
+        'asset': asset_path,
+        'mtime': st.st_mtime_ns,
+        'size': st.st_size,
+        'inode': st.st_ino,
+        'job': job,
+        'params': params
+    }, sort_keys=True, default=str)
+
+    return "{}/{}".format(task_id, hashlib.sha1(payload.encode('utf-8')).hexdigest())
+
+
+def get_path(key, extension):
+    task_id, h = key.split("/")
+    return cache_dir(task_id, "{}.{}".format(h, extension))
+
+
+def get(key, extension):
+    """
+    :return: path of a cached export (marking it as recently used) or None
+    """
+    if key is None:
+        return None
+
+    path = get_path(key, extension)
+    return path if touch(path) else None
+
+
+def get_job(key):
+    """
+    :return: ID of the last celery task that was started for key, or None
+    """
+    if key is None:
+        return None
+
+    try:
+        job_id = redis_client.get(REDIS_KEY_PREFIX + key)
+    except redis.exceptions.RedisError as e:
+        logger.warning("Cannot read export job from redis: %s" % str(e))
+        return None
+
+    return job_id.decode('utf-8') if job_id is not None else None
+
+
+def set_job(key, job_id, only_new=False):
+    """
+    Associate a celery task with key. Jobs are forgotten after
+    WORKERS_MAX_TIME_LIMIT seconds, unless their result is stored (see store)
+    :param only_new: only set the job if there's no other job for key
+    :return: True if the job was set
+    """
+    if key is None:
+        return False
+
+    try:
+        return bool(redis_client.set(REDIS_KEY_PREFIX + key, job_id, ex=settings.WORKERS_MAX_TIME_LIMIT, nx=only_new))
+    except redis.exceptions.RedisError as e:
+        logger.warning("Cannot write export job to redis: %s" % str(e))
+        return False
+
+
+def forget_job(key):
+    try:
+        redis_client.delete(REDIS_KEY_PREFIX + key)
+    except redis.exceptions.RedisError:
+        pass
+
+
+def store(key, file):
+    """
+    Move the result of an export into the cache
+    :param file: path to the exported file
+    :return: path of the file in the cache
+    """
+    extension = os.path.splitext(file)[1].lstrip(".")
+    path = get_path(key, extension)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Exports might be on a different filesystem: move to a temporary file
+    # next to the destination first, so that concurrent readers never see partial files
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    os.close(fd)
+    try:
+        shutil.move(file, tmp_path)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    # Keep the job around for as long as the celery result
+    try:
+        redis_client.expire(REDIS_KEY_PREFIX + key, settings.EXPORT_CACHE_JOB_TTL)
+    except redis.exceptions.RedisError:
+        pass
+
+    return path
+
+
+def touch(path):
+    """
+    Mark a cached export as recently used
+    :return: True if the export is still in the cache
+    """
+    try:
+        os.utime(path)
+        return True
+    except OSError:
+        return False
+
+
+def clear_task(task_id):
+    """
+    Remove all cached exports for a task
+    """
+    d = cache_dir(str(task_id))
+    if os.path.isdir(d):
+        try:
+            shutil.rmtree(d)
+        except Exception as e:
+            logger.warning("Cannot clear export cache {}: {}".format(d, str(e)))
+
+
+def evict(max_size_mb=None):
+    """
+    Remove least recently used exports until the size
+    of the cache is below max_size_mb
+    :return: (number of removed exports, bytes freed)
+    """
+    if max_size_mb is None:
+        max_size_mb = settings.EXPORT_CACHE_MAX_SIZE
+
+    d = cache_dir()
+    if not os.path.isdir(d):
+        return 0, 0
+
+    entries = []
+    total_bytes = 0
+    now = time.time()
+
+    for dirpath, _, filenames in os.walk(d):
+        for f in filenames:
+            fp = os.path.join(dirpath, f)
+            try:
+                st = os.stat(fp)
+            except FileNotFoundError:
+                continue
+
+            # Exports being stored, or leftovers from interrupted ones
+            if f.endswith(".tmp"):
+                if st.st_mtime < now - 3600:
+                    try:
+                        os.remove(fp)
+                    except FileNotFoundError:
+                        pass
+                continue
+
+            entries.append((st.st_mtime, st.st_size, fp))
+            total_bytes += st.st_size
+
+    max_bytes = max_size_mb * 1024 * 1024
+    if total_bytes <= max_bytes:
+        return 0, 0
+
+    entries.sort(key=lambda e: e[0])
+
+    removed = 0
+    freed = 0
+    for _, size, fp in entries:
+        if total_bytes - freed <= max_bytes:
+            break
+        try:
+            os.remove(fp)
+            removed += 1
+            freed += size
+        except FileNotFoundError:
+            pass
+
+    for dirpath, dirnames, filenames in os.walk(d, topdown=False):
+        if dirpath != d and not dirnames and not filenames:
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass
+
+    return removed, freed
@@ -0,0 +1,53 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from app import benchmark
+
+class Command(BaseCommand):
+    requires_system_checks = []
+    help = "Benchmark the tiler (tiles, metadata and thumbnails) using synthetic rasters"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fixtures", type=str, nargs="*", choices=benchmark.FIXTURE_TYPES, default=benchmark.FIXTURE_TYPES, help="Synthetic rasters to benchmark")
+        parser.add_argument("--size", type=int, required=False, default=4096, help="Width and height of the synthetic rasters in pixels")
+        parser.add_argument("--iterations", type=int, required=False, default=50, help="Number of measured requests for each case")
+        parser.add_argument("--zoom-levels", type=int, required=False, default=4, help="Number of zoom levels to request tiles for")
+        parser.add_argument("--tile-cache", action="store_true", default=False, help="Keep the tile cache enabled (if TILE_CACHE is set)")
+        parser.add_argument("--kernels", type=str, nargs="*", choices=benchmark.KERNELS, default=[], help="Image processing kernels to benchmark in isolation")
+        parser.add_argument("--output", type=str, required=False, default=None, help="Write the results to this JSON file")
+        parser.add_argument("--compare", type=str, required=False, default=None, help="Compare the results with a previous JSON results file")
+
+        super(Command, self).add_arguments(parser)
+
+    def handle(self, **options):
+        baseline = None
+        if options.get('compare'):
+            try:
+                with open(options.get('compare'), 'r') as f:
+                    baseline = json.load(f)
+            except (IOError, json.JSONDecodeError) as e:
+                raise CommandError("Cannot read %s: %s" % (options.get('compare'), str(e)))
+
+        def progress(fixture_type, case, summary):
+            if summary['requests'] > 0:
+                line = "%-14s %-32s p50: %8.1f ms  p95: %8.1f ms  %7.1f req/s  errors: %s" % (fixture_type, case, summary['p50'], summary['p95'], summary['per_second'], summary['errors'])
+                if 'peak_memory' in summary:
+                    line += "  peak memory: %.1f MB" % (summary['peak_memory'] / 1024 / 1024)
+                if 'file_size' in summary:
+                    line += "  size: %.1f MB  conversion: %.1f s" % (summary['file_size'] / 1024 / 1024, summary['conversion_time'])
+                print(line)
+            else:
+                print("%-14s %-32s no requests" % (fixture_type, case))
+
+        results = benchmark.run(options.get('fixtures'), options.get('size'), options.get('iterations'),
+                                options.get('zoom_levels'), options.get('tile_cache'), options.get('kernels'), progress)
+
+        if options.get('output'):
+            with open(options.get('output'), 'w') as f:
+                json.dump(results, f, indent=2)
+            print("Wrote %s" % options.get('output'))
+
+        if baseline is not None:
+            print("")
+            print("Comparison with %s (p50)" % options.get('compare'))
+            for fixture_type, case, before, after, change in benchmark.compare(results, baseline):
+                print("%-14s %-32s %8.1f ms -> %8.1f ms (%+.1f%%)" % (fixture_type, case, before, after, change * 100))
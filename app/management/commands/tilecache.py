@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from app import tilecache
+
+class Command(BaseCommand):
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("action", type=str, choices=['stats', 'evict', 'clear'])
+        parser.add_argument("--max-size", type=int, required=False, default=None, help="Maximum cache size in megabytes (evict only, defaults to TILE_CACHE_MAX_SIZE)")
+
+        super(Command, self).add_arguments(parser)
+
+    def handle(self, **options):
+        action = options.get('action')
+
+        if action == 'stats':
+            stats = tilecache.get_stats()
+            print("Hits: %s" % stats['hits'])
+            print("Misses: %s" % stats['misses'])
+            print("Hit ratio: %.2f%%" % (stats['hit_ratio'] * 100))
+            print("Tiles: %s" % stats['tiles'])
+            print("Size: %.1f MB (max %s MB)" % (stats['size'], stats['max_size']))
+        elif action == 'evict':
+            removed, freed = tilecache.evict(options.get('max_size'))
+            print("Evicted %s tiles (%.1f MB)" % (removed, freed / 1024 / 1024))
+        elif action == 'clear':
+            tilecache.clear()
+            print("Cleared tile cache")
@@ -0,0 +1,201 @@
+import os
+import sqlite3
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from webodm import settings
+
+logger = logging.getLogger('app.logger')
+
+# Number of tiles written to the archive per transaction
+COMMIT_INTERVAL = 500
+
+EPSILON = 1e-9
+
+
+def get_tile_ranges(tms, bounds, minzoom, maxzoom):
+    """
+    :param tms: morecantile TileMatrixSet
+    :param bounds: (west, south, east, north) WGS84 bounds
+    :return: list of (z, minx, maxx, miny, maxy) tuples (inclusive)
+    """
+    west, south, east, north = bounds
+    ranges = []
+    for z in range(minzoom, maxzoom + 1):
+        ul = tms.tile(west + EPSILON, north - EPSILON, z)
+        lr = tms.tile(east - EPSILON, south + EPSILON, z)
+        ranges.append((z, ul.x, lr.x, ul.y, lr.y))
+    return ranges
+
+
+def count_tiles(ranges):
+    return sum((maxx - minx + 1) * (maxy - miny + 1) for _, minx, maxx, miny, maxy in ranges)
+
+
+def iter_tiles(ranges):
+    for z, minx, maxx, miny, maxy in ranges:
+        for x in range(minx, maxx + 1):
+            for y in range(miny, maxy + 1):
+                yield z, x, y
+
+
+def intersect_bounds(a, b):
+    """
+    :return: intersection of two (west, south, east, north) bounds or None if they don't overlap
+    """
+    west, south, east, north = max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])
+    if west >= east or south >= north:
+        return None
+    return west, south, east, north
+
+
+def create_archive(output, metadata):
+    if os.path.exists(output):
+        os.remove(output)
+
+    conn = sqlite3.connect(output)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("CREATE TABLE metadata (name text, value text)")
+    conn.execute("CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)")
+    conn.executemany("INSERT INTO metadata (name, value) VALUES (?, ?)", [(k, str(v)) for k, v in metadata.items()])
+    return conn
+
+
+def get_export_ranges(src, minzoom=None, maxzoom=None, bounds=None, max_tiles=None):
+    """
+    :param src: COGReader
+    :param minzoom: minimum zoom level (default: minimum zoom level of the raster)
+    :param maxzoom: maximum zoom level (default: maximum zoom level of the raster)
+    :param bounds: (west, south, east, north) WGS84 bounds to limit the export to (optional)
+    :param max_tiles: if maxzoom is not set, lower the default maximum zoom level
+        until the export has at most max_tiles tiles (or only includes minzoom)
+    :return: (tile ranges, bounds) tuple. Raises ValueError if the zoom levels
+        or the bounds are not valid for the raster.
+    """
+    from app.api.tiler import get_zoom_safe
+    from app.raster_utils import ZOOM_EXTRA_LEVELS
+
+    raster_minzoom, raster_maxzoom = get_zoom_safe(src)
+    if minzoom is None:
+        minzoom = raster_minzoom
+    default_maxzoom = maxzoom is None
+    if default_maxzoom:
+        maxzoom = raster_maxzoom
+
+    if minzoom < 0 or minzoom > maxzoom or maxzoom > raster_maxzoom + ZOOM_EXTRA_LEVELS:
+        raise ValueError("Invalid zoom levels (max: {})".format(raster_maxzoom + ZOOM_EXTRA_LEVELS))
+
+    export_bounds = tuple(src.bounds) if bounds is None else intersect_bounds(src.bounds, bounds)
+    if export_bounds is None:
+        raise ValueError("Bounds do not overlap the raster")
+
+    ranges = get_tile_ranges(src.tms, export_bounds, minzoom, maxzoom)
+    if max_tiles is not None and default_maxzoom:
+        while len(ranges) > 1 and count_tiles(ranges) > max_tiles:
+            ranges.pop()
+
+    return ranges, export_bounds
+
+
+def export_mbtiles(task, tile_type, output, query_params={}, minzoom=None, maxzoom=None, bounds=None,
+                   ext="png", threads=None, progress_callback=None):
+    """
+    Render the tiles of a task's raster into a MBTiles archive, using the same
+    rendering path as the map tiles. Tiles are rendered in parallel and written
+    to disk as they complete, so only a few tiles are held in memory at a time.
+    :param query_params: styling parameters (formula, bands, rescale, color_map, hillshade, crop)
+    :param ext: tile format (png, jpg or webp)
+    :param threads: number of rendering threads (default: WORKERS_MAX_THREADS)
+    :return: number of tiles written
+    """
+    # app.api.tiler imports the worker tasks
+    from app.api.tiler import get_raster_path, get_tile_params, read_tile_image, encode_tile, format_rescale_value
+    from app.geoutils import get_rasterio_to_meters_factor
+    from app import raster_pool, raster_stats
+    from rest_framework.exceptions import NotFound
+
+    if threads is None:
+        threads = settings.WORKERS_MAX_THREADS
+
+    with raster_pool.open_cog(get_raster_path(task, tile_type)) as src:
+        ranges, export_bounds = get_export_ranges(src, minzoom, maxzoom, bounds)
+
+        # Same default rescaling as the map client (min/max of the last band)
+        if not query_params.get('rescale') and not query_params.get('formula'):
+            md = raster_stats.get(task, tile_type)
+            if md is None:
+                md = raster_stats.compute_metadata(src, tile_type, vrt_options=raster_stats.get_vrt_options(task, tile_type))
+            band_stats = md['statistics'][sorted(md['statistics'].keys(), key=int)[-1]]
+            to_meter = get_rasterio_to_meters_factor(src.dataset) if tile_type in ['dsm', 'dtm'] else 1.0
+            query_params = dict(query_params, rescale="{},{}".format(format_rescale_value(band_stats['min'] * to_meter),
+                                                                      format_rescale_value(band_stats['max'] * to_meter)))
+
+    minzoom = ranges[0][0]
+    maxzoom = ranges[-1][0]
+    total = count_tiles(ranges)
+    params = {z: get_tile_params(task, tile_type, z, 1, query_params) for z in range(minzoom, maxzoom + 1)}
+
+    def render(tile):
+        z, x, y = tile
+        try:
+            data, mask = read_tile_image(task, tile_type, x, y, params[z])
+        except NotFound:
+            return tile, None
+
+        if not mask.any():
+            return tile, None
+        return tile, encode_tile(data, mask, ext)[0]
+
+    west, south, east, north = export_bounds
+    conn = create_archive(output, {
+        'name': task.name or str(task.id),
+        'type': 'overlay',
+        'version': '1.1',
+        'description': "{} {}".format(task.name or str(task.id), tile_type),
+        'format': ext,
+        'minzoom': minzoom,
+        'maxzoom': maxzoom,
+        'bounds': "{},{},{},{}".format(west, south, east, north),
+        'center': "{},{},{}".format((west + east) / 2, (south + north) / 2, minzoom),
+    })
+
+    written = 0
+    done = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+            # Keep a bounded number of tiles in flight
+            pending = deque()
+            tiles = iter_tiles(ranges)
+            max_pending = max(1, threads) * 4
+
+            def write(future):
+                nonlocal written, done
+                (z, x, y), content = future.result()
+                done += 1
+                if content is not None:
+                    # MBTiles rows are numbered from the bottom (TMS)
+                    conn.execute("INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+                                 (z, x, (1 << z) - 1 - y, sqlite3.Binary(content)))
+                    written += 1
+                    if written % COMMIT_INTERVAL == 0:
+                        conn.commit()
+
+                if progress_callback is not None and done % 100 == 0:
+                    progress_callback("Rendering tiles", done / total * 100.0)
+
+            for tile in tiles:
+                pending.append(executor.submit(render, tile))
+                if len(pending) >= max_pending:
+                    write(pending.popleft())
+
+            while len(pending) > 0:
+                write(pending.popleft())
+
+        conn.execute("CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)")
+        conn.commit()
+    finally:
+        conn.close()
+
+    logger.info("Exported {} tiles ({} empty) of {} to {}".format(written, total - written, tile_type, output))
+    return written
@@ -38,6 +38,8 @@ from app import pending_actions
 from django.contrib.gis.db.models.fields import GeometryField
 
 from app.cogeo import assure_cogeo
+from app.taskgraph import run_graph
+from app import tilecache, exportcache, raster_pool, raster_stats, vector_tiles, remotezip
 from app.pointcloud_utils import is_pointcloud_georeferenced
 from app.testwatch import testWatch
 from app.security import path_traversal_check
@@ -918,16 +920,54 @@ class Task(models.Model):
                                         self.TASK_PROGRESS_LAST_VALUE + (float(progress) / 100.0) * 0.1))
                                     last_update = time.time()
 
+                            if settings.STREAM_TASK_ASSETS:
+                                logger.info("Downloading and extracting assets for {}".format(self))
+                                try:
+                                    self.processing_node.extract_task_assets(self.uuid, assets_dir, progress_callback=callback)
+                                    extracted = True
+                                except NodeConnectionError:
+                                    raise
+                                except Exception as e:
+                                    # Range requests not supported, corrupted members, I/O errors...
+                                    logger.warning("Cannot extract assets while downloading for {} ({}), downloading all.zip".format(self, str(e)))
+                                    shutil.rmtree(assets_dir)
+                                    os.makedirs(assets_dir)
+
+                                if extracted:
+                                    self.extract_assets_and_complete(assets_extracted=True)
+
+                            # Kept outside of the assets directory, so that it survives restarts
+                            partial_zip_path = self.task_path("all.zip.download")
+                            resumable = settings.RESUMABLE_TASK_DOWNLOADS
+
                             while not extracted:
                                 last_update = 0
                                 logger.info("Downloading all.zip for {}".format(self))
+                                all_zip_path = self.assets_path("all.zip")
 
                                 # Download all assets
-                                zip_path = self.processing_node.download_task_assets(self.uuid, assets_dir, progress_callback=callback, parallel_downloads=max(1, int(16 / (2 ** retry_num))))
-
-                                # Rename to all.zip
-                                all_zip_path = self.assets_path("all.zip")
-                                os.rename(zip_path, all_zip_path)
+                                if resumable:
+                                    try:
+                                        self.processing_node.download_task_assets_resumable(self.uuid, partial_zip_path, progress_callback=callback)
+
+                                        # Link, so that the partial download is kept if all.zip is corrupted
+                                        try:
+                                            os.link(partial_zip_path, all_zip_path)
+                                        except OSError:
+                                            shutil.copy(partial_zip_path, all_zip_path)
+                                    except remotezip.RangeRequestsNotSupported as e:
+                                        logger.warning("Cannot resume downloads for {} ({})".format(self, str(e)))
+                                        remotezip.remove_download(partial_zip_path)
+                                        resumable = False
+                                    except OSError as e:
+                                        # Cannot write the download (disk full, permissions, ...)
+                                        raise NodeServerError(gettext('Cannot download assets: %(error)s') % {'error': str(e)})
+
+                                if not resumable:
+                                    zip_path = self.processing_node.download_task_assets(self.uuid, assets_dir, progress_callback=callback, parallel_downloads=max(1, int(16 / (2 ** retry_num))))
+
+                                    # Rename to all.zip
+                                    os.rename(zip_path, all_zip_path)
 
                                 logger.info("Extracting all.zip for {}".format(self))
 
@@ -939,8 +979,15 @@ class Task(models.Model):
                                         logger.warning("{} seems corrupted. Retrying...".format(all_zip_path))
                                         retry_num += 1
                                         os.remove(all_zip_path)
+
+                                        # Only download the corrupted parts again
+                                        if resumable:
+                                            remotezip.invalidate_corrupted(partial_zip_path)
                                     else:
+                                        remotezip.remove_download(partial_zip_path)
                                         raise NodeServerError(gettext("Invalid zip file"))
+
+                            remotezip.remove_download(partial_zip_path)
                         else:
                             # FAILED, CANCELED
                             self.save()
@@ -961,10 +1008,11 @@ class Task(models.Model):
             # Task was interrupted during image resize / upload
             logger.warning("{} interrupted: {}".format(self, str(e)))
 
-    def extract_assets_and_complete(self):
+    def extract_assets_and_complete(self, assets_extracted=False):
         """
         Extracts assets/all.zip (if available), populates task fields where required and assure COGs
         It will raise a zipfile.BadZipFile exception if the archive is corrupted.
+        :param assets_extracted: the assets were already extracted (see ProcessingNode.extract_task_assets)
         :return:
         """
         assets_dir = self.assets_path("")
@@ -1009,38 +1057,12 @@ class Task(models.Model):
                             shutil.move(f, assets_dir)
                         shutil.rmtree(top_level[0])
 
-        elif self.import_url != "file://external":
+        elif not assets_extracted and self.import_url != "file://external":
             # all.zip should be missing only when doing external data import
             logger.warning("Cannot find assets archive for {} ({})".format(self, zip_path))
             raise NodeServerError("Cannot import task")
 
-        # Populate *_extent fields
-        extent_fields = self.get_extent_fields()
-
-        for raster_path, field in extent_fields:
-            if os.path.exists(raster_path):
-                # Make sure this is a Cloud Optimized GeoTIFF
-                # if not, it will be created
-                try:
-                    assure_cogeo(raster_path)
-                except IOError as e:
-                    logger.warning("Cannot create Cloud Optimized GeoTIFF for %s (%s). This will result in degraded visualization performance." % (raster_path, str(e)))
-
-                # Read extent
-                extent_wkt = get_raster_bounds_wkt(raster_path)
-                if extent_wkt is not None:
-                    extent = GEOSGeometry(extent_wkt, srid=4326)
-                    setattr(self, field, extent)
-                    logger.info("Populated extent field with {} for {}".format(raster_path, self))
-                else:
-                    logger.warning("Cannot populate extent field with {} for {}, not georeferenced".format(raster_path, self))
-        
-        self.check_ept()
-        self.update_available_assets_field()
-        self.update_georef_fields()
-        self.update_orthophoto_bands_field()
-        self.update_media_field()
-        self.update_size()
+        self.run_post_processing()
         self.clear_task_assets_cache()
         self.potree_scene = {}
         self.running_progress = 1.0
@@ -1063,6 +1085,59 @@ class Task(models.Model):
         from app.plugins import signals as plugin_signals
         plugin_signals.task_completed.send_robust(sender=self.__class__, task_id=self.id)
 
+    def run_post_processing(self):
+        """
+        Populate the task fields that depend on the assets and generate
+        COGs, EPT, statistics and indexes. Independent steps run concurrently
+        and their timings are logged to the console.
+        """
+        steps = []
+        raster_steps = []
+
+        # Populate *_extent fields
+        for raster_path, field in self.get_extent_fields():
+            if os.path.exists(raster_path):
+                cogeo_step = "cogeo:{}".format(field)
+                steps.append((cogeo_step, partial(self.assure_cogeo_field, raster_path, field.replace("_extent", "")), []))
+                steps.append(("extent:{}".format(field), partial(self.update_extent_field, raster_path, field), [cogeo_step]))
+                raster_steps.append(cogeo_step)
+
+        steps += [
+            ("ept", self.check_ept, []),
+            ("available_assets", self.update_available_assets_field, raster_steps + ["ept"]),
+            ("georef", self.update_georef_fields, raster_steps),
+            ("orthophoto_bands", self.update_orthophoto_bands_field, raster_steps),
+            ("raster_stats", partial(raster_stats.generate, self), raster_steps + ["georef", "orthophoto_bands"]),
+            ("media", self.update_media_field, []),
+            ("vector_tiles", partial(vector_tiles.generate, self), ["media"]),
+        ]
+
+        def on_done(name, duration):
+            logger.info("Post-processing step {} for {} took {:.2f}s".format(name, self, duration))
+            self.console += gettext("Post-processing %(step)s (%(time).2fs)") % {'step': name, 'time': duration} + "\n"
+
+        start = time.time()
+        run_graph(steps, settings.POSTPROCESS_MAX_THREADS, on_done)
+        self.update_size()
+        self.console += gettext("Post-processing completed in %(time).2fs") % {'time': time.time() - start} + "\n"
+
+    def assure_cogeo_field(self, raster_path, asset_type):
+        # Make sure this is a Cloud Optimized GeoTIFF
+        # if not, it will be created
+        try:
+            assure_cogeo(raster_path, asset_type)
+        except IOError as e:
+            logger.warning("Cannot create Cloud Optimized GeoTIFF for %s (%s). This will result in degraded visualization performance." % (raster_path, str(e)))
+
+    def update_extent_field(self, raster_path, field):
+        extent_wkt = get_raster_bounds_wkt(raster_path)
+        if extent_wkt is not None:
+            extent = GEOSGeometry(extent_wkt, srid=4326)
+            setattr(self, field, extent)
+            logger.info("Populated extent field with {} for {}".format(raster_path, self))
+        else:
+            logger.warning("Cannot populate extent field with {} for {}, not georeferenced".format(raster_path, self))
+
     def check_ept(self, threads=1):
         # Make sure that the entwine_pointcloud/ept.json file exists
         # and generate it otherwise
@@ -1150,6 +1225,10 @@ class Task(models.Model):
         if isinstance(self.media, list) and len(self.media) > 0:
              media = '/api/projects/{}/tasks/{}/media.geojson'.format(self.project.id, self.id)
 
+        vector_tiles_url = ''
+        if camera_shots or ground_control_points or media:
+            vector_tiles_url = '/api/projects/{}/tasks/{}/vector/tiles/{{z}}/{{x}}/{{y}}.mvt'.format(self.project.id, self.id)
+
         return {
             'tiles': [{'url': self.get_tile_base_url(t), 'type': t} for t in types],
             'meta': {
@@ -1167,7 +1246,8 @@ class Task(models.Model):
                     'orthophoto_bands': self.orthophoto_bands,
                     'crop': self.crop is not None,
                     'extent': self.get_extent(),
-                    'media': media
+                    'media': media,
+                    'vector_tiles': vector_tiles_url
                 }
             }
         }
@@ -1652,6 +1732,10 @@ class Task(models.Model):
             except Exception as e:
                 logger.warning("Cannot clear task assets cache {}: {}".format(d, str(e)))
 
+        tilecache.clear_task(self.id)
+        exportcache.clear_task(self.id)
+        raster_pool.invalidate(self.assets_path())
+
     def get_safe_textured_model(self, max_size_mb=150):
         input_glb = self.get_check_file_asset_path('textured_model.glb')
         if input_glb is None or (not 'textured_model.glb' in self.available_assets):
@@ -0,0 +1,155 @@
+import os
+import logging
+import threading
+import rasterio
+from collections import OrderedDict
+from contextlib import contextmanager
+from rasterio.errors import RasterioError
+from rio_tiler.io import COGReader
+from webodm import settings
+
+logger = logging.getLogger('app.logger')
+
+
+class DatasetPool:
+    """
+    Per-process pool of open raster handles. Opening a COG means parsing
+    its header, IFDs and overviews, so we keep handles open between requests.
+    Handles are keyed by path, modification time, size and inode, so that files
+    that change on disk are never served from stale handles. A handle is only ever
+    used by one thread at a time: concurrent borrowers of the same file
+    get separate handles.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.idle = OrderedDict() # key --> [handles], least recently used first
+        self.idle_count = 0
+
+    @staticmethod
+    def get_key(kind, path):
+        st = os.stat(path)
+        return (kind, os.path.realpath(path), st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def acquire(self, kind, path, opener):
+        key = self.get_key(kind, path)
+
+        with self.lock:
+            handles = self.idle.get(key)
+            if handles:
+                handle = handles.pop()
+                self.idle_count -= 1
+                if len(handles) == 0:
+                    del self.idle[key]
+                return key, handle
+
+        # Open outside of the lock, this can take a while
+        return key, opener(path)
+
+    def release(self, key, handle):
+        to_close = []
+        kind, path = key[0], key[1]
+
+        try:
+            current_key = self.get_key(kind, path)
+        except FileNotFoundError:
+            current_key = None
+
+        with self.lock:
+            # Drop handles that point to previous versions of this file
+            for k in [k for k in self.idle if k[0] == kind and k[1] == path and k != current_key]:
+                handles = self.idle.pop(k)
+                self.idle_count -= len(handles)
+                to_close += handles
+
+            if current_key != key or self.max_size <= 0:
+                # File changed while we were using it
+                to_close.append(handle)
+            else:
+                self.idle.setdefault(key, []).append(handle)
+                self.idle.move_to_end(key)
+                self.idle_count += 1
+
+            # Close least recently used handles
+            while self.idle_count > self.max_size:
+                k = next(iter(self.idle))
+                handles = self.idle[k]
+                to_close.append(handles.pop(0))
+                self.idle_count -= 1
+                if len(handles) == 0:
+                    del self.idle[k]
+
+        for h in to_close:
+            close_handle(h)
+
+    def invalidate(self, path_prefix):
+        """
+        Close all idle handles for files under path_prefix
+        """
+        path_prefix = os.path.realpath(path_prefix)
+        to_close = []
+
+        with self.lock:
+            for k in [k for k in self.idle if k[1].startswith(path_prefix)]:
+                handles = self.idle.pop(k)
+                self.idle_count -= len(handles)
+                to_close += handles
+
+        for h in to_close:
+            close_handle(h)
+
+    def clear(self):
+        to_close = []
+        with self.lock:
+            for k in self.idle:
+                to_close += self.idle[k]
+            self.idle.clear()
+            self.idle_count = 0
+
+        for h in to_close:
+            close_handle(h)
+
+    @contextmanager
+    def borrow(self, kind, path, opener):
+        key, handle = self.acquire(kind, path, opener)
+        try:
+            yield handle
+        except RasterioError:
+            # The handle might be in a bad state, don't reuse it
+            close_handle(handle)
+            raise
+        except:
+            self.release(key, handle)
+            raise
+        else:
+            self.release(key, handle)
+
+
+def close_handle(handle):
+    try:
+        handle.close()
+    except Exception as e:
+        logger.warning("Cannot close raster handle: %s" % str(e))
+
+
+pool = DatasetPool(settings.RASTER_POOL_SIZE)
+
+
+def open_cog(path):
+    """
+    Borrow a COGReader for path from the pool
+    (to be used as a context manager)
+    """
+    return pool.borrow('cog', path, COGReader)
+
+
+def open_raster(path):
+    """
+    Borrow a rasterio dataset (read mode) for path from the pool
+    (to be used as a context manager)
+    """
+    return pool.borrow('raster', path, rasterio.open)
+
+
+def invalidate(path_prefix):
+    pool.invalidate(path_prefix)
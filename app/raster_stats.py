@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+import numpy as np
+from collections import OrderedDict
+from django.core.cache import cache
+from django.contrib.gis.geos import GEOSGeometry
+from rio_tiler.utils import has_alpha_band
+from rio_tiler.utils import _stats as raster_stats
+from rio_tiler.models import ImageStatistics
+from rio_tiler.models import Metadata as RioMetadata
+from app import raster_pool
+from app.api.formulas import lookup_formula, get_algorithm_list, get_auto_bands
+from webodm import settings
+
+logger = logging.getLogger('app.logger')
+
+STATS_FILE = "raster_stats.json"
+RASTER_ASSETS = ['orthophoto', 'dsm', 'dtm']
+CACHE_KEY_PREFIX = 'raster_metadata_'
+
+# Metadata computed for ad-hoc areas (crops, boundaries) is memoized
+# in memory (LRU) and in the shared Django cache, both with a TTL
+_memo_lock = threading.Lock()
+_memo = OrderedDict() # key --> (expiration time, JSON metadata)
+
+
+def compute_metadata(src, asset_type, expr=None, hrange=None, bounds=None, vrt_options=None, pmin=2.0, pmax=98.0):
+    """
+    Compute statistics and histograms for a raster
+    :param src: COGReader
+    :param asset_type: one of orthophoto, dsm, dtm
+    :param expr: band expression (optional)
+    :param hrange: histogram range (optional)
+    :return: metadata dictionary
+    """
+    nodata = None
+    # Workaround for https://github.com/WebODM/WebODM/issues/894
+    if asset_type == 'orthophoto':
+        nodata = 0
+
+    if expr is not None:
+        data, mask = src.preview(expression=expr, vrt_options=vrt_options)
+        data = np.ma.array(data)
+        data.mask = mask == 0
+        stats = {
+            str(b + 1): raster_stats(data[b], percentiles=(pmin, pmax), bins=255, range=hrange)
+            for b in range(data.shape[0])
+        }
+        stats = {b: ImageStatistics(**s) for b, s in stats.items()}
+        metadata = RioMetadata(statistics=stats, **src.info().dict())
+    else:
+        metadata = src.metadata(pmin=pmin, pmax=pmax, hist_options={"bins": 255, "range": hrange}, nodata=nodata,
+                                bounds=bounds, vrt_options=vrt_options)
+
+    return json.loads(metadata.json())
+
+
+def get_stats_path(task):
+    return task.data_path(STATS_FILE)
+
+
+def get_entry_key(expr, hrange):
+    return "{}|{}".format(expr or "", ",".join(map(str, hrange)) if hrange is not None else "")
+
+
+def get_asset_signature(path):
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def read_stats(task):
+    try:
+        with open(get_stats_path(task), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_stats(task, stats):
+    stats_path = get_stats_path(task)
+    os.makedirs(os.path.dirname(stats_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(stats_path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(stats, f)
+        os.replace(tmp_path, stats_path)
+    except:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def get(task, asset_type, expr=None, hrange=None):
+    """
+    Lookup precomputed statistics for a task's raster asset
+    :return: metadata dictionary or None if not available (or out of date)
+    """
+    raster_path = task.get_asset_download_path(asset_type + ".tif")
+    try:
+        signature = get_asset_signature(raster_path)
+    except FileNotFoundError:
+        return None
+
+    asset_stats = read_stats(task).get(asset_type)
+    if asset_stats is None or asset_stats.get('signature') != signature:
+        return None
+
+    return asset_stats['entries'].get(get_entry_key(expr, hrange))
+
+
+def put(task, asset_type, entries):
+    """
+    Store statistics for a task's raster asset
+    :param entries: dictionary of (expr, hrange) --> metadata dictionary
+    """
+    raster_path = task.get_asset_download_path(asset_type + ".tif")
+    signature = get_asset_signature(raster_path)
+
+    stats = read_stats(task)
+    asset_stats = stats.get(asset_type)
+    if asset_stats is None or asset_stats.get('signature') != signature:
+        asset_stats = {'signature': signature, 'entries': {}}
+
+    for (expr, hrange), metadata in entries.items():
+        asset_stats['entries'][get_entry_key(expr, hrange)] = metadata
+
+    stats[asset_type] = asset_stats
+    write_stats(task, stats)
+
+
+def get_vrt_options(task, asset_type):
+    # WarpedVRT is really slow with compound CRSes
+    # so we override the CRS to the 2D version for speed
+    if asset_type in ['dsm', 'dtm'] and task.epsg is not None:
+        return {'src_crs': f"EPSG:{task.epsg}"}
+
+
+def generate(task):
+    """
+    Compute statistics for all raster assets of a task, including
+    the built-in formulas that apply to the orthophoto bands
+    """
+    for asset_type in RASTER_ASSETS:
+        raster_path = task.get_asset_download_path(asset_type + ".tif")
+        if not os.path.isfile(raster_path):
+            continue
+
+        try:
+            entries = {}
+            vrt_options = get_vrt_options(task, asset_type)
+
+            with raster_pool.open_cog(raster_path) as src:
+                entries[(None, None)] = compute_metadata(src, asset_type, vrt_options=vrt_options)
+
+                if asset_type == 'orthophoto':
+                    band_count = src.dataset.meta['count']
+                    if has_alpha_band(src.dataset):
+                        band_count -= 1
+
+                    for algo in get_algorithm_list(band_count):
+                        try:
+                            bands, _ = get_auto_bands(task.orthophoto_bands, algo['id'])
+                            expr, hrange = lookup_formula(algo['id'], bands)
+                            if (expr, hrange) not in entries:
+                                entries[(expr, hrange)] = compute_metadata(src, asset_type, expr, hrange, vrt_options=vrt_options)
+                        except (ValueError, IndexError) as e:
+                            logger.warning("Cannot compute {} statistics for {}: {}".format(algo['id'], task, str(e)))
+
+            put(task, asset_type, entries)
+            logger.info("Computed {} {} statistics for {}".format(len(entries), asset_type, task))
+        except Exception as e:
+            logger.warning("Cannot compute {} statistics for {}: {}".format(asset_type, task, str(e)))
+
+
+def normalize_geometry(geometry):
+    """
+    :param geometry: GEOSGeometry or GeoJSON geometry/feature dictionary
+    :return: normalized WKT representation of the geometry, so that
+        equivalent geometries produce the same cache key
+    """
+    if isinstance(geometry, dict):
+        geometry = GEOSGeometry(json.dumps(geometry.get('geometry', geometry)))
+    else:
+        geometry = geometry.clone()
+    geometry.normalize()
+    return geometry.wkt
+
+
+def get_cache_key(task, asset_type, expr, hrange, geometry):
+    """
+    Compute a cache key for metadata restricted to a geometry
+    :return: cache key (string) or None if the asset cannot be found
+    """
+    raster_path = task.get_asset_download_path(asset_type + ".tif")
+    try:
+        signature = get_asset_signature(raster_path)
+    except FileNotFoundError:
+        return None
+
+    payload = json.dumps([str(task.id), asset_type, signature, get_entry_key(expr, hrange), normalize_geometry(geometry)])
+    return CACHE_KEY_PREFIX + hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def cache_get(key):
+    """
+    :return: memoized metadata dictionary or None
+    """
+    if key is None or settings.METADATA_CACHE_TTL <= 0:
+        return None
+
+    now = time.time()
+    with _memo_lock:
+        entry = _memo.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > now:
+                _memo.move_to_end(key)
+                return json.loads(value)
+            else:
+                del _memo[key]
+
+    value = cache.get(key)
+    if value is not None:
+        _memo_set(key, value)
+        return json.loads(value)
+
+
+def cache_set(key, metadata):
+    if key is None or settings.METADATA_CACHE_TTL <= 0:
+        return
+
+    value = json.dumps(metadata)
+    _memo_set(key, value)
+    cache.set(key, value, settings.METADATA_CACHE_TTL)
+
+
+def _memo_set(key, value):
+    with _memo_lock:
+        _memo[key] = (time.time() + settings.METADATA_CACHE_TTL, value)
+        _memo.move_to_end(key)
+        while len(_memo) > settings.METADATA_CACHE_MAX_ENTRIES:
+            _memo.popitem(last=False)
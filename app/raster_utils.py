@@ -7,28 +7,52 @@ import numpy as np
 import numexpr as ne
 import json
 import time
+import threading
+import xml.etree.ElementTree as ET
+from bisect import bisect_right
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import ExitStack
 from django.contrib.gis.geos import GEOSGeometry
-from rasterio.enums import ColorInterp
+from rasterio.enums import ColorInterp, Resampling
+from rasterio.crs import CRS
+from affine import Affine
+from rasterio.features import geometry_mask, bounds as featureBounds
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform, transform_geom
 from rasterio.windows import Window
 from rio_tiler.utils import has_alpha_band, linear_rescale
-from rio_tiler.colormap import cmap as colormap, apply_cmap
+from app.api.colormaps import get_lut, apply_lut
 from rio_tiler.errors import InvalidColorMapName
-from app.api.hsvblend import hsv_blend
-from app.api.hillshade import LightSource
-from rio_tiler.io import COGReader
+from app.api.shaded_relief import shaded_relief
+from app import raster_pool
+from app.raster_stats import compute_metadata
 from webodm import settings
 
 logger = logging.getLogger('app.logger')
 
 ZOOM_EXTRA_LEVELS = 3
 
+# Compression methods of Cloud Optimized GeoTIFF exports
+COG_COMPRESSION = {
+    'elevation': ['DEFLATE', 'ZSTD', 'LERC'], # and other float rasters (band math)
+    'imagery': ['DEFLATE', 'ZSTD', 'JPEG', 'WEBP'] # JPEG, WEBP require 8-bit RGB(A)
+}
+
 def extension_for_export_format(export_format):
     extensions = {
         'gtiff': 'tif',
         'gtiff-rgb': 'tif',
+        'cog': 'tif',
     }
     return extensions.get(export_format, export_format)
 
+def cog_compression_options(asset_type, expression=None):
+    if asset_type in ['dsm', 'dtm'] or expression is not None:
+        return COG_COMPRESSION['elevation']
+    else:
+        return COG_COMPRESSION['imagery']
+
 # Based on https://github.com/uav4geo/GeoDeep/blob/main/geodeep/slidingwindow.py
 def compute_subwindows(window, max_window_size, overlap_pixels=0):
     col_off = int(window.col_off)
@@ -72,22 +96,286 @@ def compute_subwindows(window, max_window_size, overlap_pixels=0):
 
     return windows
 
-def compute_block_aligned_subwindows(src, win):
+def compute_block_aligned_subwindows(src, win, window_size=512, max_width=2048):
+    """
+    Plan windows that are aligned to the block layout of a raster, so that
+    each block is read (and decompressed) only once. Adjacent blocks are
+    batched into strips of up to max_width pixels, about window_size pixels tall.
+    The strip grid starts at the block boundary before win, the first and last
+    strips of each row and column are clipped to win.
+    :return: list of (window, destination window) tuples, in row-major order
+    """
+    block_height, block_width = src.block_shapes[0]
+    col_off = int(win.col_off)
+    row_off = int(win.row_off)
+    width = int(win.width)
+    height = int(win.height)
+
+    strip_width = max(block_width, max_width // block_width * block_width)
+    strip_height = max(block_height, window_size // block_height * block_height)
+    grid_col_off = col_off // block_width * block_width
+    grid_row_off = row_off // block_height * block_height
+
     subwins = []
-    for _, w in src.block_windows(1):
-        dst_w = Window(
-            w.col_off - win.col_off, 
-            w.row_off - win.row_off, 
-            w.width, 
-            w.height
-        )
-        subwins.append([w, dst_w])
-    
+    for gy in range(grid_row_off, row_off + height, strip_height):
+        y = max(gy, row_off)
+        h = min(gy + strip_height, row_off + height) - y
+        for gx in range(grid_col_off, col_off + width, strip_width):
+            x = max(gx, col_off)
+            w = Window(x, y, min(gx + strip_width, col_off + width) - x, h)
+            dst_w = Window(x - col_off, y - row_off, w.width, w.height)
+            subwins.append((w, dst_w))
+
     return subwins
 
+class WindowCache:
+    """
+    Keeps the most recently read windows of a window grid (as planned by
+    compute_block_aligned_subwindows) in memory, so that padded reads reuse
+    the data of neighboring windows instead of reading it again.
+    Can be used from multiple threads.
+    """
+    def __init__(self, subwins, read, capacity):
+        self.windows = [w for w, _ in subwins]
+        self.read = read
+        self.capacity = capacity
+
+        # Grid lines (the first and last windows can be smaller than the others)
+        first = self.windows[0]
+        self.col_offs = [int(w.col_off) for w in self.windows if w.row_off == first.row_off]
+        self.columns = len(self.col_offs)
+        self.row_offs = [int(w.row_off) for w in self.windows[::self.columns]]
+        self.rows = len(self.row_offs)
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # window index --> Future
+
+    def get(self, index):
+        with self.lock:
+            future = self.entries.get(index)
+            owner = future is None
+            if owner:
+                future = self.entries[index] = Future()
+            self.entries.move_to_end(index)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+        # Read outside of the lock, other threads
+        # wait for the result if they need the same window
+        if owner:
+            try:
+                future.set_result(self.read(self.windows[index]))
+            except Exception as e:
+                future.set_exception(e)
+
+        return future.result()
+
+    def read_padded(self, window, pad, fill_value):
+        """
+        :return: data of window with pad pixels on each side. Areas outside
+            of the raster are set to fill_value.
+        """
+        col0 = int(window.col_off) - pad
+        row0 = int(window.row_off) - pad
+        width = int(window.width) + pad * 2
+        height = int(window.height) + pad * 2
+
+        first_col = max(0, bisect_right(self.col_offs, col0) - 1)
+        last_col = max(0, bisect_right(self.col_offs, col0 + width - 1) - 1)
+        first_row = max(0, bisect_right(self.row_offs, row0) - 1)
+        last_row = max(0, bisect_right(self.row_offs, row0 + height - 1) - 1)
+
+        out = None
+        for r in range(first_row, last_row + 1):
+            for c in range(first_col, last_col + 1):
+                index = r * self.columns + c
+                w = self.windows[index]
+                data = self.get(index)
+                if out is None:
+                    out = np.full((data.shape[0], height, width), fill_value, dtype=data.dtype)
+
+                c_start, c_end = max(col0, int(w.col_off)), min(col0 + width, int(w.col_off + w.width))
+                r_start, r_end = max(row0, int(w.row_off)), min(row0 + height, int(w.row_off + w.height))
+                if c_start < c_end and r_start < r_end:
+                    out[:, r_start - row0:r_end - row0, c_start - col0:c_end - col0] = \
+                        data[:, r_start - int(w.row_off):r_end - int(w.row_off), c_start - int(w.col_off):c_end - int(w.col_off)]
+
+        return out
+
 def padded_window(w, pad):
     return Window(w.col_off - pad, w.row_off - pad, w.width + pad * 2, w.height + pad * 2)
 
+def read_padded(ds, w, pad, fill_value, indexes=1):
+    """
+    Read a window with pad pixels on each side. Areas outside
+    of the dataset are set to fill_value (unlike boundless reads,
+    this also works with WarpedVRTs).
+    """
+    col0 = int(w.col_off) - pad
+    row0 = int(w.row_off) - pad
+    width = int(w.width) + pad * 2
+    height = int(w.height) + pad * 2
+
+    c_start, c_end = max(0, col0), min(ds.width, col0 + width)
+    r_start, r_end = max(0, row0), min(ds.height, row0 + height)
+    data = ds.read(indexes=indexes, window=Window(c_start, r_start, c_end - c_start, r_end - r_start))
+
+    out = np.full(data.shape[:-2] + (height, width), fill_value, dtype=data.dtype)
+    out[..., r_start - row0:r_end - row0, c_start - col0:c_end - col0] = data
+    return out
+
+def compute_crop_window(ds, geom):
+    """
+    :param geom: GeoJSON geometry in the CRS of ds
+    :return: smallest window of ds that contains geom
+    """
+    west, south, east, north = featureBounds(geom)
+    t = ds.transform
+    col_start = max(0, int(np.floor((west - t.c) / t.a)))
+    col_end = min(ds.width, int(np.ceil((east - t.c) / t.a)))
+    row_start = max(0, int(np.floor((north - t.f) / t.e)))
+    row_end = min(ds.height, int(np.ceil((south - t.f) / t.e)))
+
+    if col_start >= col_end or row_start >= row_end:
+        raise ValueError("The crop area does not overlap the raster")
+
+    return Window(col_start, row_start, col_end - col_start, row_end - row_start)
+
+def process_windows(windows, read, compute, write, threads=1):
+    """
+    Run read --> compute --> write for each window. Reads and computations
+    run in thread pools, while writes happen on the calling thread, in the
+    same order as windows. At most threads * 2 windows are in flight at any time,
+    which keeps memory usage bounded.
+    :param read: function(window) --> data
+    :param compute: function(window, data) --> result
+    :param write: function(window, result)
+    """
+    threads = max(1, threads)
+    if threads == 1:
+        for w in windows:
+            write(w, compute(w, read(w)))
+        return
+
+    with ThreadPoolExecutor(max_workers=threads) as readers, ThreadPoolExecutor(max_workers=threads) as workers:
+        pending = deque()
+
+        def submit(w):
+            read_future = readers.submit(read, w)
+            pending.append((w, workers.submit(lambda: compute(w, read_future.result()))))
+
+        for w in windows:
+            if len(pending) >= threads * 2:
+                done_w, future = pending.popleft()
+                write(done_w, future.result())
+            submit(w)
+
+        while len(pending) > 0:
+            done_w, future = pending.popleft()
+            write(done_w, future.result())
+
+def get_overview_factors(width, height, blocksize=512):
+    """
+    :return: decimation factors of the overviews of a raster, until
+        the smallest overview fits in a single block (like the GDAL COG driver)
+    """
+    factors = []
+    f = 2
+    while max(width, height) / (f // 2) > blocksize:
+        factors.append(f)
+        f *= 2
+    return factors
+
+class OverviewWriter:
+    """
+    Write the overviews of a raster from its windows, as they are computed,
+    into one file per overview level. Overviews are decimated
+    (nearest neighbor), like GDAL's NEAREST resampling.
+    """
+    def __init__(self, path_base, profile, blocksize=512):
+        self.levels = []
+        width, height = profile['width'], profile['height']
+
+        for f in get_overview_factors(width, height, blocksize):
+            level_profile = dict(profile,
+                                 driver='GTiff',
+                                 width=int(np.ceil(width / f)),
+                                 height=int(np.ceil(height / f)),
+                                 transform=profile['transform'] * Affine.scale(f),
+                                 tiled=True, blockxsize=blocksize, blockysize=blocksize,
+                                 compress='DEFLATE', zlevel=1, BIGTIFF='IF_SAFER')
+            level_profile.pop('jpeg_quality', None)
+            level_profile.pop('photometric', None)
+            path = "{}.ovr{}.tif".format(path_base, f)
+            self.levels.append((f, path, rasterio.open(path, 'w', **level_profile)))
+
+    @property
+    def paths(self):
+        return [path for _, path, _ in self.levels]
+
+    def write(self, arr, indexes, window):
+        col_off, row_off = int(window.col_off), int(window.row_off)
+
+        for f, _, dst in self.levels:
+            # Keep the pixels whose coordinates are multiples of f
+            r0 = (-row_off) % f
+            c0 = (-col_off) % f
+            data = arr[..., r0::f, c0::f]
+            if data.shape[-1] == 0 or data.shape[-2] == 0:
+                continue
+
+            dst.write(data, indexes=indexes, window=Window((col_off + c0) // f, (row_off + r0) // f,
+                                                           data.shape[-1], data.shape[-2]))
+
+    def close(self):
+        for _, _, dst in self.levels:
+            dst.close()
+
+    def remove(self):
+        self.close()
+        for path in self.paths:
+            if os.path.isfile(path):
+                os.unlink(path)
+
+def write_cog(input, overview_paths, output, compress='DEFLATE', threads=1, blocksize=512):
+    """
+    Copy a GeoTIFF and its precomputed overviews (one file per level)
+    into a Cloud Optimized GeoTIFF, without recomputing the overviews
+    """
+    vrt = input + ".vrt"
+    try:
+        subprocess.check_output(["gdal_translate", "-of", "VRT", input, vrt])
+
+        tree = ET.parse(vrt)
+        for band in tree.getroot().findall('VRTRasterBand'):
+            for path in overview_paths:
+                overview = ET.SubElement(band, 'Overview')
+                ET.SubElement(overview, 'SourceFilename', relativeToVRT="0").text = path
+                ET.SubElement(overview, 'SourceBand').text = band.get('band')
+        tree.write(vrt)
+
+        args = ["-of", "COG",
+                "-co", "BLOCKSIZE={}".format(blocksize),
+                "-co", "COMPRESS={}".format(compress),
+                "-co", "OVERVIEWS=FORCE_USE_EXISTING",
+                "-co", "BIGTIFF=IF_SAFER",
+                "-co", "NUM_THREADS={}".format(max(1, threads))]
+        if compress in ['JPEG', 'WEBP']:
+            args += ["-co", "QUALITY=90"]
+        elif compress in ['DEFLATE', 'ZSTD']:
+            args += ["-co", "PREDICTOR=YES"]
+
+        subprocess.check_output(["gdal_translate"] + args + [vrt, output])
+    finally:
+        if os.path.isfile(vrt):
+            os.unlink(vrt)
+
+def cache_capacity(subwins, threads):
+    # Windows are processed in row-major order: keep the current
+    # and next row of windows, plus the windows in flight
+    columns = sum(1 for w, _ in subwins if w.row_off == subwins[0][0].row_off)
+    return columns * 2 + max(1, threads) * 4 + 2
+
 def export_raster(input, output, progress_callback=None, **opts):
     now = time.time()
 
@@ -116,6 +404,8 @@ def export_raster(input, output, progress_callback=None, **opts):
     asset_type = opts.get('asset_type')
     name = opts.get('name', 'raster') # KMZ specific
     crop_wkt = opts.get('crop')
+    threads = opts.get('threads', settings.WORKERS_MAX_THREADS)
+    window_planner = opts.get('window_planner', 'blocks') # or 'fixed'
 
     dem = asset_type in ['dsm', 'dtm']
     path_base, _ = os.path.splitext(output)
@@ -123,29 +413,64 @@ def export_raster(input, output, progress_callback=None, **opts):
     if dem:
         resampling = 'bilinear'
 
-    if crop_wkt is not None:
-        crop = GEOSGeometry(crop_wkt)
+    crop = GEOSGeometry(crop_wkt) if crop_wkt is not None else None
 
-        crop_geojson = os.path.join(path_base, "crop.geojson")
-        raster_vrt = os.path.join(path_base, "raster.vrt")
+    # Datasets cannot be shared between threads, so each
+    # thread opens its own handles (closed at the end)
+    handles = []
+    handles_lock = threading.Lock()
 
-        os.makedirs(os.path.dirname(crop_geojson), exist_ok=True)
-        with open(crop_geojson, "w", encoding="utf-8") as f:
-            f.write(crop.geojson)
+    def close_handles():
+        # WarpedVRTs are opened after their datasets
+        for handle in reversed(handles):
+            handle.close()
 
-        subprocess.check_output(["gdalwarp", "-cutline", crop_geojson,
-                '--config', 'GDALWARP_DENSIFY_CUTLINE', 'NO', 
-                '-crop_to_cutline', '-of', 'VRT', '-r', resampling,
-                 input, raster_vrt])
-
-        input = raster_vrt
-    
-    with COGReader(input) as ds_src:
+    with raster_pool.open_cog(input) as ds_src, ExitStack() as cleanup:
+        cleanup.callback(close_handles)
         src = ds_src.dataset
-        profile = src.meta.copy()
-        units = ds_src.dataset.units
-        win = Window(0, 0, src.width, src.height)
-            
+        units = src.units
+        reproject = src.crs is not None and ((epsg is not None and src.crs.to_epsg() != epsg) or proj is not None)
+
+        # Reprojection happens while reading, through a WarpedVRT
+        # with the same grid as gdalwarp
+        vrt_options = None
+        if reproject:
+            dst_crs = CRS.from_epsg(epsg) if epsg is not None else CRS.from_string(proj)
+            transform, width, height = calculate_default_transform(src.crs, dst_crs, src.width, src.height, *src.bounds)
+            vrt_options = {
+                'crs': dst_crs,
+                'transform': transform,
+                'width': width,
+                'height': height,
+                'resampling': Resampling[resampling]
+            }
+
+        def open_dataset(ds):
+            if vrt_options is not None:
+                ds = WarpedVRT(ds, **vrt_options)
+                with handles_lock:
+                    handles.append(ds)
+            return ds
+
+        ds = open_dataset(src)
+        profile = ds.meta.copy()
+        win = Window(0, 0, ds.width, ds.height)
+
+        # Crops are applied while reading, by masking
+        # the pixels outside of the crop area
+        crop_geom = None
+        crop_fill = ds.nodata if ds.nodata is not None else 0
+        if crop is not None:
+            crop_geom = transform_geom('EPSG:4326', ds.crs, json.loads(crop.geojson))
+            win = compute_crop_window(ds, crop_geom)
+            profile.update(transform=ds.window_transform(win), width=int(win.width), height=int(win.height))
+
+        def mask_crop(w, data):
+            if crop_geom is not None:
+                inside = geometry_mask([crop_geom], out_shape=data.shape[-2:], transform=ds.window_transform(w), invert=True)
+                data[..., ~inside] = crop_fill
+            return data
+
         # Output format
         driver = "GTiff"
         compress = None
@@ -156,7 +481,6 @@ def export_raster(input, output, progress_callback=None, **opts):
         indexes = src.indexes
         output_raster = output
         jpg_background = 255 # white
-        reproject = src.crs is not None and ((epsg is not None and src.crs.to_epsg() != epsg) or proj is not None)
 
         # KMZ is special, we just export it as GeoTIFF
         # and then call GDAL to tile/package it
@@ -165,21 +489,26 @@ def export_raster(input, output, progress_callback=None, **opts):
             export_format = "gtiff-rgb"
             output_raster = path_base + ".kmz.tif"
 
-        # JPG and PNG are exported to GeoTIFF only if reprojection is needed
+        # COGs are exported as GeoTIFF, writing their overviews
+        # along the way, then copied into the COG layout
+        cog = export_format == "cog"
+        overviews = None
+        if cog:
+            export_format = "gtiff"
+            output_raster = path_base + ".cog.tif"
+            cog_compress = (opts.get('compress') or 'DEFLATE').upper()
+
+            def remove_cog_files():
+                if overviews is not None:
+                    overviews.remove()
+                if os.path.isfile(output_raster):
+                    os.unlink(output_raster)
+            cleanup.callback(remove_cog_files)
+
         jpg = export_format == "jpg"
-        png = export_format == "png"
-        if reproject:
-            if jpg:
-                export_format = 'gtiff-rgb'
-                path_base, _ = os.path.splitext(output)
-                output_raster = path_base + ".jpg.tif"
-            if png:
-                export_format = 'gtiff-rgb'
-                path_base, _ = os.path.splitext(output)
-                output_raster = path_base + ".png.tif"
 
         JPEG_PX_LIMIT = 65000 # Due to 16bit fields for w,h in JPEG standard
-        if jpg and (src.width > JPEG_PX_LIMIT or src.height > JPEG_PX_LIMIT):
+        if jpg and (win.width > JPEG_PX_LIMIT or win.height > JPEG_PX_LIMIT):
             raise Exception(f"Image is too large (> {JPEG_PX_LIMIT}px) for JPEG. Use TIFF (RGB) instead.")
 
         if export_format == "jpg":
@@ -209,20 +538,16 @@ def export_raster(input, output, progress_callback=None, **opts):
         if bigtiff:
             profile.update(BIGTIFF='IF_SAFER')
 
-        if reproject:
-            path_base, _ = os.path.splitext(output_raster)
-            output_raster = path_base + ".base.tif"
+        if driver == "GTiff" and (reproject or cog):
+            profile.update(tiled=True, blockxsize=512, blockysize=512)
 
-        if compress is not None and not reproject:
+        if compress is not None:
             profile.update(compress=compress)
             profile.update(predictor=2 if compress == "DEFLATE" else 1)
 
         if rgb and rescale is None:
             # Compute min max
-            nodata = None
-            if asset_type == 'orthophoto':
-                nodata = 0
-            md = ds_src.metadata(pmin=2.0, pmax=98.0, hist_options={"bins": 255}, nodata=nodata)
+            md = compute_metadata(ds_src, asset_type, bounds=crop.extent if crop is not None else None)
             rescale = [md['statistics']['1']['min'], md['statistics']['1']['max']]
 
         ci = src.colorinterp
@@ -230,8 +555,10 @@ def export_raster(input, output, progress_callback=None, **opts):
         if has_alpha_band(src):
             alpha_index = src.colorinterp.index(ColorInterp.alpha) + 1
         
-        subwins = compute_subwindows(win, window_size)
-        # subwins = compute_block_aligned_subwindows(src, win)
+        if window_planner == 'fixed':
+            subwins = compute_subwindows(win, window_size)
+        else:
+            subwins = compute_block_aligned_subwindows(ds, win, window_size)
 
         if rgb and expression is None:
             # More than 4 bands?
@@ -257,7 +584,8 @@ def export_raster(input, output, progress_callback=None, **opts):
         cmap = None
         if color_map:
             try:
-                cmap = colormap.get(color_map)
+                get_lut(color_map)
+                cmap = color_map
             except InvalidColorMapName:
                 logger.warning("Invalid colormap {}".format(color_map))
 
@@ -302,10 +630,41 @@ def export_raster(input, output, progress_callback=None, **opts):
             profile.update(nodata=None)
 
         
-        post_perc = 20 if reproject or kmz else 0
+        post_perc = 20 if kmz or cog else 0
         num_wins = len(subwins)
         progress_per_win = (100 - post_perc) / num_wins if num_wins > 0 else 0
 
+        local = threading.local()
+
+        def reader():
+            thread_ds = getattr(local, 'ds', None)
+            if thread_ds is None:
+                thread_ds = rasterio.open(input)
+                with handles_lock:
+                    handles.append(thread_ds)
+                thread_ds = local.ds = open_dataset(thread_ds)
+            return thread_ds
+
+        written = 0
+
+        def window_writer(dst):
+            nonlocal overviews
+            if cog:
+                if cog_compress in ['JPEG', 'WEBP'] and (dst.count not in [3, 4] or dst.dtypes[0] != 'uint8'):
+                    raise ValueError("{} compression requires an 8-bit RGB raster".format(cog_compress))
+                overviews = OverviewWriter(path_base, dst.profile)
+
+            # Results are lists of (array, band indexes) tuples
+            def write(win, result):
+                nonlocal written
+                written += 1
+                p(f"Processing tile {written}/{num_wins}", progress_per_win)
+                for arr, band_indexes in result:
+                    dst.write(arr, indexes=band_indexes, window=win[1])
+                    if overviews is not None:
+                        overviews.write(arr, band_indexes, win[1])
+            return write
+
         if expression is not None:
             # Apply band math
             if rgb:
@@ -320,110 +679,119 @@ def export_raster(input, output, progress_callback=None, **opts):
             if alpha_index is not None:
                 indexes += (alpha_index, )
 
+            def read(win):
+                return mask_crop(win[0], reader().read(indexes=indexes, window=win[0], out_dtype=np.float32))
+
+            def compute(win, data):
+                arr = dict(zip(bands_names, data))
+                arr = np.array([np.nan_to_num(ne.evaluate(bloc.strip(), local_dict=arr)) for bloc in rgb_expr])
+
+                # Set nodata values
+                index_band = arr[0]
+                mask = None
+                if alpha_index is not None:
+                    # -1 is the last band = alpha
+                    mask = data[-1] != 0
+                    index_band[~mask] = -9999
+
+                # Remove infinity values
+                index_band[index_band>1e+30] = -9999
+                index_band[index_band<-1e+30] = -9999
+
+                # Make sure this is float32
+                arr = arr.astype(np.float32)
+
+                # Apply colormap?
+                if rgb and cmap is not None:
+                    rgb_data, _ = apply_lut(process(arr, skip_background=True, includes_alpha=False), cmap)
+                    result = [(process(rgb_data, skip_rescale=True, mask=mask, includes_alpha=False), (1,2,3))]
+                    if with_alpha:
+                        result.append((mask.astype(np.uint8) * 255, 4))
+                    return result
+                else:
+                    # Raw
+                    return [(process(arr), None)]
+
             with rasterio.open(output_raster, 'w', **profile) as dst:
-                for idx, (w, dst_w) in enumerate(subwins):
-                    p(f"Processing tile {idx}/{num_wins}", progress_per_win)
-
-                    data = src.read(indexes=indexes, window=w, out_dtype=np.float32)
-                    arr = dict(zip(bands_names, data))
-                    arr = np.array([np.nan_to_num(ne.evaluate(bloc.strip(), local_dict=arr)) for bloc in rgb_expr])
-
-                    # Set nodata values
-                    index_band = arr[0]
-                    mask = None
-                    if alpha_index is not None:
-                        # -1 is the last band = alpha
-                        mask = data[-1] != 0
-                        index_band[~mask] = -9999
-
-                    # Remove infinity values
-                    index_band[index_band>1e+30] = -9999
-                    index_band[index_band<-1e+30] = -9999
-
-                    # Make sure this is float32
-                    arr = arr.astype(np.float32)
-
-                    # Apply colormap?
-                    if rgb and cmap is not None:
-                        rgb_data, _ = apply_cmap(process(arr, skip_background=True, includes_alpha=False), cmap)
-                        dst.write(process(rgb_data, skip_rescale=True, mask=mask, includes_alpha=False), window=dst_w, indexes=(1,2,3))
-
-                        if with_alpha:
-                            dst.write(mask.astype(np.uint8) * 255, 4, window=dst_w)
-
-                        update_rgb_colorinterp(dst)
-                    else:
-                        # Raw
-                        dst.write(process(arr), window=dst_w) 
+                process_windows(subwins, read, compute, window_writer(dst), threads)
+                if rgb and cmap is not None:
+                    update_rgb_colorinterp(dst)
         elif dem:
             # Apply hillshading, colormaps to elevation
+            nodata = profile.get('nodata')
+            if nodata is None:
+                nodata = -9999
+            pad = 16
+            delta_scale = ZOOM_EXTRA_LEVELS ** 2
+            # Reprojection keeps about the same number of pixels,
+            # so the source pixel size is used for shading
+            dx = src.meta["transform"][0] * delta_scale
+            dy = src.meta["transform"][4] * delta_scale
+
+            # Block aligned windows share their padding with their
+            # neighbors, so it's read from a cache instead of the raster
+            cache = None
+            if window_planner != 'fixed' and len(subwins) > 0:
+                cache = WindowCache(subwins, lambda w: mask_crop(w, reader().read(indexes=[1], window=w)),
+                                    capacity=cache_capacity(subwins, threads))
+
+            def read(win):
+                if rgb and cmap is not None:
+                    if cache is not None:
+                        return cache.read_padded(win[0], pad, nodata)[0]
+
+                    return mask_crop(padded_window(win[0], pad), read_padded(reader(), win[0], pad, nodata))
+                else:
+                    return mask_crop(win[0], reader().read(window=win[0])[:1])
+
+            def compute(win, data):
+                # Apply colormap?
+                if rgb and cmap is not None:
+                    height, width = int(win[0].height), int(win[0].width)
+                    elevation = data
+                    elevation[0:pad, 0:pad] = nodata
+                    elevation[pad+height:pad*2+height, 0:pad] = nodata
+                    elevation[0:pad, pad+width:pad*2+width] = nodata
+                    elevation[pad+height:pad*2+height, pad+width:pad*2+width] = nodata
+
+                    mask = elevation != nodata
+
+                    rgb_data, _ = apply_lut(process(elevation[pad:height+pad, pad:width+pad][np.newaxis,:], skip_background=True, includes_alpha=False), cmap)
+
+                    if hillshade is not None and hillshade > 0:
+                        rgb_data = shaded_relief(rgb_data, elevation, dx, dy, vert_exag=hillshade, pad=pad)
+
+                    mask = mask[pad:height+pad, pad:width+pad]
+                    result = [(process(rgb_data, skip_rescale=True, mask=mask, includes_alpha=False), (1,2,3))]
+                    if with_alpha:
+                        result.append((mask.astype(np.uint8) * 255, 4))
+                    return result
+                else:
+                    # Raw
+                    return [(process(data), None)]
+
             with rasterio.open(output_raster, 'w', **profile) as dst:
                 # Copy units information
                 if export_format == "gtiff" and not rgb and len(units) == len(dst.units):
                     dst.units = units
 
-                for idx, (w, dst_w) in enumerate(subwins):
-                    p(f"Processing tile {idx}/{num_wins}", progress_per_win)
-
-                    # Apply colormap?
-                    if rgb and cmap is not None:
-                        nodata = profile.get('nodata')
-                        if nodata is None:
-                            nodata = -9999
-
-                        pad = 16
-                        elevation = src.read(window=padded_window(w, pad), boundless=True, fill_value=nodata, out_shape=(
-                            1,
-                            window_size + pad * 2,
-                            window_size + pad * 2,
-                        ), resampling=rasterio.enums.Resampling.bilinear)[:1][0]
-
-                        elevation[0:pad, 0:pad] = nodata
-                        elevation[pad+window_size:pad*2+window_size, 0:pad] = nodata
-                        elevation[0:pad, pad+window_size:pad*2+window_size] = nodata
-                        elevation[pad+window_size:pad*2+window_size, pad+window_size:pad*2+window_size] = nodata
-
-                        mask = elevation != nodata
-
-                        intensity = None
-                        if hillshade is not None and hillshade > 0:
-                            delta_scale = ZOOM_EXTRA_LEVELS ** 2
-                            dx = src.meta["transform"][0] * delta_scale
-                            dy = src.meta["transform"][4] * delta_scale
-                            ls = LightSource(azdeg=315, altdeg=45)
-
-                            intensity = ls.hillshade(elevation, dx=dx, dy=dy, vert_exag=hillshade)
-                            intensity = intensity[pad:pad+window_size, pad:pad+window_size]
-                            intensity = intensity * 255.0
-
-                        rgb_data, _ = apply_cmap(process(elevation[pad:window_size+pad, pad:window_size+pad][np.newaxis,:], skip_background=True, includes_alpha=False), cmap)
-
-                        if intensity is not None:
-                            rgb_data = hsv_blend(rgb_data, intensity)
-                        
-                        mask = mask[pad:window_size+pad, pad:window_size+pad]
-                        dst.write(process(rgb_data, skip_rescale=True, mask=mask, includes_alpha=False), window=dst_w, indexes=(1,2,3))
-                        if with_alpha:
-                            dst.write(mask.astype(np.uint8) * 255, 4, window=dst_w)
-
-                        update_rgb_colorinterp(dst)
-                    else:
-                        # Raw
-                        arr = src.read(window=w)[:1]
-                        dst.write(process(arr), window=dst_w)
+                process_windows(subwins, read, compute, window_writer(dst), threads)
+                if rgb and cmap is not None:
+                    update_rgb_colorinterp(dst)
         else:
             # Copy bands as-is
-            with rasterio.open(output_raster, 'w', **profile) as dst:
-                for idx, (w, dst_w) in enumerate(subwins):
-                    p(f"Processing tile {idx}/{num_wins}", progress_per_win)
+            def read(win):
+                return mask_crop(win[0], reader().read(indexes=indexes, window=win[0]))
 
-                    arr = src.read(indexes=indexes, window=w)
-                    dst.write(process(arr, drop_last_band=not with_alpha), window=dst_w)
+            def compute(win, data):
+                return [(process(data, drop_last_band=not with_alpha), None)]
+
+            with rasterio.open(output_raster, 'w', **profile) as dst:
+                process_windows(subwins, read, compute, window_writer(dst), threads)
 
                 new_ci = [src.colorinterp[idx - 1] for idx in indexes]
                 if not with_alpha:
                     new_ci = [ci for ci in new_ci if ci != ColorInterp.alpha]
-                    
                 dst.colorinterp = new_ci
         
         if kmz:
@@ -431,41 +799,11 @@ def export_raster(input, output, progress_callback=None, **opts):
                                         "-co", "Name={}".format(name),
                                         "-co", "FORMAT=AUTO", output_raster, output])
             p("Finalizing", post_perc)
-
-        elif reproject:
-            output_vrt = path_base + ".vrt"
-
-            if epsg is not None:
-                t_srs = f"EPSG:{epsg}"
-            elif proj is not None:
-                t_srs = proj
-
-            subprocess.check_output(["gdalwarp", "-r", "near" if resampling == "nearest" else resampling, 
-                                    "-of", "VRT",
-                                    "-t_srs", t_srs,
-                                    output_raster, output_vrt])
-            gt_args = ["-r", resampling, "--config", "GDAL_CACHEMAX", "25%"]
-            if bigtiff and not jpg and not png:
-                gt_args += ["-co", "BIGTIFF=IF_SAFER", 
-                            "-co", "BLOCKXSIZE=512", 
-                            "-co", "BLOCKYSIZE=512", 
-                            "-co", "NUM_THREADS=%s" % settings.WORKERS_MAX_THREADS,]
-
-            if compress and not png:
-                if jpg:
-                    gt_args += ["-co", "QUALITY=90"]
-                else:
-                    gt_args += ["-co", f"COMPRESS={compress}", 
-                                "-co", "PREDICTOR=2"]
-
-            subprocess.check_output(["gdal_translate"] +  
-                                    gt_args +
-                                    [output_vrt, output])
-            
-            if os.path.isfile(output_raster):
-                os.unlink(output_raster)
-
+        elif cog:
+            overviews.close()
+            write_cog(output_raster, overviews.paths, output, cog_compress, threads)
             p("Finalizing", post_perc)
+
             
         logger.info(f"Exported {output} in {round(time.time() - now, 2)}s")
         
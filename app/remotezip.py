@@ -0,0 +1,476 @@
+import io
+import os
+import re
+import json
+import time
+import zlib
+import struct
+import logging
+import zipfile
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from django.core.exceptions import SuspiciousFileOperation
+from app.security import path_traversal_check
+
+logger = logging.getLogger('app.logger')
+
+# Read-ahead used when reading the central directory
+READ_BLOCK_SIZE = 1024 * 1024
+
+# Size of the chunks that are decompressed and written at once
+CHUNK_SIZE = 1024 * 1024
+
+# Number of times a member is downloaded again
+# if it's corrupted or its download fails
+MAX_RETRIES = 4
+
+# Size of the chunks of resumable downloads
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Minimum number of seconds between writes of the state of resumable downloads
+STATE_SAVE_INTERVAL = 2
+
+# Local file header (zipfile.structFileHeader)
+LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+LOCAL_HEADER_SIGNATURE = b"PK\003\004"
+
+
+class RangeRequestsNotSupported(Exception):
+    pass
+
+
+class IncompleteChunk(Exception):
+    pass
+
+
+def is_transient_error(e):
+    """
+    :return: True if a request that failed with e might succeed if attempted again
+    """
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and e.response.status_code >= 500
+    return isinstance(e, (IncompleteChunk, requests.exceptions.ConnectionError,
+                          requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError))
+
+
+def get_range(session, url, start, end, timeout=None, stream=False):
+    """
+    Request bytes start-end (inclusive) of url
+    :return: requests response
+    """
+    res = session.get(url, headers={'Range': 'bytes={}-{}'.format(start, end)}, stream=stream, timeout=timeout)
+    if res.status_code != 206:
+        res.close()
+        if res.status_code == 200:
+            raise RangeRequestsNotSupported("Range requests are not supported by {}".format(url))
+        res.raise_for_status()
+        raise RangeRequestsNotSupported("Unexpected status code {}".format(res.status_code))
+    return res
+
+
+class HttpRangeFile(io.RawIOBase):
+    """
+    Read-only, seekable file backed by HTTP range requests
+    """
+    def __init__(self, session, url, timeout=None):
+        self.session = session
+        self.url = url
+        self.timeout = timeout
+        self.pos = 0
+
+        res = get_range(session, url, 0, 0, timeout)
+        m = re.match(r"bytes\s+\d+-\d+/(\d+)", res.headers.get('Content-Range', ''))
+        if not m:
+            raise RangeRequestsNotSupported("Invalid Content-Range header")
+        self.size = int(m.group(1))
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = self.size + offset
+        else:
+            raise ValueError("Invalid whence")
+        return self.pos
+
+    def readinto(self, b):
+        if self.pos >= self.size or len(b) == 0:
+            return 0
+
+        end = min(self.size, self.pos + len(b)) - 1
+        data = get_range(self.session, self.url, self.pos, end, self.timeout).content
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+
+class StreamReader:
+    """
+    Read exact amounts of bytes from an iterator of chunks
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = b""
+
+    def read(self, n):
+        while len(self.buffer) < n:
+            chunk = next(self.chunks, None)
+            if not chunk:
+                break
+            self.buffer += chunk
+
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+
+def extract_member(session, url, info, end, destination, timeout=None, on_progress=None):
+    """
+    Download and extract a single member of a remote zip archive, verifying its CRC
+    :param end: offset of the first byte after the member's data
+    :param on_progress: function called with the number of compressed bytes read
+    :return: path of the extracted file
+    """
+    try:
+        target = path_traversal_check(os.path.join(destination, info.filename), destination)
+    except SuspiciousFileOperation as e:
+        raise zipfile.BadZipFile(str(e))
+
+    if info.is_dir():
+        os.makedirs(target, exist_ok=True)
+        return target
+
+    if info.flag_bits & 0x1:
+        raise RangeRequestsNotSupported("{} is encrypted".format(info.filename))
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-15)
+    elif info.compress_type == zipfile.ZIP_STORED:
+        decompressor = None
+    else:
+        raise RangeRequestsNotSupported("Unsupported compression method for {}".format(info.filename))
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_path = target + ".part"
+    crc = 0
+    size = 0
+
+    with get_range(session, url, info.header_offset, end - 1, timeout, stream=True) as res:
+        reader = StreamReader(res.iter_content(CHUNK_SIZE))
+
+        header = reader.read(LOCAL_HEADER.size)
+        if len(header) != LOCAL_HEADER.size or header[:4] != LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile("Bad local file header for {}".format(info.filename))
+
+        # The local header can have a different extra field than the central directory
+        name_length, extra_length = LOCAL_HEADER.unpack(header)[10:12]
+        reader.read(name_length + extra_length)
+
+        remaining = info.compress_size
+        with open(tmp_path, "wb") as f:
+            while remaining > 0:
+                data = reader.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    raise zipfile.BadZipFile("{} is truncated".format(info.filename))
+                remaining -= len(data)
+                if on_progress is not None:
+                    on_progress(len(data))
+
+                if decompressor is not None:
+                    data = decompressor.decompress(data)
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                f.write(data)
+
+            if decompressor is not None:
+                data = decompressor.flush()
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                f.write(data)
+
+    if crc != info.CRC or size != info.file_size:
+        os.remove(tmp_path)
+        raise zipfile.BadZipFile("Bad CRC-32 for {}".format(info.filename))
+
+    os.replace(tmp_path, target)
+    return target
+
+
+def extract(url, destination, progress_callback=None, parallel_downloads=16, timeout=None):
+    """
+    Extract a remote zip archive without downloading it first. Members are downloaded
+    in parallel using HTTP range requests and decompressed while they are received.
+    Corrupted members (bad CRC) are downloaded again, up to MAX_RETRIES times.
+    Raises RangeRequestsNotSupported if the server or the archive cannot be used this way.
+    :param progress_callback: function called with the download progress (0-100),
+        from the calling thread
+    :return: list of extracted paths
+    """
+    parallel_downloads = max(1, parallel_downloads)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=parallel_downloads)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    try:
+        with zipfile.ZipFile(io.BufferedReader(HttpRangeFile(session, url, timeout), READ_BLOCK_SIZE)) as zf:
+            infos = zf.infolist()
+            central_directory = zf.start_dir
+
+        # The data of each member ends where the next member starts
+        offsets = sorted(set([i.header_offset for i in infos] + [central_directory]))
+        ends = {o: offsets[k + 1] for k, o in enumerate(offsets[:-1])}
+
+        total = max(1, sum(i.compress_size for i in infos))
+        downloaded = 0
+        lock = threading.Lock()
+
+        def run(info):
+            nonlocal downloaded
+            member_downloaded = 0
+
+            def on_progress(count):
+                nonlocal downloaded, member_downloaded
+                with lock:
+                    downloaded += count
+                    member_downloaded += count
+
+            for attempt in range(MAX_RETRIES + 1):
+                try:
+                    return extract_member(session, url, info, ends[info.header_offset], destination, timeout, on_progress)
+                except (zipfile.BadZipFile, zlib.error, requests.exceptions.RequestException) as e:
+                    with lock:
+                        downloaded -= member_downloaded
+                        member_downloaded = 0
+
+                    if attempt == MAX_RETRIES:
+                        raise
+                    logger.warning("Cannot extract {} from {} ({}), retrying".format(info.filename, url, str(e)))
+
+        with ThreadPoolExecutor(max_workers=parallel_downloads) as executor:
+            # Largest members first, they take the longest
+            futures = [executor.submit(run, info) for info in sorted(infos, key=lambda i: -i.compress_size)]
+            pending = set(futures)
+
+            while len(pending) > 0:
+                done, pending = wait(pending, timeout=1, return_when=FIRST_EXCEPTION)
+                if progress_callback is not None:
+                    progress_callback(min(100.0, downloaded / total * 100.0))
+
+                for f in done:
+                    if f.exception() is not None:
+                        for p in pending:
+                            p.cancel()
+                        raise f.exception()
+
+            return [f.result() for f in futures]
+    finally:
+        session.close()
+
+
+def get_state_path(output):
+    return output + ".json"
+
+
+def load_state(output):
+    try:
+        with open(get_state_path(output), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_state(output, state):
+    tmp_path = get_state_path(output) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, get_state_path(output))
+
+
+def remove_download(output):
+    """
+    Remove a (partial) resumable download and its state
+    """
+    for path in [output, get_state_path(output)]:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def get_chunk_range(state, index):
+    start = index * state['chunk_size']
+    return start, min(state['size'], start + state['chunk_size']) - 1
+
+
+def verify_chunks(output, state):
+    """
+    Remove the chunks that do not match their checksum from the state
+    (e.g. when the worker stopped before they were written to disk)
+    :return: number of invalid chunks
+    """
+    invalid = []
+    with open(output, "rb") as f:
+        for index, crc in state['chunks'].items():
+            start, end = get_chunk_range(state, int(index))
+            f.seek(start)
+            if zlib.crc32(f.read(end - start + 1)) != crc:
+                invalid.append(index)
+
+    for index in invalid:
+        del state['chunks'][index]
+    return len(invalid)
+
+
+def download(url, output, progress_callback=None, parallel_downloads=16, chunk_size=DOWNLOAD_CHUNK_SIZE, timeout=None):
+    """
+    Download a file in chunks using HTTP range requests. The checksums of the downloaded
+    chunks are stored next to output, so that an interrupted download (or one that
+    was partially invalidated, see invalidate_corrupted) only fetches the missing chunks.
+    Raises RangeRequestsNotSupported if the server cannot be used this way.
+    :param progress_callback: function called with the download progress (0-100),
+        from the calling thread
+    :return: output
+    """
+    parallel_downloads = max(1, parallel_downloads)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=parallel_downloads)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    try:
+        res = get_range(session, url, 0, 0, timeout)
+        m = re.match(r"bytes\s+\d+-\d+/(\d+)", res.headers.get('Content-Range', ''))
+        if not m:
+            raise RangeRequestsNotSupported("Invalid Content-Range header")
+        size = int(m.group(1))
+        validator = res.headers.get('ETag') or res.headers.get('Last-Modified')
+
+        state = load_state(output)
+        if state is not None and os.path.isfile(output) and state.get('size') == size and \
+           state.get('validator') == validator and state.get('chunk_size') == chunk_size:
+            invalid = verify_chunks(output, state)
+            logger.info("Resuming download of {} ({} chunks done, {} invalid)".format(url, len(state['chunks']), invalid))
+        else:
+            state = {'size': size, 'validator': validator, 'chunk_size': chunk_size, 'chunks': {}}
+            with open(output, "wb") as f:
+                f.truncate(size)
+        save_state(output, state)
+
+        count = (size + chunk_size - 1) // chunk_size
+        missing = [i for i in range(count) if not str(i) in state['chunks']]
+        downloaded = size - sum(get_chunk_range(state, i)[1] - get_chunk_range(state, i)[0] + 1 for i in missing)
+        lock = threading.Lock()
+        last_save = time.time()
+
+        fd = os.open(output, os.O_WRONLY)
+        try:
+            def run(index):
+                nonlocal downloaded, last_save
+                start, end = get_chunk_range(state, index)
+
+                for attempt in range(MAX_RETRIES + 1):
+                    try:
+                        data = get_range(session, url, start, end, timeout).content
+                        if len(data) != end - start + 1:
+                            raise IncompleteChunk("Incomplete chunk {}-{}".format(start, end))
+                        break
+                    except Exception as e:
+                        if attempt == MAX_RETRIES or not is_transient_error(e):
+                            raise
+                        logger.warning("Cannot download bytes {}-{} of {} ({}), retrying".format(start, end, url, str(e)))
+
+                os.pwrite(fd, data, start)
+
+                with lock:
+                    state['chunks'][str(index)] = zlib.crc32(data)
+                    downloaded += len(data)
+                    if time.time() - last_save >= STATE_SAVE_INTERVAL:
+                        save_state(output, state)
+                        last_save = time.time()
+
+            with ThreadPoolExecutor(max_workers=parallel_downloads) as executor:
+                pending = set(executor.submit(run, index) for index in missing)
+
+                while len(pending) > 0:
+                    done, pending = wait(pending, timeout=1, return_when=FIRST_EXCEPTION)
+                    if progress_callback is not None:
+                        progress_callback(min(100.0, downloaded / max(1, size) * 100.0))
+
+                    for f in done:
+                        if f.exception() is not None:
+                            for p in pending:
+                                p.cancel()
+                            raise f.exception()
+        finally:
+            os.close(fd)
+            with lock:
+                save_state(output, state)
+
+        return output
+    finally:
+        session.close()
+
+
+def find_corrupted_ranges(path):
+    """
+    Check the CRC of every member of a zip archive
+    :return: list of (start, end) byte ranges (end excluded) of the corrupted
+        members, or None if the central directory cannot be read
+    """
+    try:
+        zf = zipfile.ZipFile(path)
+    except (zipfile.BadZipFile, OSError):
+        return None
+
+    with zf:
+        infos = zf.infolist()
+        offsets = sorted(set([i.header_offset for i in infos] + [zf.start_dir]))
+        ends = {o: offsets[k + 1] for k, o in enumerate(offsets[:-1])}
+
+        ranges = []
+        for info in infos:
+            if info.is_dir():
+                continue
+            try:
+                # zipfile checks the CRC once the member is read
+                with zf.open(info) as f:
+                    while f.read(CHUNK_SIZE):
+                        pass
+            except (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError):
+                ranges.append((info.header_offset, ends[info.header_offset]))
+
+    return ranges
+
+
+def invalidate_corrupted(output):
+    """
+    Mark the chunks of a resumable download that contain corrupted zip members
+    as missing, so that the next download only fetches them again. If the corrupted
+    data cannot be located, the download is removed.
+    :return: number of invalidated chunks, or None if the download was removed
+    """
+    state = load_state(output)
+    ranges = find_corrupted_ranges(output) if state is not None else None
+    if not ranges:
+        logger.warning("Cannot locate the corrupted data of {}, removing it".format(output))
+        remove_download(output)
+        return None
+
+    invalid = set()
+    for start, end in ranges:
+        invalid.update(str(i) for i in range(start // state['chunk_size'], (end - 1) // state['chunk_size'] + 1))
+
+    state['chunks'] = {k: v for k, v in state['chunks'].items() if not k in invalid}
+    save_state(output, state)
+    logger.info("Invalidated {} chunks of {}".format(len(invalid), output))
+    return len(invalid)
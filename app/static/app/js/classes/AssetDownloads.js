@@ -37,7 +37,7 @@ class AssetDownloadSeparator extends AssetDownload{
   }
 }
 
-const tiffExportFormats = ["gtiff", "gtiff-rgb", "jpg", "png", "kmz"];
+const tiffExportFormats = ["gtiff", "gtiff-rgb", "cog", "jpg", "png", "kmz", "mbtiles"];
 const elevationExportParams = {'hillshade': 6, "color_map": "viridis"};
 
 const api = {
@@ -9,7 +9,7 @@ import Workers from '../classes/Workers';
 
 export default class ExportAssetPanel extends React.Component {
   static defaultProps = {
-      exportFormats: ["gtiff-rgb", "gtiff", "jpg", "png", "kmz"],
+      exportFormats: ["gtiff-rgb", "gtiff", "cog", "jpg", "png", "kmz", "mbtiles"],
       asset: "",
       exportParams: {},
       task: null,
@@ -40,6 +40,10 @@ export default class ExportAssetPanel extends React.Component {
             label: "GeoTIFF (Raw)",
             icon: "far fa-image"
         },
+        'cog': {
+            label: "Cloud Optimized GeoTIFF (Raw)",
+            icon: "far fa-image"
+        },
         'jpg': {
             label: "JPEG (RGB)",
             icon: "fas fa-palette"
@@ -52,6 +56,10 @@ export default class ExportAssetPanel extends React.Component {
             label: "KMZ (RGB)",
             icon: "fas fa-globe"
         },
+        'mbtiles': {
+            label: "MBTiles (RGB)",
+            icon: "fa fa-table"
+        },
         'laz': {
             label: "LAZ",
             icon: "fa fa-braille"
@@ -230,7 +238,8 @@ export default class ExportAssetPanel extends React.Component {
     if (epsg == projEPSG) title = projSrsName;
     else if (epsg == "" && projWKT) title = projWKT;
 
-    let projection = georeferenced ? (<div><div className="row form-group form-inline">
+    // Tiles are always in web mercator
+    let projection = georeferenced && format !== "mbtiles" ? (<div><div className="row form-group form-inline">
     <label className="col-sm-3 control-label">{_("CRS:")}</label>
     <div className="col-sm-9 ">
       <select className="form-control crs" value={epsg} onChange={this.handleSelectEpsg} title={title}>
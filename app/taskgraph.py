@@ -0,0 +1,71 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger('app.logger')
+
+
+def run_graph(steps, max_workers=1, on_done=None):
+    """
+    Run a set of steps concurrently, each step starting as soon
+    as all of its dependencies have completed
+    :param steps: list of (name, function, dependencies) tuples,
+        where dependencies is a list of step names
+    :param max_workers: maximum number of steps running at once
+    :param on_done: function called with (name, duration in seconds) each time
+        a step completes (from the calling thread)
+    :return: dictionary of step name --> duration in seconds. If a step fails,
+        no other steps are started and its exception is raised once the running steps complete.
+    """
+    names = [name for name, _, _ in steps]
+    if len(set(names)) != len(names):
+        raise ValueError("Duplicate step names")
+
+    for name, _, deps in steps:
+        for d in deps:
+            if not d in names:
+                raise ValueError("{} depends on unknown step {}".format(name, d))
+
+    pending = list(steps)
+    done = set()
+    durations = {}
+    error = None
+
+    def run(name, func):
+        start = time.perf_counter()
+        func()
+        return name, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        running = set()
+
+        while True:
+            if error is None:
+                for step in [s for s in pending if all(d in done for d in s[2])]:
+                    pending.remove(step)
+                    running.add(executor.submit(run, step[0], step[1]))
+
+            if len(running) == 0:
+                break
+
+            finished, running = wait(running, return_when=FIRST_COMPLETED)
+            for f in finished:
+                try:
+                    name, duration = f.result()
+                except Exception as e:
+                    if error is None:
+                        error = e
+                    continue
+
+                done.add(name)
+                durations[name] = duration
+                if on_done is not None:
+                    on_done(name, duration)
+
+    if error is not None:
+        raise error
+
+    if len(pending) > 0:
+        raise ValueError("Circular dependencies between steps: {}".format(", ".join(s[0] for s in pending)))
+
+    return durations
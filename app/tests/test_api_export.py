@@ -12,6 +12,7 @@ from rest_framework.test import APIClient
 from app.plugins.signals import task_completed
 from app.tests.classes import BootTransactionTestCase
 from app.models import Project, Task
+from app import exportcache
 from nodeodm.models import ProcessingNode
 from guardian.shortcuts import assign_perm
 from nodeodm import status_codes
@@ -133,6 +134,16 @@ class TestApiTask(BootTransactionTestCase):
                 ('orthophoto', {'format': 'jpg', 'epsg': 4326, 'rescale': '10,200'}, False, ".jpg", status.HTTP_200_OK),
                 ('orthophoto', {'format': 'png'}, False, ".png", status.HTTP_200_OK),
                 ('orthophoto', {'format': 'kmz'}, False, ".kmz", status.HTTP_200_OK),
+                ('orthophoto', {'format': 'cog'}, False, ".tif", status.HTTP_200_OK),
+                ('orthophoto', {'format': 'cog', 'compress': 'webp'}, False, ".tif", status.HTTP_200_OK),
+                ('orthophoto', {'format': 'cog', 'compress': 'lerc'}, False, ".tif", status.HTTP_400_BAD_REQUEST),
+                ('orthophoto', {'format': 'mbtiles'}, False, ".mbtiles", status.HTTP_200_OK),
+                ('orthophoto', {'format': 'mbtiles', 'tile_format': 'jpg', 'rescale': '10,200'}, False, ".mbtiles", status.HTTP_200_OK),
+                ('orthophoto', {'format': 'mbtiles', 'tile_format': 'gif'}, False, ".mbtiles", status.HTTP_400_BAD_REQUEST),
+                ('orthophoto', {'format': 'mbtiles', 'minzoom': 10, 'maxzoom': 5}, False, ".mbtiles", status.HTTP_400_BAD_REQUEST),
+                ('orthophoto', {'format': 'mbtiles', 'maxzoom': 40}, False, ".mbtiles", status.HTTP_400_BAD_REQUEST),
+                ('orthophoto', {'format': 'mbtiles', 'bbox': '0,0,1,1'}, False, ".mbtiles", status.HTTP_400_BAD_REQUEST),
+                ('orthophoto', {'format': 'mbtiles', 'bbox': 'invalid'}, False, ".mbtiles", status.HTTP_400_BAD_REQUEST),
                 
                 ('orthophoto', {'formula': 'NDVI'}, False, "-NDVI.tif", status.HTTP_400_BAD_REQUEST),
                 ('orthophoto', {'bands': 'RGN'}, False, "-NDVI.tif", status.HTTP_400_BAD_REQUEST),
@@ -146,6 +157,9 @@ class TestApiTask(BootTransactionTestCase):
                 ('dsm', {'epsg': 4326, 'format': 'jpg'}, False, ".jpg", status.HTTP_200_OK),
                 ('dsm', {'epsg': 4326, 'format': 'gtiff-rgb'}, False, ".tif", status.HTTP_200_OK),
                 ('dsm', {'format': 'kmz'}, False, ".kmz", status.HTTP_200_OK),
+                ('dsm', {'format': 'cog', 'compress': 'LERC', 'epsg': 4326}, False, ".tif", status.HTTP_200_OK),
+                ('dsm', {'format': 'cog', 'compress': 'JPEG'}, False, ".tif", status.HTTP_400_BAD_REQUEST),
+                ('dsm', {'format': 'mbtiles', 'bbox': '-91.995,46.841,-91.992,46.843'}, False, ".mbtiles", status.HTTP_200_OK),
                 ('dsm', {'color_map': 'viridis', 'hillshade': 2, 'format': 'png'}, False, ".png", status.HTTP_200_OK),
                 ('dsm', {'rescale': 'invalid-but-works-cuz-gtiff'}, True, ".tif", status.HTTP_200_OK),
                 
@@ -217,6 +231,72 @@ class TestApiTask(BootTransactionTestCase):
             # Test without crop
             testExport()
 
+            # Identical exports reuse the same job (and file)
+            def export_job(data):
+                res = client.post("/api/projects/{}/tasks/{}/dsm/export".format(project.id, task.id), data)
+                self.assertEqual(res.status_code, status.HTTP_200_OK)
+                return json.loads(res.content.decode("utf-8"))["celery_task_id"]
+
+            job_id = export_job({'format': 'jpg', 'epsg': 4326})
+            self.assertEqual(job_id, export_job({'format': 'jpg', 'epsg': 4326}))
+            self.assertNotEqual(job_id, export_job({'format': 'jpg', 'epsg': 3857}))
+
+            result = TestSafeAsyncResult(job_id).get()
+            self.assertTrue(result['file'].startswith(exportcache.cache_dir()))
+
+            # Evicted exports are generated again
+            exportcache.evict(0)
+            self.assertFalse(os.path.isfile(result['file']))
+            res = client.get("/api/workers/get/{}".format(job_id))
+            self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+            self.assertTrue('error' in json.loads(res.content.decode("utf-8")))
+            self.assertNotEqual(job_id, export_job({'format': 'jpg', 'epsg': 4326}))
+
+            # Batch exports
+            batch_url = "/api/projects/{}/tasks/{}/export/batch".format(project.id, task.id)
+            res = client.post(batch_url, [], format="json")
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+            res = client.post(batch_url, [{'asset': 'invalid'}], format="json")
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+            res = client.post(batch_url, [{'asset': 'dsm', 'format': 'tif'}], format="json")
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+            res = client.post(batch_url, [{'asset': 'dsm'}] * (settings.EXPORT_BATCH_MAX_ITEMS + 1), format="json")
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+            res = client.post(batch_url, {'items': [
+                {'asset': 'orthophoto', 'format': 'gtiff'},
+                {'asset': 'dsm', 'format': 'jpg', 'epsg': 4326},
+                {'asset': 'dsm', 'format': 'gtiff', 'epsg': 3857},
+                {'asset': 'dtm', 'format': 'cog'},
+                {'asset': 'georeferenced_model', 'format': 'las'},
+            ]}, format="json")
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            reply = json.loads(res.content.decode("utf-8"))
+            self.assertEqual(reply['filename'], "test-task-export.zip")
+            self.assertEqual(reply['items'], ["test-task-orthophoto.tif", "test-task-dsm.jpg",
+                                              "test-task-dsm.tif", "test-task-dtm.tif", "test-task-georeferenced_model.las"])
+
+            result = TestSafeAsyncResult(reply['celery_task_id']).get()
+            self.assertEqual(len(result['files']), 5)
+
+            # Items share the export cache with single exports
+            self.assertEqual(result['files'][1]['file'], TestSafeAsyncResult(export_job({'format': 'jpg', 'epsg': 4326})).get()['file'])
+
+            res = client.get("/api/workers/check/{}".format(reply['celery_task_id']))
+            self.assertTrue(json.loads(res.content.decode("utf-8"))['ready'])
+
+            res = client.get("/api/workers/get/{}?filename={}".format(reply['celery_task_id'], reply['filename']))
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertEqual(res._headers['content-disposition'][1], 'attachment; filename=test-task-export.zip')
+            self.assertTrue(res.has_header('_stream'))
+
+            res = client.get("/api/workers/get/{}?item=1".format(reply['celery_task_id']))
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertEqual(res._headers['content-disposition'][1], 'attachment; filename=test-task-dsm.jpg')
+
+            res = client.get("/api/workers/get/{}?item=10".format(reply['celery_task_id']))
+            self.assertTrue('error' in json.loads(res.content.decode("utf-8")))
+
             # Set crop
 
             crop_geojson = {"type":"Feature","properties":{},"geometry":{"type":"Polygon","coordinates":[[[-91.99424117803576,46.84230591442068],[-91.99366182088853,46.84228940253027],[-91.99393808841705,46.84257010397711],[-91.99424117803576,46.84230591442068]]]}}
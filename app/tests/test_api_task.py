@@ -10,6 +10,7 @@ import logging
 from datetime import timedelta
 
 import json
+import urllib.parse
 import requests
 from PIL import Image
 from django.contrib.auth.models import User
@@ -22,7 +23,7 @@ from django.utils import timezone
 
 from app import pending_actions
 from app.api.formulas import algos, get_camera_filters_for
-from app.api.tiler import ZOOM_EXTRA_LEVELS
+from app.api.tiler import ZOOM_EXTRA_LEVELS, get_seed_tiles
 from app.cogeo import valid_cogeo
 from app.geoutils import get_rasterio_to_meters_factor
 from app.models import Project, Task
@@ -453,6 +454,15 @@ class TestApiTask(BootTransactionTestCase):
             res = client.get("/api/projects/{}/tasks/{}/thumbnail".format(project.id, task.id))
             self.assertEqual(res.status_code, status.HTTP_200_OK)
 
+            # Thumbnails can be revalidated
+            self.assertTrue(res.has_header('ETag'))
+            self.assertTrue(res.has_header('Last-Modified'))
+            self.assertEqual(res.get('Cache-Control'), 'private, no-cache')
+            res = client.get("/api/projects/{}/tasks/{}/thumbnail".format(project.id, task.id), HTTP_IF_NONE_MATCH=res.get('ETag'))
+            self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+            res = client.get("/api/projects/{}/tasks/{}/thumbnail?size=128".format(project.id, task.id), HTTP_IF_NONE_MATCH=res.get('ETag'))
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+
             # Can download assets
             for asset in list(task.ASSETS_MAP.keys()):
                 res = client.get("/api/projects/{}/tasks/{}/download/{}".format(project.id, task.id, asset))
@@ -910,11 +920,75 @@ class TestApiTask(BootTransactionTestCase):
                 self.assertEqual(i.width, 512)
                 self.assertEqual(i.height, 512)
             
+            # Tiles, metadata and tile.json support conditional requests
+            for url in ["orthophoto/tiles/{}.png".format(tile_path['orthophoto']), "orthophoto/metadata", "orthophoto/tiles.json", "orthophoto/bounds"]:
+                res = client.get("/api/projects/{}/tasks/{}/{}".format(project.id, task.id, url))
+                self.assertEqual(res.status_code, status.HTTP_200_OK)
+                etag = res.get('ETag')
+                self.assertTrue(etag is not None)
+
+                res = client.get("/api/projects/{}/tasks/{}/{}".format(project.id, task.id, url), HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+                self.assertEqual(res.get('ETag'), etag)
+
+                res = client.get("/api/projects/{}/tasks/{}/{}".format(project.id, task.id, url), HTTP_IF_NONE_MATCH='"bogus"')
+                self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+            res = client.get("/api/projects/{}/tasks/{}/orthophoto/tiles/{}.png".format(project.id, task.id, tile_path['orthophoto']))
+            self.assertEqual(res.get('Cache-Control'), 'private, max-age={}'.format(settings.TILE_HTTP_MAX_AGE))
+            res = client.get("/api/projects/{}/tasks/{}/orthophoto/tiles/{}.png".format(project.id, task.id, tile_path['orthophoto']), HTTP_IF_MODIFIED_SINCE=res.get('Last-Modified'))
+            self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+
+            # Can request multiple tiles at once
+            res = client.get("/api/projects/{}/tasks/{}/orthophoto/tiles/batch?tiles={},{},0/0/0&ext=png".format(project.id, task.id, tile_path['orthophoto'], tile_path['orthophoto']))
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertTrue(res.get('content-type').startswith("multipart/mixed; boundary="))
+            boundary = res.get('content-type').split('boundary=')[1].strip('"')
+            parts = res.content.split(("--" + boundary).encode('ascii'))[1:-1]
+            self.assertEqual(len(parts), 3)
+            for p in parts[:2]:
+                self.assertTrue(("Content-Location: " + tile_path['orthophoto']).encode('ascii') in p)
+                self.assertTrue(b"Content-Type: image/png" in p)
+                with Image.open(io.BytesIO(p.split(b"\r\n\r\n", 1)[1][:-2])) as i:
+                    self.assertEqual(i.width, 256)
+            self.assertTrue(b"X-Tile-Status: 404" in parts[2])
+
+            # At high-DPI scales too
+            res = client.get("/api/projects/{}/tasks/{}/orthophoto/tiles/batch?tiles={}&ext=png&scale=2".format(project.id, task.id, tile_path['orthophoto']))
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            boundary = res.get('content-type').split('boundary=')[1].strip('"')
+            part = res.content.split(("--" + boundary).encode('ascii'))[1]
+            with Image.open(io.BytesIO(part.split(b"\r\n\r\n", 1)[1][:-2])) as i:
+                self.assertEqual(i.width, 512)
+
+            # But not too many, or invalid ones
+            res = client.get("/api/projects/{}/tasks/{}/orthophoto/tiles/batch?tiles={}".format(project.id, task.id, ",".join([tile_path['orthophoto']] * (settings.TILE_BATCH_MAX_TILES + 1))))
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+            res = client.get("/api/projects/{}/tasks/{}/orthophoto/tiles/batch?tiles=a/b/c".format(project.id, task.id))
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+            for scale in ["0", "a", "-1", "5", "64"]:
+                res = client.get("/api/projects/{}/tasks/{}/orthophoto/tiles/batch?tiles={}&scale={}".format(project.id, task.id, tile_path['orthophoto'], scale))
+                self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
             # Cannot request invalid tiles sizes
             for s in ["1024", "abc", "-1"]:
                 res = client.get("/api/projects/{}/tasks/{}/orthophoto/tiles/{}.png?size={}".format(project.id, task.id, tile_path['orthophoto'], s))
                 self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
             
+            # Can list and pre-render tiles with default styling
+            seed_tiles = get_seed_tiles(task, 2, 1000)
+            self.assertTrue(len(seed_tiles) > 0)
+            self.assertEqual(len(get_seed_tiles(task, 2, 0)), 0)
+            self.assertTrue(len(get_seed_tiles(task, 1, 1000)) < len(seed_tiles))
+            self.assertTrue(set(t[0] for t in seed_tiles) <= set(tile_types))
+
+            tile_type, z, x, y, query_params = seed_tiles[0]
+            self.assertEqual(query_params['size'], '512')
+            worker.tasks.seed_tiles(str(task.id))
+            res = client.get("/api/projects/{}/tasks/{}/{}/tiles/{}/{}/{}?{}".format(project.id, task.id, tile_type, z, x, y,
+                                urllib.parse.urlencode(query_params)), HTTP_ACCEPT="image/webp")
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+
             # This task's assets cache should not exist
             ta_cache_dir = task.get_task_assets_cache()
             self.assertFalse(os.path.isdir(ta_cache_dir))
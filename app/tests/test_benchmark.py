@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import rasterio
+from django.contrib.auth.models import User
+
+from app import benchmark
+from app.models import Project
+from .classes import BootTestCase
+
+
+class TestBenchmark(BootTestCase):
+    def test_synthetic_rasters(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for fixture_type, count, dtype in [('rgb', 4, 'uint8'), ('multispectral', 6, 'uint16'), ('dsm', 1, 'float32')]:
+                path = os.path.join(tmpdir, fixture_type + ".tif")
+                benchmark.make_synthetic_raster(path, fixture_type, 600)
+                with rasterio.open(path) as f:
+                    self.assertEqual(f.width, 600)
+                    self.assertEqual(f.count, count)
+                    self.assertEqual(f.dtypes[0], dtype)
+                    self.assertEqual(f.crs.to_epsg(), benchmark.FIXTURE_EPSG)
+                    if fixture_type == 'multispectral':
+                        self.assertEqual(f.descriptions[3], 'nir')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_run(self):
+        users_count = User.objects.count()
+        projects_count = Project.objects.count()
+
+        results = benchmark.run(['rgb', 'dsm'], size=512, iterations=2, zoom_levels=1)
+
+        cases = [(r['fixture'], r['case']) for r in results['results']]
+        self.assertTrue(('rgb', 'thumbnail/256') in cases)
+        self.assertTrue(('rgb', 'metadata/vari/computed') in cases)
+        self.assertTrue(('dsm', 'metadata/default/cached') in cases)
+        self.assertFalse(('dsm', 'thumbnail/256') in cases)
+        self.assertTrue(any(c.startswith('tiles/512/hillshade/') for f, c in cases))
+
+        for r in results['results']:
+            self.assertEqual(r['errors'], 0, "{} {}".format(r['fixture'], r['case']))
+            self.assertEqual(r['requests'], 2)
+            self.assertTrue(r['p50'] <= r['p95'])
+            self.assertTrue(r['per_second'] > 0)
+
+        # Fixtures are removed
+        self.assertEqual(User.objects.count(), users_count)
+        self.assertEqual(Project.objects.count(), projects_count)
+
+        comparison = benchmark.compare(results, results)
+        self.assertEqual(len(comparison), len(results['results']))
+        self.assertTrue(all(change == 0 for _, _, _, _, change in comparison))
+
+    def test_cogeo_kernel(self):
+        results = benchmark.run([], size=600, iterations=2, kernels=['cogeo'])
+        cases = [r['case'] for r in results['results']]
+
+        self.assertTrue('cogeo/rgb/jpeg' in cases)
+        self.assertTrue('cogeo/dsm/lerc' in cases)
+
+        # Lossy profiles are only used for 8-bit RGB rasters
+        self.assertFalse('cogeo/dsm/jpeg' in cases)
+        self.assertFalse('cogeo/multispectral/webp' in cases)
+
+        for r in results['results']:
+            self.assertTrue(r['file_size'] > 0)
+            self.assertTrue(r['conversion_time'] > 0)
+            self.assertEqual(r['requests'], 2)
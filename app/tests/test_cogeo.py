@@ -0,0 +1,112 @@
+import os
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+import rasterio
+from django.test import TestCase
+
+from app import cogeo
+from webodm import settings
+
+
+class TestCogeo(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_tif(self, name, width=1024, height=1024, count=1, dtype="uint8", **profile):
+        path = os.path.join(self.tmpdir, name)
+        with rasterio.open(path, "w", driver="GTiff", width=width, height=height, count=count,
+                           dtype=dtype, **profile) as dst:
+            dst.write(np.ones((count, height, width), dtype=dtype))
+        return path
+
+    def test_precheck(self):
+        # Large stripped files are never cogeos
+        stripped = self.write_tif("stripped.tif")
+        self.assertEqual(cogeo.read_tiff_header(stripped)['width'], 1024)
+        self.assertFalse(cogeo.precheck_cogeo(stripped))
+        self.assertFalse(cogeo.validate_cogeo(stripped))
+
+        # Large files without overviews neither
+        tiled = self.write_tif("tiled.tif", tiled=True, blockxsize=256, blockysize=256)
+        self.assertFalse(cogeo.read_tiff_header(tiled)['has_overviews'])
+        self.assertFalse(cogeo.precheck_cogeo(tiled))
+
+        # Small files require a full check
+        small = self.write_tif("small.tif", width=64, height=64)
+        self.assertIsNone(cogeo.precheck_cogeo(small))
+        self.assertTrue(cogeo.valid_cogeo(small))
+
+        # Files written by the COG driver are decided from their header
+        cog = os.path.join(self.tmpdir, "cog.tif")
+        subprocess.run(["gdal_translate", "-q", "-of", "COG", stripped, cog], check=True)
+        self.assertTrue(cogeo.precheck_cogeo(cog))
+        self.assertTrue(cogeo.validate_cogeo(cog))
+
+        bigtiff_cog = os.path.join(self.tmpdir, "bigtiff_cog.tif")
+        subprocess.run(["gdal_translate", "-q", "-of", "COG", "-co", "BIGTIFF=YES", stripped, bigtiff_cog], check=True)
+        self.assertTrue(cogeo.precheck_cogeo(bigtiff_cog))
+
+        # Not a TIFF
+        not_tiff = os.path.join(self.tmpdir, "not_tiff.tif")
+        with open(not_tiff, "w") as f:
+            f.write("not a tiff")
+        self.assertIsNone(cogeo.read_tiff_header(not_tiff))
+        self.assertIsNone(cogeo.precheck_cogeo(not_tiff))
+
+    def test_cached_verdicts(self):
+        tif = self.write_tif("small.tif", width=64, height=64)
+        self.assertIsNone(cogeo.get_verdict(tif, cogeo.get_file_key(tif)))
+
+        self.assertTrue(cogeo.valid_cogeo(tif))
+        self.assertTrue(cogeo.get_verdict(tif, cogeo.get_file_key(tif)))
+
+        # Cached verdicts are used until the file changes
+        cogeo.set_verdict(tif, cogeo.get_file_key(tif), False)
+        self.assertFalse(cogeo.valid_cogeo(tif))
+        self.assertTrue(cogeo.valid_cogeo(tif, use_cache=False))
+
+        st = os.stat(tif)
+        os.utime(tif, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        self.assertIsNone(cogeo.get_verdict(tif, cogeo.get_file_key(tif)))
+        self.assertTrue(cogeo.valid_cogeo(tif))
+
+        os.remove(cogeo.get_verdict_path(tif))
+
+    def test_profiles(self):
+        rgb = self.write_tif("rgb.tif", count=3)
+        dem = self.write_tif("dem.tif", dtype="float32")
+        multispectral = self.write_tif("multispectral.tif", count=5, dtype="uint16")
+
+        self.assertTrue(cogeo.is_rgb8(rgb))
+        self.assertFalse(cogeo.is_rgb8(multispectral))
+        self.assertTrue(cogeo.is_profile_compatible(dem, 'lerc'))
+        self.assertFalse(cogeo.is_profile_compatible(dem, 'jpeg'))
+
+        asset_profiles = settings.COG_ASSET_PROFILES
+        try:
+            settings.COG_ASSET_PROFILES = {'orthophoto': 'jpeg', 'multispectral': 'zstd', 'dsm': 'jpeg', 'dtm': 'invalid'}
+            self.assertEqual(cogeo.get_profile(rgb, 'orthophoto'), 'jpeg')
+            self.assertEqual(cogeo.get_profile(multispectral, 'orthophoto'), 'zstd')
+
+            # Incompatible or invalid profiles fall back to the default profile
+            self.assertEqual(cogeo.get_profile(dem, 'dsm'), 'default')
+            self.assertEqual(cogeo.get_profile(dem, 'dtm'), 'default')
+            self.assertEqual(cogeo.get_profile(dem), 'default')
+
+            cogeo.assure_cogeo(rgb, 'orthophoto')
+            self.assertTrue(cogeo.valid_cogeo(rgb))
+            with rasterio.open(rgb) as f:
+                self.assertEqual(f.compression.name.upper(), 'JPEG')
+        finally:
+            settings.COG_ASSET_PROFILES = asset_profiles
+
+        for profile in cogeo.COG_PROFILES:
+            if cogeo.is_profile_compatible(dem, profile):
+                output = os.path.join(self.tmpdir, "dem-{}.tif".format(profile))
+                self.assertTrue(cogeo.translate_cogeo(dem, output, profile))
+                self.assertTrue(cogeo.valid_cogeo(output))
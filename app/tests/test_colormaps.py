@@ -0,0 +1,50 @@
+import numpy as np
+from django.test import TestCase
+from rio_tiler.models import ImageData
+from rio_tiler.colormap import apply_cmap
+from rio_tiler.errors import InvalidColorMapName
+
+from app.api.colormaps import colormap, get_lut, apply_lut, apply_colormap, rescale_to_uint8
+
+
+class TestColormaps(TestCase):
+    def test_lut(self):
+        lut = get_lut('viridis')
+        self.assertEqual(lut.shape, (4, 256))
+        self.assertEqual(lut.dtype, np.uint8)
+        self.assertTrue(get_lut('viridis') is lut)
+        self.assertFalse(lut.flags.writeable)
+
+        # Custom colormaps are registered
+        self.assertEqual(get_lut('discrete_ndvi').shape, (4, 256))
+
+        with self.assertRaises(InvalidColorMapName):
+            get_lut('invalid')
+
+    def test_parity(self):
+        rng = np.random.default_rng(0)
+        mask = (rng.random((256, 256)) > 0.2).astype(np.uint8) * 255
+
+        for dtype, in_range in [(np.float32, (200.0, 300.0)), (np.float32, (-1.0, 1.0)), (np.uint16, (100.0, 900.0))]:
+            data = (rng.random((1, 256, 256)) * 1000 - 100).astype(dtype) if dtype == np.float32 else \
+                   (rng.random((1, 256, 256)) * 1000).astype(dtype)
+
+            expected = ImageData(data.copy(), mask).post_process(in_range=(in_range,))
+            self.assertTrue(np.array_equal(rescale_to_uint8(data, in_range, mask), expected.data))
+
+            for color_map in ['viridis', 'gray', 'rdylgn', 'discrete_ndvi']:
+                expected_rgb, expected_alpha = apply_cmap(expected.data, colormap.get(color_map))
+                rgb, alpha = apply_colormap(data, in_range, color_map, mask)
+                self.assertTrue(np.array_equal(rgb, expected_rgb))
+                self.assertTrue(np.array_equal(alpha, expected_alpha))
+                self.assertEqual(rgb.shape, (3, 256, 256))
+
+        # Input is not modified
+        data = np.full((1, 4, 4), 250, dtype=np.float32)
+        rgb, alpha = apply_colormap(data, (200.0, 300.0), 'gray')
+        self.assertTrue((data == 250).all())
+        self.assertTrue((rgb == get_lut('gray')[:3, 127, np.newaxis, np.newaxis]).all())
+
+        rgb, alpha = apply_lut(np.full((1, 4, 4), 255, dtype=np.uint8), 'viridis')
+        self.assertTrue((rgb == get_lut('viridis')[:3, 255, np.newaxis, np.newaxis]).all())
+        self.assertTrue((alpha == 255).all())
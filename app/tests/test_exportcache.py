@@ -0,0 +1,95 @@
+import os
+import time
+import tempfile
+import shutil
+from django.test import TestCase
+
+from app import exportcache
+
+
+class TestExportCache(TestCase):
+    def setUp(self):
+        shutil.rmtree(exportcache.cache_dir(), ignore_errors=True)
+        self.tmpdir = tempfile.mkdtemp()
+        self.asset = os.path.join(self.tmpdir, "orthophoto.tif")
+        shutil.copy(os.path.join("app", "fixtures", "orthophoto.tif"), self.asset)
+
+    def tearDown(self):
+        shutil.rmtree(exportcache.cache_dir(), ignore_errors=True)
+        shutil.rmtree(self.tmpdir)
+
+    def export(self, key, size=1024):
+        tmpfile = os.path.join(self.tmpdir, "export.tif")
+        with open(tmpfile, "wb") as f:
+            f.write(b"0" * size)
+        return exportcache.store(key, tmpfile)
+
+    def test_keys(self):
+        params = {'args': [self.asset], 'opts': {'format': 'gtiff', 'epsg': 4326}}
+        key = exportcache.get_key("task1", self.asset, "export_raster", params)
+        self.assertEqual(key, exportcache.get_key("task1", self.asset, "export_raster", dict(params)))
+        self.assertTrue(key.startswith("task1/"))
+
+        # Options, jobs and assets affect the key
+        self.assertNotEqual(key, exportcache.get_key("task1", self.asset, "export_raster", {**params, 'opts': {'format': 'gtiff'}}))
+        self.assertNotEqual(key, exportcache.get_key("task1", self.asset, "export_tiles", params))
+
+        st = os.stat(self.asset)
+        os.utime(self.asset, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        self.assertNotEqual(key, exportcache.get_key("task1", self.asset, "export_raster", params))
+
+        self.assertIsNone(exportcache.get_key("task1", os.path.join(self.tmpdir, "missing.tif"), "export_raster", params))
+
+    def test_store(self):
+        key = exportcache.get_key("task1", self.asset, "export_raster", {})
+        self.assertIsNone(exportcache.get(key, "tif"))
+        self.assertIsNone(exportcache.get(None, "tif"))
+
+        path = self.export(key)
+        self.assertTrue(path.startswith(exportcache.cache_dir("task1")))
+        self.assertFalse(os.path.isfile(os.path.join(self.tmpdir, "export.tif")))
+        self.assertEqual(exportcache.get(key, "tif"), path)
+        self.assertIsNone(exportcache.get(key, "png"))
+
+        # Jobs
+        self.assertTrue(exportcache.set_job(key, "job1", only_new=True))
+        self.assertFalse(exportcache.set_job(key, "job2", only_new=True))
+        self.assertEqual(exportcache.get_job(key), "job1")
+        exportcache.forget_job(key)
+        self.assertIsNone(exportcache.get_job(key))
+
+        exportcache.clear_task("task1")
+        self.assertIsNone(exportcache.get(key, "tif"))
+
+    def test_evict(self):
+        # Exports that are being stored are not evicted
+        # (unless they are leftovers from interrupted stores)
+        storing = os.path.join(exportcache.cache_dir("task1"), "storing.tif.tmp")
+        leftover = os.path.join(exportcache.cache_dir("task1"), "leftover.tif.tmp")
+        os.makedirs(exportcache.cache_dir("task1"), exist_ok=True)
+        for tmp in [storing, leftover]:
+            with open(tmp, "wb") as f:
+                f.write(b"0" * 1024 * 1024 * 2)
+        t = time.time() - 7200
+        os.utime(leftover, (t, t))
+
+        paths = []
+        for i in range(10):
+            path = self.export(exportcache.get_key("task1", self.asset, "export_raster", {'i': i}), 1024 * 200)
+            paths.append(path)
+
+            t = time.time() - 100 + i
+            os.utime(path, (t, t))
+
+        # Reused exports are the most recently used
+        self.assertTrue(exportcache.touch(paths[0]))
+
+        removed, freed = exportcache.evict(1)
+        self.assertTrue(removed > 0)
+        self.assertEqual(freed, removed * 1024 * 200)
+        self.assertTrue(os.path.isfile(paths[0]))
+        self.assertFalse(os.path.isfile(paths[1]))
+        self.assertTrue(os.path.isfile(paths[-1]))
+        self.assertFalse(exportcache.touch(paths[1]))
+        self.assertTrue(os.path.isfile(storing))
+        self.assertFalse(os.path.isfile(leftover))
@@ -0,0 +1,84 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+from django.contrib.auth.models import User
+
+from app import benchmark, raster_pool
+from app.api.tiler import get_raster_path, get_tile_params, read_tile_image, encode_tile
+from app.mbtiles import get_export_ranges, count_tiles, iter_tiles, intersect_bounds, export_mbtiles
+from .classes import BootTestCase
+
+
+class TestMBTiles(BootTestCase):
+    def setUp(self):
+        super().setUp()
+        self.task = benchmark.create_task(User.objects.get(username="testuser"), 'rgb', 1024)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        benchmark.delete_task(self.task)
+        shutil.rmtree(self.tmpdir)
+
+    def test_ranges(self):
+        self.assertEqual(intersect_bounds((0, 0, 2, 2), (1, 1, 3, 3)), (1, 1, 2, 2))
+        self.assertIsNone(intersect_bounds((0, 0, 1, 1), (2, 2, 3, 3)))
+
+        with raster_pool.open_cog(get_raster_path(self.task, 'orthophoto')) as src:
+            ranges, bounds = get_export_ranges(src)
+            self.assertEqual(count_tiles(ranges), len(list(iter_tiles(ranges))))
+            for z, x, y in iter_tiles(ranges):
+                self.assertTrue(src.tile_exists(z, x, y))
+
+            # Bounds restrict the export
+            west, south, east, north = bounds
+            half_ranges, half_bounds = get_export_ranges(src, bounds=(west, south, (west + east) / 2, north))
+            self.assertTrue(count_tiles(half_ranges) < count_tiles(ranges))
+
+            with self.assertRaises(ValueError):
+                get_export_ranges(src, bounds=(0, 0, 1, 1))
+            with self.assertRaises(ValueError):
+                get_export_ranges(src, minzoom=ranges[-1][0], maxzoom=ranges[0][0] - 1)
+            with self.assertRaises(ValueError):
+                get_export_ranges(src, maxzoom=30)
+
+            # The default maximum zoom level is lowered to fit max_tiles
+            max_tiles = count_tiles(ranges) - 1
+            limited_ranges, _ = get_export_ranges(src, max_tiles=max_tiles)
+            self.assertTrue(limited_ranges[-1][0] < ranges[-1][0])
+            self.assertTrue(count_tiles(limited_ranges) <= max_tiles)
+            self.assertEqual(get_export_ranges(src, max_tiles=0)[0], ranges[:1])
+
+            # Unless it's set explicitly
+            self.assertEqual(get_export_ranges(src, maxzoom=ranges[-1][0], max_tiles=max_tiles)[0], ranges)
+
+    def test_export(self):
+        output = os.path.join(self.tmpdir, "orthophoto.mbtiles")
+        with raster_pool.open_cog(get_raster_path(self.task, 'orthophoto')) as src:
+            ranges, bounds = get_export_ranges(src)
+        maxzoom = ranges[-1][0]
+
+        progress = []
+        written = export_mbtiles(self.task, 'orthophoto', output, {'rescale': '0,255'}, minzoom=maxzoom - 1, maxzoom=maxzoom,
+                                 threads=3, progress_callback=lambda s, p: progress.append(p))
+
+        conn = sqlite3.connect(output)
+        metadata = dict(conn.execute("SELECT name, value FROM metadata").fetchall())
+        self.assertEqual(metadata['format'], 'png')
+        self.assertEqual(int(metadata['minzoom']), maxzoom - 1)
+        self.assertEqual(int(metadata['maxzoom']), maxzoom)
+        self.assertEqual(len(metadata['bounds'].split(",")), 4)
+
+        rows = conn.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles").fetchall()
+        conn.close()
+        self.assertEqual(len(rows), written)
+        self.assertTrue(written > 0)
+        self.assertTrue(written <= count_tiles(ranges[-2:]))
+        self.assertTrue(all(0 < p <= 100 for p in progress))
+
+        # Tiles are the same as the map tiles (rows are flipped)
+        z, x, tile_row, content = rows[-1]
+        y = (1 << z) - 1 - tile_row
+        params = get_tile_params(self.task, 'orthophoto', z, 1, {'rescale': '0,255'})
+        data, mask = read_tile_image(self.task, 'orthophoto', x, y, params)
+        self.assertEqual(content, encode_tile(data, mask, 'png')[0])
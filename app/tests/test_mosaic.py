@@ -0,0 +1,135 @@
+import os
+import numpy as np
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import GEOSGeometry
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from app import benchmark
+from app.api.mosaic import get_tile_bounds, get_mosaic_tasks, composite
+from app.models import Project, Task
+from app.raster_utils import get_raster_bounds_wkt
+from nodeodm import status_codes
+from .classes import BootTestCase
+
+
+class TestMosaic(BootTestCase):
+    def create_task(self, project, name):
+        task = Task.objects.create(project=project, name=name, status=status_codes.COMPLETED)
+        raster_path = task.assets_path(task.ASSETS_MAP['orthophoto.tif'])
+        os.makedirs(os.path.dirname(raster_path), exist_ok=True)
+        benchmark.make_synthetic_raster(raster_path, 'rgb', 512)
+
+        task.orthophoto_extent = GEOSGeometry(get_raster_bounds_wkt(raster_path), srid=4326)
+        task.update_available_assets_field()
+        task.update_georef_fields()
+        task.update_orthophoto_bands_field()
+        task.save()
+        return task
+
+    def test_tile_bounds(self):
+        west, south, east, north = get_tile_bounds(0, 0, 0)
+        self.assertAlmostEqual(west, -180)
+        self.assertAlmostEqual(east, 180)
+        self.assertAlmostEqual(north, 85.0511287798, places=6)
+        self.assertAlmostEqual(south, -85.0511287798, places=6)
+
+        west, south, east, north = get_tile_bounds(1, 1, 0)
+        self.assertAlmostEqual(west, 0)
+        self.assertAlmostEqual(south, 0)
+
+    def test_composite(self):
+        self.assertIsNone(composite([]))
+
+        top = np.full((3, 4, 4), 10, dtype=np.uint8)
+        top_mask = np.zeros((4, 4), dtype=np.uint8)
+        top_mask[:2] = 255
+        bottom = np.full((1, 4, 4), 20, dtype=np.uint8)
+        bottom_mask = np.full((4, 4), 255, dtype=np.uint8)
+
+        data, mask = composite([(top, top_mask), (bottom, bottom_mask)])
+        self.assertEqual(data.shape, (3, 4, 4))
+        self.assertTrue((data[:, :2] == 10).all())
+        self.assertTrue((data[:, 2:] == 20).all())
+        self.assertTrue((mask == 255).all())
+
+        # Layers are not modified
+        self.assertTrue((top == 10).all())
+        self.assertTrue((top_mask[2:] == 0).all())
+
+        # Lower layers are not read once the tile is covered
+        def layers():
+            yield bottom, bottom_mask
+            raise AssertionError("Should not be read")
+
+        data, mask = composite(layers())
+        self.assertTrue((data == 20).all())
+
+    def test_mosaic(self):
+        user = User.objects.get(username="testuser")
+        project = Project.objects.create(owner=user, name="Mosaic")
+        older = self.create_task(project, "Older")
+        newer = self.create_task(project, "Newer")
+        other = self.create_task(Project.objects.create(owner=user, name="Other"), "Other")
+
+        z, tiles = max(benchmark.get_tiles(older, 'orthophoto', 1).items())
+        x, y = tiles[0]
+        bounds = get_tile_bounds(z, x, y)
+
+        # Only tasks of the project that overlap the tile
+        self.assertEqual(get_mosaic_tasks(project, 'orthophoto', bounds), [newer, older])
+        self.assertEqual(get_mosaic_tasks(project, 'orthophoto', bounds, order='oldest'), [older, newer])
+        self.assertEqual(get_mosaic_tasks(project, 'orthophoto', bounds, task_ids=[str(older.id), str(newer.id)]), [older, newer])
+        self.assertEqual(get_mosaic_tasks(project, 'orthophoto', bounds, task_ids=[str(newer.id), str(other.id)]), [newer])
+        self.assertEqual(get_mosaic_tasks(project, 'orthophoto', get_tile_bounds(z, 0, 0)), [])
+        self.assertEqual(get_mosaic_tasks(project, 'dsm', bounds), [])
+        self.assertEqual(get_mosaic_tasks(project, 'orthophoto', bounds, public_only=True), [])
+
+        url = "/api/projects/{}/orthophoto/tiles/{}/{}/{}.png".format(project.id, z, x, y)
+
+        # Anonymous users cannot see private projects
+        client = APIClient()
+        res = client.get(url)
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+        # Unless tasks are public
+        older.public = True
+        older.save()
+        res = client.get(url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['Content-Type'], "image/png")
+
+        client.login(username="testuser", password="test1234")
+        res = client.get(url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        etag = res['ETag']
+        self.assertTrue(etag)
+        self.assertIn("private", res['Cache-Control'])
+
+        res = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Layer order is part of the ETag
+        res = client.get(url + "?order=oldest")
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(res['ETag'], etag)
+
+        res = client.get(url + "?tasks={}".format(older.id))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+        res = client.get("/api/projects/{}/orthophoto/tiles/{}/{}/{}@2x.png?size=512".format(project.id, z, x, y))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+        # Invalid parameters
+        res = client.get(url + "?order=invalid")
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        res = client.get(url + "?tasks=invalid")
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Outside of bounds / no rasters
+        res = client.get("/api/projects/{}/orthophoto/tiles/{}/0/0.png".format(project.id, z))
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+        res = client.get("/api/projects/{}/dsm/tiles/{}/{}/{}.png".format(project.id, z, x, y))
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+        res = client.get("/api/projects/999999/orthophoto/tiles/{}/{}/{}.png".format(z, x, y))
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
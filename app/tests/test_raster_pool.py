@@ -0,0 +1,85 @@
+import os
+import tempfile
+import shutil
+from django.test import TestCase
+
+from app.raster_pool import DatasetPool
+
+
+class TestRasterPool(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.asset = os.path.join(self.tmpdir, "orthophoto.tif")
+        shutil.copy(os.path.join("app", "fixtures", "orthophoto.tif"), self.asset)
+        self.pool = DatasetPool(2)
+        self.opened = []
+
+    def tearDown(self):
+        self.pool.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def opener(self, path):
+        handle = Handle(path)
+        self.opened.append(handle)
+        return handle
+
+    def test_reuse(self):
+        with self.pool.borrow('cog', self.asset, self.opener) as h1:
+            pass
+        with self.pool.borrow('cog', self.asset, self.opener) as h2:
+            pass
+
+        # Handles are reused
+        self.assertEqual(h1, h2)
+        self.assertEqual(len(self.opened), 1)
+        self.assertFalse(h1.closed)
+
+        # Concurrent borrowers get different handles
+        with self.pool.borrow('cog', self.asset, self.opener) as h1:
+            with self.pool.borrow('cog', self.asset, self.opener) as h2:
+                self.assertNotEqual(h1, h2)
+        self.assertEqual(self.pool.idle_count, 2)
+
+        # Kinds are pooled separately
+        with self.pool.borrow('raster', self.asset, self.opener) as h3:
+            self.assertNotIn(h3, [h1, h2])
+
+        # Least recently used handles are closed
+        self.assertEqual(self.pool.idle_count, 2)
+        self.assertEqual(len([h for h in self.opened if h.closed]), 1)
+
+    def test_invalidation(self):
+        with self.pool.borrow('cog', self.asset, self.opener) as h1:
+            pass
+
+        # File changed
+        st = os.stat(self.asset)
+        os.utime(self.asset, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+
+        with self.pool.borrow('cog', self.asset, self.opener) as h2:
+            pass
+
+        self.assertNotEqual(h1, h2)
+        self.assertTrue(h1.closed)
+        self.assertFalse(h2.closed)
+        self.assertEqual(self.pool.idle_count, 1)
+
+        # Handles are returned to the pool after non-raster errors
+        with self.assertRaises(ValueError):
+            with self.pool.borrow('cog', self.asset, self.opener) as h3:
+                raise ValueError("test")
+        self.assertEqual(h3, h2)
+        self.assertEqual(self.pool.idle_count, 1)
+
+        self.pool.invalidate(self.tmpdir)
+        self.assertTrue(h2.closed)
+        self.assertEqual(self.pool.idle_count, 0)
+
+
+class Handle:
+    def __init__(self, path):
+        self.path = path
+        self.closed = False
+
+    def close(self):
+        self.closed = True
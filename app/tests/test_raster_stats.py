@@ -0,0 +1,91 @@
+import os
+import tempfile
+import shutil
+from django.test import TestCase
+
+from app import raster_stats
+
+
+class TestRasterStats(TestCase):
+    def setUp(self):
+        self.task = StubTask(tempfile.mkdtemp())
+        shutil.copy(os.path.join("app", "fixtures", "orthophoto.tif"), self.task.get_asset_download_path("orthophoto.tif"))
+
+    def tearDown(self):
+        shutil.rmtree(self.task.root)
+
+    def test_sidecar(self):
+        self.assertIsNone(raster_stats.get(self.task, 'orthophoto'))
+        self.assertIsNone(raster_stats.get(self.task, 'dsm'))
+
+        raster_stats.generate(self.task)
+        self.assertTrue(os.path.isfile(self.task.data_path(raster_stats.STATS_FILE)))
+
+        md = raster_stats.get(self.task, 'orthophoto')
+        self.assertTrue(len(md['statistics']) >= 3)
+        self.assertTrue('histogram' in md['statistics']['1'])
+        self.assertTrue(md['statistics']['1']['min'] <= md['statistics']['1']['max'])
+
+        # Built-in formulas are precomputed
+        md = raster_stats.get(self.task, 'orthophoto', '(b2-b1)/(b2+b1-b3)', (-1, 1))
+        self.assertIsNotNone(md)
+        self.assertEqual(len(md['statistics']), 1)
+
+        # Other ranges are not
+        self.assertIsNone(raster_stats.get(self.task, 'orthophoto', '(b2-b1)/(b2+b1-b3)', (-0.5, 0.5)))
+
+        # But can be added
+        raster_stats.put(self.task, 'orthophoto', {('(b2-b1)/(b2+b1-b3)', (-0.5, 0.5)): {'test': True}})
+        self.assertEqual(raster_stats.get(self.task, 'orthophoto', '(b2-b1)/(b2+b1-b3)', (-0.5, 0.5)), {'test': True})
+        self.assertIsNotNone(raster_stats.get(self.task, 'orthophoto'))
+
+        # Changing the asset invalidates the statistics
+        asset = self.task.get_asset_download_path("orthophoto.tif")
+        st = os.stat(asset)
+        os.utime(asset, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        self.assertIsNone(raster_stats.get(self.task, 'orthophoto'))
+
+    def test_cache(self):
+        geom = {'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]]}
+        same_geom = {'type': 'Feature', 'properties': {}, 'geometry': {
+                        'type': 'Polygon', 'coordinates': [[[1, 0], [1, 1], [0, 1], [0, 0], [1, 0]]]}}
+        other_geom = {'type': 'Polygon', 'coordinates': [[[0, 0], [2, 0], [2, 2], [0, 2], [0, 0]]]}
+
+        key = raster_stats.get_cache_key(self.task, 'orthophoto', None, None, geom)
+        self.assertEqual(key, raster_stats.get_cache_key(self.task, 'orthophoto', None, None, same_geom))
+        self.assertNotEqual(key, raster_stats.get_cache_key(self.task, 'orthophoto', None, None, other_geom))
+        self.assertNotEqual(key, raster_stats.get_cache_key(self.task, 'orthophoto', 'b1', (-1, 1), geom))
+        self.assertIsNone(raster_stats.get_cache_key(self.task, 'dsm', None, None, geom))
+
+        self.assertIsNone(raster_stats.cache_get(key))
+        raster_stats.cache_set(key, {'statistics': {'1': {'min': 0}}})
+
+        md = raster_stats.cache_get(key)
+        self.assertEqual(md['statistics']['1']['min'], 0)
+
+        # Callers get their own copy
+        md['statistics']['1']['min'] = 1
+        self.assertEqual(raster_stats.cache_get(key)['statistics']['1']['min'], 0)
+
+        # Changing the asset changes the key
+        asset = self.task.get_asset_download_path("orthophoto.tif")
+        st = os.stat(asset)
+        os.utime(asset, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        self.assertNotEqual(key, raster_stats.get_cache_key(self.task, 'orthophoto', None, None, geom))
+
+
+class StubTask:
+    def __init__(self, root):
+        self.root = root
+        self.id = os.path.basename(root)
+        self.epsg = None
+        self.orthophoto_bands = [{'name': 'red', 'description': 'red'},
+                                 {'name': 'green', 'description': 'green'},
+                                 {'name': 'blue', 'description': 'blue'},
+                                 {'name': 'alpha', 'description': None}]
+
+    def data_path(self, *args):
+        return os.path.join(self.root, "data", *args)
+
+    def get_asset_download_path(self, asset):
+        return os.path.join(self.root, asset)
@@ -0,0 +1,257 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import rasterio
+import numpy as np
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+from django.contrib.gis.geos import Polygon
+from django.test import TestCase
+
+from app import benchmark
+from app.cogeo import valid_cogeo
+from app.raster_utils import process_windows, export_raster, compute_block_aligned_subwindows, WindowCache, get_overview_factors
+
+
+class TestRasterUtils(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_process_windows(self):
+        lock = threading.Lock()
+        in_flight = 0
+        max_in_flight = 0
+        written = []
+
+        def read(w):
+            nonlocal in_flight, max_in_flight
+            with lock:
+                in_flight += 1
+                max_in_flight = max(max_in_flight, in_flight)
+            time.sleep(0.001 * (w % 3))
+            return w * 2
+
+        def compute(w, data):
+            time.sleep(0.001 * (w % 5))
+            return data + 1
+
+        def write(w, result):
+            nonlocal in_flight
+            with lock:
+                in_flight -= 1
+            written.append((w, result))
+
+        for threads in [1, 4]:
+            written = []
+            max_in_flight = 0
+            process_windows(range(50), read, compute, write, threads)
+
+            # Writes are in order and memory is bounded
+            self.assertEqual(written, [(w, w * 2 + 1) for w in range(50)])
+            self.assertTrue(max_in_flight <= threads * 2)
+
+        def fail(w, data):
+            raise ValueError("Compute failed")
+
+        with self.assertRaises(ValueError):
+            process_windows(range(10), read, fail, write, 4)
+
+    def test_parallel_export(self):
+        dsm = os.path.join(self.tmpdir, "dsm.tif")
+        benchmark.make_synthetic_raster(dsm, 'dsm', 1200)
+        multispectral = os.path.join(self.tmpdir, "multispectral.tif")
+        benchmark.make_synthetic_raster(multispectral, 'multispectral', 1200)
+
+        cases = [
+            (dsm, {'format': 'gtiff-rgb', 'color_map': 'viridis', 'hillshade': 6, 'rescale': [240, 280], 'asset_type': 'dsm'}),
+            (dsm, {'format': 'gtiff', 'asset_type': 'dsm'}),
+            (multispectral, {'format': 'gtiff', 'expression': '(b4 - b3) / (b4 + b3)', 'asset_type': 'orthophoto'}),
+            (multispectral, {'format': 'gtiff-rgb', 'expression': '(b4 - b3) / (b4 + b3)', 'color_map': 'rdylgn', 'rescale': [-1, 1], 'asset_type': 'orthophoto'}),
+        ]
+
+        # Parallel exports match sequential exports
+        for i, (input, opts) in enumerate(cases):
+            sequential = os.path.join(self.tmpdir, "sequential{}.tif".format(i))
+            parallel = os.path.join(self.tmpdir, "parallel{}.tif".format(i))
+            progress = []
+            export_raster(input, sequential, threads=1, **opts)
+            export_raster(input, parallel, progress_callback=lambda s, p: progress.append(p), threads=4, **opts)
+
+            with rasterio.open(sequential) as a, rasterio.open(parallel) as b:
+                self.assertEqual(a.count, b.count)
+                self.assertEqual(a.colorinterp, b.colorinterp)
+                self.assertTrue(np.array_equal(a.read(), b.read()))
+
+            self.assertTrue(all(p <= 100 for p in progress))
+
+    def test_block_aligned_windows(self):
+        dsm = os.path.join(self.tmpdir, "dsm.tif")
+        benchmark.make_synthetic_raster(dsm, 'dsm', 1200)
+
+        with rasterio.open(dsm) as src:
+            block_height, block_width = src.block_shapes[0]
+
+            # Full raster and a crop window that is not aligned to blocks
+            for win in [Window(0, 0, src.width, src.height), Window(100, 75, 700, 900)]:
+                subwins = compute_block_aligned_subwindows(src, win, 512, 1024)
+                col_end = win.col_off + win.width
+                row_end = win.row_off + win.height
+
+                # Windows start and end at block boundaries (or at the edges of win)
+                # and cover win exactly once
+                coverage = np.zeros((src.height, src.width), dtype=np.uint8)
+                for w, dst_w in subwins:
+                    self.assertTrue(w.col_off % block_width == 0 or w.col_off == win.col_off)
+                    self.assertTrue(w.row_off % block_height == 0 or w.row_off == win.row_off)
+                    self.assertTrue((w.col_off + w.width) % block_width == 0 or w.col_off + w.width == col_end)
+                    self.assertTrue((w.row_off + w.height) % block_height == 0 or w.row_off + w.height == row_end)
+                    self.assertEqual((w.col_off - win.col_off, w.row_off - win.row_off), (dst_w.col_off, dst_w.row_off))
+                    self.assertTrue(w.width <= 1024 and w.height <= 512)
+                    coverage[w.row_off:w.row_off+w.height, w.col_off:w.col_off+w.width] += 1
+                self.assertTrue(np.all(coverage[win.row_off:row_end, win.col_off:col_end] == 1))
+                self.assertEqual(coverage.sum(), win.width * win.height)
+
+                # Padded reads from the cache match boundless reads (limited to win),
+                # with each window read only once
+                reads = []
+                def read(w):
+                    reads.append(w)
+                    return src.read(indexes=[1], window=w)
+
+                cache = WindowCache(subwins, read, capacity=len(subwins))
+                for w, _ in subwins:
+                    padded = Window(w.col_off - 16, w.row_off - 16, w.width + 32, w.height + 32)
+                    expected = src.read(indexes=[1], window=padded, boundless=True, fill_value=-9999)
+                    rows = np.arange(padded.row_off, padded.row_off + padded.height)
+                    cols = np.arange(padded.col_off, padded.col_off + padded.width)
+                    outside = ~(((rows >= win.row_off) & (rows < row_end))[:, None] & ((cols >= win.col_off) & (cols < col_end))[None, :])
+                    expected[:, outside] = -9999
+                    self.assertTrue(np.array_equal(cache.read_padded(w, 16, -9999), expected))
+                self.assertEqual(len(reads), len(subwins))
+
+    def test_window_planners(self):
+        dsm = os.path.join(self.tmpdir, "dsm.tif")
+        benchmark.make_synthetic_raster(dsm, 'dsm', 1200)
+        rgb = os.path.join(self.tmpdir, "rgb.tif")
+        benchmark.make_synthetic_raster(rgb, 'rgb', 1200)
+
+        cases = [
+            (dsm, {'format': 'gtiff-rgb', 'color_map': 'viridis', 'hillshade': 6, 'rescale': [240, 280], 'asset_type': 'dsm'}),
+            (dsm, {'format': 'gtiff', 'asset_type': 'dsm'}),
+            (rgb, {'format': 'gtiff', 'asset_type': 'orthophoto'}),
+            (rgb, {'format': 'gtiff', 'expression': '(b1 - b2) / (b1 + b2)', 'asset_type': 'orthophoto'}),
+        ]
+
+        # Block aligned windows produce the same output as fixed windows
+        for i, (input, opts) in enumerate(cases):
+            fixed = os.path.join(self.tmpdir, "fixed{}.tif".format(i))
+            blocks = os.path.join(self.tmpdir, "blocks{}.tif".format(i))
+            export_raster(input, fixed, window_planner='fixed', threads=4, **opts)
+            export_raster(input, blocks, window_planner='blocks', threads=4, **opts)
+
+            with rasterio.open(fixed) as a, rasterio.open(blocks) as b:
+                self.assertEqual(a.count, b.count)
+                self.assertTrue(np.array_equal(a.read(), b.read()))
+
+    def test_reprojection_parity(self):
+        dsm = os.path.join(self.tmpdir, "dsm.tif")
+        benchmark.make_synthetic_raster(dsm, 'dsm', 1000)
+        rgb = os.path.join(self.tmpdir, "rgb.tif")
+        benchmark.make_synthetic_raster(rgb, 'rgb', 1000)
+
+        for input, asset_type, resampling in [(dsm, 'dsm', 'bilinear'), (rgb, 'orthophoto', 'near')]:
+            # Output of the previous gdalwarp based pipeline
+            expected = os.path.join(self.tmpdir, "expected-{}.tif".format(asset_type))
+            subprocess.check_output(["gdalwarp", "-r", resampling, "-t_srs", "EPSG:4326", input, expected])
+
+            output = os.path.join(self.tmpdir, "{}.tif".format(asset_type))
+            export_raster(input, output, format='gtiff', epsg=4326, asset_type=asset_type)
+
+            with rasterio.open(expected) as a, rasterio.open(output) as b:
+                self.assertEqual(b.crs.to_epsg(), 4326)
+                self.assertEqual((a.width, a.height), (b.width, b.height))
+                self.assertTrue(b.transform.almost_equals(a.transform))
+                self.assertEqual(b.profile['blockxsize'], 512)
+
+                da = a.read()
+                db = b.read()
+                self.assertTrue(np.mean(np.isclose(da, db, atol=1e-3)) > 0.99)
+
+    def test_crop_parity(self):
+        dsm = os.path.join(self.tmpdir, "dsm.tif")
+        benchmark.make_synthetic_raster(dsm, 'dsm', 1000)
+
+        with rasterio.open(dsm) as src:
+            west, south, east, north = transform_bounds(src.crs, "EPSG:4326", *src.bounds)
+        crop = Polygon([(west + (east - west) * 0.2, south + (north - south) * 0.2),
+                        (west + (east - west) * 0.7, south + (north - south) * 0.3),
+                        (west + (east - west) * 0.4, south + (north - south) * 0.8),
+                        (west + (east - west) * 0.2, south + (north - south) * 0.2)], srid=4326)
+
+        # Output of the previous gdalwarp based pipeline
+        crop_geojson = os.path.join(self.tmpdir, "crop.geojson")
+        with open(crop_geojson, "w", encoding="utf-8") as f:
+            f.write(crop.geojson)
+        expected = os.path.join(self.tmpdir, "expected.tif")
+        subprocess.check_output(["gdalwarp", "-cutline", crop_geojson, "--config", "GDALWARP_DENSIFY_CUTLINE", "NO",
+                                 "-crop_to_cutline", "-r", "bilinear", dsm, expected])
+
+        for opts in [{'format': 'gtiff'}, {'format': 'gtiff', 'epsg': 4326}]:
+            output = os.path.join(self.tmpdir, "cropped.tif")
+            export_raster(dsm, output, asset_type='dsm', crop=crop.wkt, **opts)
+
+            with rasterio.open(output) as dst:
+                data = dst.read(1)
+                valid = data != dst.nodata
+
+                # Pixels outside of the crop area are nodata
+                west, south, east, north = transform_bounds(dst.crs, "EPSG:4326", *dst.bounds)
+                self.assertTrue(np.any(valid))
+                self.assertTrue(np.any(~valid))
+                self.assertTrue(crop.extent[0] - 1e-5 <= west and east <= crop.extent[2] + 1e-5)
+
+                if 'epsg' not in opts:
+                    with rasterio.open(expected) as a:
+                        self.assertTrue(abs(a.width - dst.width) <= 1 and abs(a.height - dst.height) <= 1)
+                        expected_valid = a.read(1) != a.nodata
+                        self.assertTrue(abs(int(np.sum(expected_valid)) - int(np.sum(valid))) / np.sum(expected_valid) < 0.02)
+
+    def test_cog_export(self):
+        dsm = os.path.join(self.tmpdir, "dsm.tif")
+        benchmark.make_synthetic_raster(dsm, 'dsm', 1200)
+        rgb = os.path.join(self.tmpdir, "rgb.tif")
+        benchmark.make_synthetic_raster(rgb, 'rgb', 1200)
+
+        self.assertEqual(get_overview_factors(1200, 1200), [2, 4])
+        self.assertEqual(get_overview_factors(512, 300), [])
+
+        for input, opts in [(dsm, {'asset_type': 'dsm'}),
+                            (dsm, {'asset_type': 'dsm', 'compress': 'LERC', 'epsg': 4326}),
+                            (rgb, {'asset_type': 'orthophoto', 'compress': 'WEBP'}),
+                            (rgb, {'asset_type': 'orthophoto', 'compress': 'JPEG', 'window_planner': 'fixed'})]:
+            output = os.path.join(self.tmpdir, "export.tif")
+            export_raster(input, output, format='cog', **opts)
+
+            self.assertTrue(valid_cogeo(output))
+            with rasterio.open(output) as dst:
+                self.assertEqual(dst.overviews(1), [2, 4])
+                self.assertEqual(dst.profile['blockxsize'], 512)
+
+                # Overviews are decimated from the full resolution data
+                if opts.get('compress') is None:
+                    full = dst.read(1)
+                    with rasterio.open(output, OVERVIEW_LEVEL=0) as ovr:
+                        self.assertTrue(np.array_equal(ovr.read(1), full[::2, ::2]))
+
+            # Temporary files are removed
+            self.assertEqual(sorted(os.listdir(self.tmpdir)), ["dsm.tif", "export.tif", "rgb.tif"])
+
+        # JPEG requires 8-bit RGB
+        with self.assertRaises(ValueError):
+            export_raster(dsm, os.path.join(self.tmpdir, "invalid.tif"), format='cog', asset_type='dsm', compress='JPEG')
@@ -0,0 +1,185 @@
+import io
+import os
+import re
+import shutil
+import zipfile
+import tempfile
+import threading
+import requests
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from django.test import TestCase
+
+from app import remotezip
+
+
+class ZipHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        data = server.data
+        m = re.match(r"bytes=(\d+)-(\d+)", self.headers.get('Range', ''))
+        if m is None or not server.ranges:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        start, end = int(m.group(1)), min(int(m.group(2)), len(data) - 1)
+        body = data[start:end + 1]
+        server.requests.append(start)
+
+        if server.fail_from is not None and start >= server.fail_from:
+            self.send_error(server.fail_status)
+            return
+
+        # Corrupt the first large member transfers
+        if end - start > 100000 and server.corrupt > 0:
+            server.corrupt -= 1
+            body = body[:50000] + bytes([body[50000] ^ 0xff]) + body[50001:]
+
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data)))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestRemoteZip(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w") as z:
+            z.writestr("odm_orthophoto/", "")
+            z.writestr("odm_orthophoto/odm_orthophoto.tif", os.urandom(500000), compress_type=zipfile.ZIP_DEFLATED)
+            z.writestr("odm_report/report.txt", b"report" * 50000, compress_type=zipfile.ZIP_DEFLATED)
+            z.writestr("images.json", b"[]", compress_type=zipfile.ZIP_STORED)
+            z.writestr("empty.txt", b"")
+        self.archive = buf.getvalue()
+
+        self.server = HTTPServer(('127.0.0.1', 0), ZipHandler)
+        self.server.data = self.archive
+        self.server.ranges = True
+        self.server.corrupt = 0
+        self.server.fail_from = None
+        self.server.fail_status = 503
+        self.server.requests = []
+        self.url = "http://127.0.0.1:{}/all.zip".format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def assertExtracted(self):
+        with zipfile.ZipFile(io.BytesIO(self.archive)) as z:
+            for info in z.infolist():
+                path = os.path.join(self.tmpdir, info.filename)
+                if info.is_dir():
+                    self.assertTrue(os.path.isdir(path))
+                else:
+                    with open(path, "rb") as f:
+                        self.assertEqual(f.read(), z.read(info))
+                    self.assertFalse(os.path.exists(path + ".part"))
+
+    def test_extract(self):
+        progress = []
+        paths = remotezip.extract(self.url, self.tmpdir, progress.append, parallel_downloads=4)
+        self.assertEqual(len(paths), 5)
+        self.assertEqual(progress[-1], 100.0)
+        self.assertExtracted()
+
+    def test_corrupted_members(self):
+        # Corrupted members are downloaded again
+        self.server.corrupt = 2
+        remotezip.extract(self.url, self.tmpdir, parallel_downloads=2)
+        self.assertEqual(self.server.corrupt, 0)
+        self.assertExtracted()
+
+        # Until they're not
+        self.server.corrupt = 100
+        with self.assertRaises(zipfile.BadZipFile):
+            remotezip.extract(self.url, self.tmpdir)
+
+    def test_no_range_requests(self):
+        self.server.ranges = False
+        with self.assertRaises(remotezip.RangeRequestsNotSupported):
+            remotezip.extract(self.url, self.tmpdir)
+
+    def test_resumable_download(self):
+        output = os.path.join(self.tmpdir, "all.zip.download")
+        chunk_size = 64 * 1024
+        chunks = (len(self.archive) + chunk_size - 1) // chunk_size
+
+        # Interrupted downloads keep track of the downloaded chunks
+        self.server.fail_from = chunk_size * 3
+        with self.assertRaises(IOError):
+            remotezip.download(self.url, output, parallel_downloads=1, chunk_size=chunk_size)
+        self.assertEqual(len(remotezip.load_state(output)['chunks']), 3)
+
+        # And only download the missing chunks when resumed
+        self.server.fail_from = None
+        self.server.requests = []
+        progress = []
+        remotezip.download(self.url, output, progress.append, parallel_downloads=4, chunk_size=chunk_size)
+        self.assertEqual(len(self.server.requests), 1 + chunks - 3)
+        self.assertEqual(progress[-1], 100.0)
+        with open(output, "rb") as f:
+            self.assertEqual(f.read(), self.archive)
+        self.assertEqual(remotezip.find_corrupted_ranges(output), [])
+
+        # Chunks that do not match their checksum are downloaded again
+        with open(output, "r+b") as f:
+            f.write(b"XX")
+        self.server.requests = []
+        remotezip.download(self.url, output, chunk_size=chunk_size)
+        self.assertEqual(self.server.requests, [0, 0])
+
+        # Corrupted members are located and only their chunks are downloaded again
+        with zipfile.ZipFile(output) as z:
+            report = z.getinfo("odm_report/report.txt")
+        with open(output, "r+b") as f:
+            f.seek(report.header_offset + 100)
+            f.write(b"XXXX")
+        ranges = remotezip.find_corrupted_ranges(output)
+        self.assertEqual(len(ranges), 1)
+        self.assertEqual(ranges[0][0], report.header_offset)
+
+        invalidated = remotezip.invalidate_corrupted(output)
+        self.assertTrue(0 < invalidated < chunks)
+        self.server.requests = []
+        remotezip.download(self.url, output, chunk_size=chunk_size)
+        self.assertEqual(len(self.server.requests), 1 + invalidated)
+        with open(output, "rb") as f:
+            self.assertEqual(f.read(), self.archive)
+
+        # Downloads of other files start over
+        self.server.data = self.archive + b"\0"
+        self.server.requests = []
+        remotezip.download(self.url, output, chunk_size=chunk_size)
+        self.assertEqual(len(self.server.requests), 1 + (len(self.server.data) + chunk_size - 1) // chunk_size)
+
+        remotezip.remove_download(output)
+        self.assertFalse(os.path.exists(output))
+        self.assertFalse(os.path.exists(remotezip.get_state_path(output)))
+
+        # Client errors are not retried
+        self.server.fail_from = 0
+        self.server.fail_status = 404
+        self.server.requests = []
+        with self.assertRaises(requests.exceptions.HTTPError) as cm:
+            remotezip.download(self.url, output)
+        self.assertFalse(remotezip.is_transient_error(cm.exception))
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertTrue(remotezip.is_transient_error(remotezip.IncompleteChunk()))
+        self.assertTrue(remotezip.is_transient_error(requests.exceptions.ConnectionError()))
+        self.assertFalse(remotezip.is_transient_error(OSError()))
+
+        self.server.fail_from = None
+        self.server.ranges = False
+        with self.assertRaises(remotezip.RangeRequestsNotSupported):
+            remotezip.download(self.url, output)
@@ -0,0 +1,54 @@
+import numpy as np
+from django.test import TestCase
+
+from app import benchmark
+from app.api.hillshade import LightSource
+from app.api.hsvblend import hsv_blend
+from app.api.shaded_relief import shaded_relief
+
+
+class TestShadedRelief(TestCase):
+    def test_parity(self):
+        rng = np.random.default_rng(42)
+        pad = 16
+
+        for tilesize, dx, dy, vert_exag in [(256, 0.5, -0.5, 6), (512, 2.0, -2.0, 1), (100, 0.1, -0.3, 12)]:
+            size = tilesize + pad * 2
+            y, x = np.mgrid[0:size, 0:size].astype(np.float32)
+            elevation = (250 + 20 * np.sin(x / 17.0) * np.cos(y / 23.0) + rng.standard_normal((size, size))).astype(np.float32)
+
+            # Nodata corners, like the tiler sets them
+            elevation[0:pad, 0:pad] = -9999
+            elevation[-pad:, -pad:] = -9999
+
+            rgb = rng.integers(0, 256, (3, tilesize, tilesize), dtype=np.uint8)
+            rgb[:, 0:10, 0:10] = 0 # black
+            rgb[:, 10:20, 10:20] = 128 # gray
+
+            intensity = LightSource(azdeg=315, altdeg=45).hillshade(elevation, dx=dx, dy=dy, vert_exag=vert_exag)
+            expected = hsv_blend(rgb.copy(), intensity[pad:pad+tilesize, pad:pad+tilesize] * 255.0)
+
+            result = shaded_relief(rgb, elevation, dx, dy, vert_exag=vert_exag, pad=pad)
+            self.assertEqual(result.shape, (3, tilesize, tilesize))
+            self.assertEqual(result.dtype, np.uint8)
+
+            # Differences are limited to rounding
+            diff = np.abs(result.astype(np.int16) - expected.astype(np.int16))
+            self.assertTrue(diff.max() <= 1)
+            self.assertTrue(np.count_nonzero(diff) / diff.size < 0.01)
+
+            # Input is not modified and results are not shared between calls
+            again = shaded_relief(rgb, elevation, dx, dy, vert_exag=vert_exag, pad=pad)
+            self.assertTrue(np.array_equal(result, again))
+            self.assertFalse(np.shares_memory(result, again))
+
+    def test_invalid(self):
+        rgb = np.zeros((3, 256, 256), dtype=np.uint8)
+        with self.assertRaises(ValueError):
+            shaded_relief(rgb, np.zeros((256, 256), dtype=np.float32), 1, -1, pad=0)
+        with self.assertRaises(ValueError):
+            shaded_relief(rgb, np.zeros((260, 260), dtype=np.float32), 1, -1, pad=16)
+
+    def test_benchmark(self):
+        results = {r['case']: r for r in benchmark.run_hillshade_kernel(iterations=2, tilesizes=(256,))}
+        self.assertTrue(results['hillshade/256/shaded_relief']['peak_memory'] < results['hillshade/256/legacy']['peak_memory'])
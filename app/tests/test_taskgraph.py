@@ -0,0 +1,62 @@
+import time
+import threading
+from django.test import TestCase
+
+from app.taskgraph import run_graph
+
+
+class TestTaskGraph(TestCase):
+    def test_run_graph(self):
+        order = []
+        lock = threading.Lock()
+
+        def step(name, delay=0):
+            def run():
+                time.sleep(delay)
+                with lock:
+                    order.append(name)
+            return run
+
+        completed = []
+        durations = run_graph([
+            ("a", step("a", 0.2), []),
+            ("b", step("b", 0.2), []),
+            ("c", step("c"), ["a"]),
+            ("d", step("d"), ["b", "c"]),
+        ], max_workers=2, on_done=lambda name, duration: completed.append(name))
+
+        self.assertEqual(set(durations.keys()), {"a", "b", "c", "d"})
+        self.assertEqual(sorted(completed), sorted(order))
+
+        # Dependencies complete first
+        self.assertTrue(order.index("c") > order.index("a"))
+        self.assertEqual(order[-1], "d")
+
+        # Independent steps run concurrently
+        start = time.time()
+        run_graph([(str(i), step(str(i), 0.2), []) for i in range(4)], max_workers=4)
+        self.assertTrue(time.time() - start < 0.6)
+
+    def test_errors(self):
+        ran = []
+
+        def fail():
+            raise IOError("Failed")
+
+        with self.assertRaises(IOError):
+            run_graph([
+                ("a", fail, []),
+                ("b", lambda: ran.append("b"), ["a"]),
+            ])
+
+        # Dependent steps do not run
+        self.assertEqual(ran, [])
+
+        with self.assertRaises(ValueError):
+            run_graph([("a", lambda: None, ["missing"])])
+
+        with self.assertRaises(ValueError):
+            run_graph([("a", lambda: None, ["b"]), ("b", lambda: None, ["a"])])
+
+        with self.assertRaises(ValueError):
+            run_graph([("a", lambda: None, []), ("a", lambda: None, [])])
@@ -0,0 +1,78 @@
+import os
+import time
+import tempfile
+import shutil
+from django.test import TestCase
+
+from app import tilecache
+
+
+class TestTileCache(TestCase):
+    def setUp(self):
+        tilecache.clear()
+        self.tmpdir = tempfile.mkdtemp()
+        self.asset = os.path.join(self.tmpdir, "orthophoto.tif")
+        shutil.copy(os.path.join("app", "fixtures", "orthophoto.tif"), self.asset)
+
+    def tearDown(self):
+        tilecache.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def test_keys(self):
+        params = {'z': 18, 'x': 1, 'y': 2, 'formula': None}
+        key = tilecache.get_key("task1", self.asset, params)
+        self.assertEqual(key, tilecache.get_key("task1", self.asset, dict(params)))
+
+        # Parameters, tasks and assets affect the key
+        self.assertNotEqual(key, tilecache.get_key("task1", self.asset, {**params, 'formula': 'NDVI'}))
+        self.assertNotEqual(key, tilecache.get_key("task2", self.asset, params))
+        self.assertTrue(key.startswith("task1/"))
+
+        # Rewriting the asset invalidates the key
+        st = os.stat(self.asset)
+        os.utime(self.asset, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        self.assertNotEqual(key, tilecache.get_key("task1", self.asset, params))
+
+        # Missing assets have no key
+        self.assertIsNone(tilecache.get_key("task1", os.path.join(self.tmpdir, "missing.tif"), params))
+
+    def test_get_set(self):
+        key = tilecache.get_key("task1", self.asset, {'z': 1})
+        self.assertIsNone(tilecache.get(key))
+        self.assertIsNone(tilecache.get(None))
+
+        tilecache.set(key, b"\x89PNG\nabc", "png")
+        data, ext = tilecache.get(key)
+        self.assertEqual(data, b"\x89PNG\nabc")
+        self.assertEqual(ext, "png")
+
+        # Task invalidation
+        tilecache.clear_task("task1")
+        self.assertIsNone(tilecache.get(key))
+
+    def test_evict(self):
+        keys = []
+        for i in range(10):
+            k = tilecache.get_key("task1", self.asset, {'z': i})
+            tilecache.set(k, b"0" * 1024 * 200, "png")
+            keys.append(k)
+
+            # Make sure modification times differ
+            t = time.time() - 100 + i
+            os.utime(tilecache._key_path(k), (t, t))
+
+        # Access the oldest tile, it should survive eviction
+        self.assertIsNotNone(tilecache.get(keys[0]))
+
+        removed, freed = tilecache.evict(1)
+        self.assertTrue(removed > 0)
+        self.assertTrue(freed > 0)
+        self.assertIsNotNone(tilecache.get(keys[0]))
+        self.assertIsNone(tilecache.get(keys[1]))
+        self.assertIsNotNone(tilecache.get(keys[-1]))
+
+        stats = tilecache.get_stats()
+        self.assertTrue(stats['tiles'] < 10)
+        self.assertTrue(stats['size'] <= 1)
+        self.assertTrue(stats['hits'] > 0)
+        self.assertTrue(stats['misses'] > 0)
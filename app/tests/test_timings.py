@@ -0,0 +1,65 @@
+from django.http import HttpResponse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from app import timings
+from app.timings import StageTimer
+from .classes import BootTestCase
+
+
+class TestTimings(BootTestCase):
+    def setUp(self):
+        timings.clear()
+
+    def tearDown(self):
+        timings.clear()
+
+    def test_stage_timer(self):
+        # Disabled timers do nothing
+        timer = StageTimer(False)
+        timer.lap('open')
+        timer.group = 'test'
+        res = timer.finish(HttpResponse())
+        self.assertFalse(res.has_header('Server-Timing'))
+        self.assertEqual(len(timings.get_histograms()), 0)
+
+        timer = StageTimer(True)
+        timer.lap('open')
+        timer.lap('read')
+        timer.lap('read')
+        timer.group = 'tile/orthophoto'
+        res = timer.finish(HttpResponse())
+
+        header = res.get('Server-Timing')
+        self.assertTrue(header.startswith('open;dur='))
+        self.assertTrue(', read;dur=' in header)
+        self.assertTrue(', total;dur=' in header)
+        self.assertEqual(header.count('read;'), 1)
+
+        histograms = timings.get_histograms()
+        self.assertEqual(list(histograms.keys()), ['tile/orthophoto'])
+        for stage in ['open', 'read', 'total']:
+            self.assertEqual(histograms['tile/orthophoto'][stage]['count'], 1)
+            self.assertEqual(sum(histograms['tile/orthophoto'][stage]['buckets'].values()), 1)
+
+        self.assertEqual(timings.get_bucket(0.5), '1')
+        self.assertEqual(timings.get_bucket(7), '10')
+        self.assertEqual(timings.get_bucket(99999), 'inf')
+
+    def test_metrics_api(self):
+        client = APIClient()
+        res = client.get("/api/admin/tiler/metrics")
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+
+        client.login(username="testuser", password="test1234")
+        res = client.get("/api/admin/tiler/metrics")
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+
+        client.login(username="testsuperuser", password="test1234")
+        res = client.get("/api/admin/tiler/metrics")
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertTrue('timings' in res.data)
+        self.assertTrue('hit_ratio' in res.data['tile_cache'])
+
+        res = client.delete("/api/admin/tiler/metrics")
+        self.assertEqual(res.status_code, status.HTTP_204_NO_CONTENT)
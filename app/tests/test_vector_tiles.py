@@ -0,0 +1,198 @@
+import os
+import json
+from django.contrib.auth.models import User
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from app import vector_tiles
+from app.models import Project, Task
+from nodeodm import status_codes
+from .classes import BootTestCase
+
+
+def read_varint(buf, i):
+    result = shift = 0
+    while True:
+        b = buf[i]
+        i += 1
+        result |= (b & 0x7f) << shift
+        shift += 7
+        if not b & 0x80:
+            return result, i
+
+
+def read_message(buf):
+    fields = []
+    i = 0
+    while i < len(buf):
+        key, i = read_varint(buf, i)
+        if key & 7 == 0:
+            value, i = read_varint(buf, i)
+        elif key & 7 == 1:
+            value = buf[i:i+8]
+            i += 8
+        else:
+            length, i = read_varint(buf, i)
+            value = buf[i:i+length]
+            i += length
+        fields.append((key >> 3, value))
+    return fields
+
+
+def decode_tile(buf):
+    """
+    :return: dictionary of layer name --> list of (x, y, properties)
+    """
+    result = {}
+    for _, layer in read_message(buf):
+        fields = read_message(layer)
+        name = [v for f, v in fields if f == 1][0].decode('utf-8')
+        keys = [v.decode('utf-8') for f, v in fields if f == 3]
+        values = []
+        for f, v in fields:
+            if f == 4:
+                vf, vv = read_message(v)[0]
+                values.append(vv.decode('utf-8') if vf == 1 else vv)
+        self_extent = [v for f, v in fields if f == 5][0]
+        assert self_extent == vector_tiles.EXTENT
+
+        features = []
+        for f, v in fields:
+            if f == 2:
+                feature = dict(read_message(v))
+                tags = []
+                i = 0
+                while i < len(feature.get(2, b"")):
+                    t, i = read_varint(feature[2], i)
+                    tags.append(t)
+                geometry = []
+                i = 0
+                while i < len(feature[4]):
+                    g, i = read_varint(feature[4], i)
+                    geometry.append(g)
+                assert feature[3] == 1 and geometry[0] == 9
+                unzigzag = lambda n: (n >> 1) ^ -(n & 1)
+                features.append((unzigzag(geometry[1]), unzigzag(geometry[2]),
+                                 {keys[tags[j]]: values[tags[j + 1]] for j in range(0, len(tags), 2)}))
+        result[name] = features
+    return result
+
+
+class TestVectorTiles(BootTestCase):
+    def test_encoding(self):
+        for v in [0, 1, 127, 128, 300, 2 ** 40]:
+            self.assertEqual(read_varint(vector_tiles.varint(v), 0)[0], v)
+        self.assertEqual(vector_tiles.zigzag(0), 0)
+        self.assertEqual(vector_tiles.zigzag(-1), 1)
+        self.assertEqual(vector_tiles.zigzag(1), 2)
+
+        # Codes of child tiles are within the range of the parent
+        parent = vector_tiles.interleave(3, 5)
+        for dx in range(2):
+            for dy in range(2):
+                self.assertEqual(vector_tiles.interleave(6 + dx, 10 + dy) >> 2, parent)
+
+        tile = vector_tiles.encode_layer("test", [(10, -20, 1, {'name': 'a', 'count': 2, 'list': [1, 2], 'none': None}),
+                                                  (4096, 4000, 2, {'name': 'a', 'negative': -3})])
+        layers = decode_tile(tile)
+        self.assertEqual(layers['test'][0], (10, -20, {'name': 'a', 'count': 2, 'list': '[1, 2]'}))
+        self.assertEqual(layers['test'][1][:2], (4096, 4000))
+        self.assertEqual(layers['test'][1][2]['name'], 'a')
+
+    def test_vector_tiles(self):
+        client = APIClient()
+        user = User.objects.get(username="testuser")
+        project = Project.objects.create(owner=user, name="Vector tiles")
+        task = Task.objects.create(project=project, name="Shots", status=status_codes.COMPLETED)
+
+        # 100 shots in a ~100m grid and 2 GCPs
+        shots_path = task.get_asset_download_path('shots.geojson')
+        os.makedirs(os.path.dirname(shots_path), exist_ok=True)
+        with open(shots_path, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': [{
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': [-91.99 + (i % 10) * 0.0001, 46.84 + (i // 10) * 0.0001, 300]},
+                'properties': {'filename': 'DJI_{:04d}.JPG'.format(i), 'focal': 0.85, 'rotation': [0.1, 0.2, 0.3]}
+            } for i in range(100)] + [{'type': 'Feature', 'geometry': None, 'properties': {}}]}, f)
+
+        gcp_path = task.get_asset_download_path('ground_control_points.geojson')
+        os.makedirs(os.path.dirname(gcp_path), exist_ok=True)
+        with open(gcp_path, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': [{
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': [-91.99 + i * 0.0005, 46.84, 300]},
+                'properties': {'id': 'gcp{}'.format(i)}
+            } for i in range(2)]}, f)
+
+        vector_tiles.generate(task)
+        index = vector_tiles.load_index(task)
+        self.assertEqual(len(index['shots'][1]), 100)
+        self.assertEqual(len(index['ground_control_points'][1]), 2)
+        self.assertEqual(len(index['media'][1]), 0)
+        self.assertEqual(index['shots'][0], sorted(index['shots'][0]))
+
+        def tile_of(lon, lat, z):
+            mx, my = vector_tiles.lonlat_to_mercator(lon, lat)
+            return z, int(mx * 2 ** z), int(my * 2 ** z)
+
+        url = "/api/projects/{}/tasks/{}/vector/tiles/{}/{}/{}.mvt"
+
+        # Private
+        res = client.get(url.format(project.id, task.id, *tile_of(-91.99, 46.84, 18)))
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+        client.login(username="testuser", password="test1234")
+        res = client.get(url.format(project.id, task.id, *tile_of(-91.9895, 46.8405, 20)))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['Content-Type'], "application/vnd.mapbox-vector-tile")
+        layers = decode_tile(res.content)
+        self.assertTrue(0 < len(layers['shots']) < 100)
+        for x, y, properties in layers['shots']:
+            self.assertTrue(-vector_tiles.BUFFER <= x <= vector_tiles.EXTENT + vector_tiles.BUFFER)
+            self.assertTrue(-vector_tiles.BUFFER <= y <= vector_tiles.EXTENT + vector_tiles.BUFFER)
+            self.assertTrue(properties['filename'].startswith('DJI_'))
+            self.assertEqual(json.loads(properties['rotation']), [0.1, 0.2, 0.3])
+
+        # All shots are visible at high zoom levels,
+        # but features are thinned at low zoom levels
+        z, x, y = tile_of(-91.99, 46.84, 16)
+        layers = decode_tile(client.get(url.format(project.id, task.id, z, x, y)).content)
+        self.assertEqual(len(layers['shots']), 100)
+        self.assertEqual(len(layers['ground_control_points']), 2)
+
+        z, x, y = tile_of(-91.99, 46.84, 8)
+        res = client.get(url.format(project.id, task.id, z, x, y))
+        layers = decode_tile(res.content)
+        self.assertEqual(len(layers['shots']), 1)
+
+        # Conditional requests
+        res = client.get(url.format(project.id, task.id, z, x, y), HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Layer selection
+        res = client.get(url.format(project.id, task.id, z, x, y) + "?layers=ground_control_points")
+        self.assertEqual(list(decode_tile(res.content).keys()), ['ground_control_points'])
+        res = client.get(url.format(project.id, task.id, z, x, y) + "?layers=invalid")
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Empty and invalid tiles
+        res = client.get(url.format(project.id, task.id, 16, 0, 0))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.content, b"")
+        res = client.get(url.format(project.id, task.id, 2, 4, 0))
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+        res = client.get(url.format(project.id, task.id, 25, 0, 0))
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+        # Media locations are indexed when they change
+        task.media = [{'filename': 'video.mp4', 'type': 'video', 'geolocation': [-91.99, 46.84]},
+                      {'filename': 'no_location.jpg', 'type': 'photo'}]
+        task.save()
+        vector_tiles.generate(task, ['media'])
+        res = client.get(url.format(project.id, task.id, z, x, y))
+        layers = decode_tile(res.content)
+        self.assertEqual(len(layers['media']), 1)
+        self.assertEqual(layers['media'][0][2]['filename'], 'video.mp4')
+        self.assertEqual(len(layers['shots']), 1)
+
+        self.assertTrue(task.get_map_items()['meta']['task']['vector_tiles'].endswith("/vector/tiles/{z}/{x}/{y}.mvt"))
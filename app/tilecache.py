@@ -0,0 +1,328 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import redis
+from webodm import settings
+
+logger = logging.getLogger('app.logger')
+redis_client = redis.Redis.from_url(settings.CELERY_BROKER_URL)
+
+STATS_KEY = 'tile_cache_stats'
+REDIS_KEY_PREFIX = 'tile_cache_'
+
+# Hit/miss counters are accumulated in memory
+# and flushed to redis periodically, so that we
+# don't pay a round trip to redis for each tile
+STATS_FLUSH_INTERVAL = 10
+
+_stats_lock = threading.Lock()
+_pending_stats = {'hits': 0, 'misses': 0}
+_last_stats_flush = 0
+
+
+def cache_dir(*args):
+    return os.path.join(settings.MEDIA_CACHE, "tiles", *args)
+
+
+def get_key(task_id, asset_path, params):
+    """
+    Compute a content-addressed key for a rendered tile
+    :param task_id: task ID
+    :param asset_path: path to the raster that is used to render the tile
+    :param params: dictionary with all parameters that affect the output (must be JSON serializable)
+    :return: cache key (string) or None if the asset cannot be found
+    """
+    try:
+        st = os.stat(asset_path)
+    except FileNotFoundError:
+        return None
+
+    # Any change to the asset (e.g. assets re-extraction or re-processing)
+    # changes the key, so stale tiles are never served
+    payload = json.dumps({
+        'asset': asset_path,
+        'mtime': st.st_mtime_ns,
+        'size': st.st_size,
+        'inode': st.st_ino,
+        'params': params
+    }, sort_keys=True, default=str)
+
+    return "{}/{}".format(task_id, hashlib.sha1(payload.encode('utf-8')).hexdigest())
+
+
+def get_mosaic_key(project_id, asset_paths, params):
+    """
+    Compute a content-addressed key for a tile composited from multiple rasters
+    :param project_id: project ID
+    :param asset_paths: list of paths to the rasters that are used to render the tile
+    :param params: dictionary with all parameters that affect the output (must be JSON serializable)
+    :return: cache key (string) or None if an asset cannot be found
+    """
+    assets = []
+    for asset_path in asset_paths:
+        try:
+            st = os.stat(asset_path)
+        except FileNotFoundError:
+            return None
+        assets.append([asset_path, st.st_mtime_ns, st.st_size, st.st_ino])
+
+    payload = json.dumps({
+        'assets': assets,
+        'params': params
+    }, sort_keys=True, default=str)
+
+    return "project-{}/{}".format(project_id, hashlib.sha1(payload.encode('utf-8')).hexdigest())
+
+
+def _key_path(key):
+    task_id, h = key.split("/")
+    return cache_dir(task_id, h[:2], h)
+
+
+def _encode(data, ext):
+    return ext.encode('ascii') + b"\n" + data
+
+
+def _decode(blob):
+    ext, data = blob.split(b"\n", 1)
+    return data, ext.decode('ascii')
+
+
+def get(key):
+    """
+    :param key: cache key (as returned by get_key)
+    :return: (data, ext) tuple or None if the tile is not in the cache
+    """
+    if key is None:
+        return None
+
+    if settings.TILE_CACHE_REDIS_TTL > 0:
+        try:
+            blob = redis_client.get(REDIS_KEY_PREFIX + key)
+            if blob is not None:
+                record_stat('hits')
+                return _decode(blob)
+        except redis.exceptions.RedisError as e:
+            logger.warning("Cannot read tile from redis cache: %s" % str(e))
+
+    path = _key_path(key)
+    try:
+        with open(path, 'rb') as f:
+            blob = f.read()
+    except (FileNotFoundError, NotADirectoryError):
+        record_stat('misses')
+        return None
+    except IOError as e:
+        logger.warning("Cannot read tile from cache: %s" % str(e))
+        record_stat('misses')
+        return None
+
+    # Mark as recently used
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+    if settings.TILE_CACHE_REDIS_TTL > 0:
+        _set_redis(key, blob)
+
+    record_stat('hits')
+    return _decode(blob)
+
+
+def set(key, data, ext):
+    """
+    Store a rendered tile in the cache
+    :param key: cache key (as returned by get_key)
+    :param data: tile image bytes
+    :param ext: tile image format (png, jpg, webp)
+    """
+    if key is None:
+        return
+
+    blob = _encode(data, ext)
+    path = _key_path(key)
+    d = os.path.dirname(path)
+
+    try:
+        os.makedirs(d, exist_ok=True)
+
+        # Write atomically, concurrent readers
+        # should never see partial tiles
+        fd, tmp_path = tempfile.mkstemp(dir=d, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(blob)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Cannot write tile to cache: %s" % str(e))
+
+    if settings.TILE_CACHE_REDIS_TTL > 0:
+        _set_redis(key, blob)
+
+
+def _set_redis(key, blob):
+    try:
+        redis_client.setex(REDIS_KEY_PREFIX + key, settings.TILE_CACHE_REDIS_TTL, blob)
+    except redis.exceptions.RedisError as e:
+        logger.warning("Cannot write tile to redis cache: %s" % str(e))
+
+
+def clear_task(task_id):
+    """
+    Remove all cached tiles for a task
+    (redis entries are not removed, but they can never
+    be hit again, since keys change along with the assets, and expire on their own)
+    """
+    d = cache_dir(str(task_id))
+    if os.path.isdir(d):
+        try:
+            shutil.rmtree(d)
+        except Exception as e:
+            logger.warning("Cannot clear tile cache {}: {}".format(d, str(e)))
+
+
+def clear():
+    d = cache_dir()
+    if os.path.isdir(d):
+        shutil.rmtree(d, ignore_errors=True)
+
+    try:
+        redis_client.delete(STATS_KEY)
+    except redis.exceptions.RedisError:
+        pass
+
+
+def evict(max_size_mb=None):
+    """
+    Remove least recently used tiles until the size
+    of the cache is below max_size_mb
+    :return: (number of removed tiles, bytes freed)
+    """
+    if max_size_mb is None:
+        max_size_mb = settings.TILE_CACHE_MAX_SIZE
+
+    d = cache_dir()
+    if not os.path.isdir(d):
+        return 0, 0
+
+    entries = []
+    total_bytes = 0
+    now = time.time()
+
+    for dirpath, _, filenames in os.walk(d):
+        for f in filenames:
+            fp = os.path.join(dirpath, f)
+            try:
+                st = os.stat(fp)
+            except FileNotFoundError:
+                continue
+
+            # Leftovers from interrupted writes
+            if f.endswith(".tmp"):
+                if st.st_mtime < now - 3600:
+                    os.remove(fp)
+                continue
+
+            entries.append((st.st_mtime, st.st_size, fp))
+            total_bytes += st.st_size
+
+    max_bytes = max_size_mb * 1024 * 1024
+    if total_bytes <= max_bytes:
+        return 0, 0
+
+    # Free some space below the threshold, so that we
+    # don't need to evict again right away
+    target_bytes = max_bytes * 0.9
+    entries.sort(key=lambda e: e[0])
+
+    removed = 0
+    freed = 0
+    for _, size, fp in entries:
+        if total_bytes - freed <= target_bytes:
+            break
+        try:
+            os.remove(fp)
+            removed += 1
+            freed += size
+        except FileNotFoundError:
+            pass
+
+    # Cleanup empty directories
+    for dirpath, dirnames, filenames in os.walk(d, topdown=False):
+        if dirpath != d and not dirnames and not filenames:
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass
+
+    return removed, freed
+
+
+def record_stat(field):
+    global _last_stats_flush
+
+    with _stats_lock:
+        _pending_stats[field] += 1
+        now = time.time()
+        if now - _last_stats_flush < STATS_FLUSH_INTERVAL:
+            return
+
+        pending = dict(_pending_stats)
+        _pending_stats['hits'] = 0
+        _pending_stats['misses'] = 0
+        _last_stats_flush = now
+
+    try:
+        pipe = redis_client.pipeline()
+        for k in pending:
+            if pending[k] > 0:
+                pipe.hincrby(STATS_KEY, k, pending[k])
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        pass
+
+
+def get_stats():
+    """
+    :return: dictionary with hits, misses, hit ratio, number of tiles and size (in MB) of the disk cache
+    """
+    hits = 0
+    misses = 0
+    try:
+        stats = redis_client.hgetall(STATS_KEY)
+        hits = int(stats.get(b'hits', 0))
+        misses = int(stats.get(b'misses', 0))
+    except redis.exceptions.RedisError:
+        pass
+
+    # Add counters that have not been flushed yet
+    with _stats_lock:
+        hits += _pending_stats['hits']
+        misses += _pending_stats['misses']
+
+    count = 0
+    total_bytes = 0
+    for dirpath, _, filenames in os.walk(cache_dir()):
+        for f in filenames:
+            if f.endswith(".tmp"):
+                continue
+            try:
+                total_bytes += os.path.getsize(os.path.join(dirpath, f))
+                count += 1
+            except FileNotFoundError:
+                pass
+
+    requests_count = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': (hits / requests_count) if requests_count > 0 else 0,
+        'tiles': count,
+        'size': total_bytes / 1024 / 1024,
+        'max_size': settings.TILE_CACHE_MAX_SIZE
+    }
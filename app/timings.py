@@ -0,0 +1,138 @@
+import time
+import threading
+import redis
+from webodm import settings
+
+redis_client = redis.Redis.from_url(settings.CELERY_BROKER_URL)
+
+HISTOGRAMS_KEY = 'tiler_timings'
+
+# Upper bounds (in milliseconds) of the histogram buckets
+BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Like the tile cache counters, histograms are accumulated
+# in memory and flushed to redis periodically
+FLUSH_INTERVAL = 10
+
+_lock = threading.Lock()
+_pending = {}
+_last_flush = 0
+
+
+class StageTimer:
+    """
+    Measures the duration of the stages of a request. Each
+    call to lap(name) records the time elapsed since the previous
+    call (or since the timer was created) as stage "name".
+    When disabled, nothing is measured.
+    """
+    def __init__(self, enabled=None):
+        self.enabled = settings.TILER_TIMINGS if enabled is None else enabled
+        self.stages = {}
+        self.group = None
+        if self.enabled:
+            self.start = self.last = time.perf_counter()
+
+    def lap(self, name):
+        if self.enabled:
+            now = time.perf_counter()
+            self.stages[name] = self.stages.get(name, 0) + (now - self.last) * 1000
+            self.last = now
+
+    def finish(self, response):
+        """
+        Add a Server-Timing header to response and
+        record the durations in the histograms
+        """
+        if not self.enabled:
+            return response
+
+        self.stages['total'] = (time.perf_counter() - self.start) * 1000
+        response['Server-Timing'] = ", ".join("{};dur={:.1f}".format(name, duration) for name, duration in self.stages.items())
+        if self.group is not None:
+            record(self.group, self.stages)
+
+        return response
+
+
+def get_bucket(duration):
+    for b in BUCKETS:
+        if duration <= b:
+            return str(b)
+    return "inf"
+
+
+def record(group, stages):
+    """
+    Add stage durations to the histograms
+    :param group: histogram group (e.g. tile type and options)
+    :param stages: dictionary of stage name --> duration (ms)
+    """
+    global _last_flush
+
+    with _lock:
+        for name, duration in stages.items():
+            prefix = "{}|{}|".format(group, name)
+            for field, value in ((prefix + "count", 1), (prefix + "sum", duration), (prefix + get_bucket(duration), 1)):
+                _pending[field] = _pending.get(field, 0) + value
+
+        now = time.time()
+        if now - _last_flush < FLUSH_INTERVAL:
+            return
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush = now
+
+    try:
+        pipe = redis_client.pipeline()
+        for field, value in pending.items():
+            if field.endswith("|sum"):
+                pipe.hincrbyfloat(HISTOGRAMS_KEY, field, value)
+            else:
+                pipe.hincrby(HISTOGRAMS_KEY, field, value)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        pass
+
+
+def get_histograms():
+    """
+    :return: dictionary of group --> stage --> {count, mean, buckets}
+        where buckets maps the upper bound (ms) of each bucket to its count
+    """
+    values = {}
+    try:
+        for field, value in redis_client.hgetall(HISTOGRAMS_KEY).items():
+            values[field.decode('utf-8')] = float(value)
+    except redis.exceptions.RedisError:
+        pass
+
+    # Add values that have not been flushed yet
+    with _lock:
+        for field, value in _pending.items():
+            values[field] = values.get(field, 0) + value
+
+    result = {}
+    for field, value in values.items():
+        group, stage, key = field.rsplit("|", 2)
+        s = result.setdefault(group, {}).setdefault(stage, {'count': 0, 'sum': 0, 'buckets': {}})
+        if key in ['count', 'sum']:
+            s[key] = value
+        else:
+            s['buckets'][key] = int(value)
+
+    for group in result:
+        for stage, s in result[group].items():
+            s['count'] = int(s['count'])
+            s['mean'] = s.pop('sum') / s['count'] if s['count'] > 0 else 0
+
+    return result
+
+
+def clear():
+    with _lock:
+        _pending.clear()
+    try:
+        redis_client.delete(HISTOGRAMS_KEY)
+    except redis.exceptions.RedisError:
+        pass
@@ -0,0 +1,312 @@
+import os
+import json
+import math
+import struct
+import logging
+import tempfile
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+logger = logging.getLogger('app.logger')
+
+INDEX_FILE = "vector_index.json"
+
+# Layer name --> GeoJSON asset (media locations are read from the task)
+LAYERS = OrderedDict([
+    ('shots', 'shots.geojson'),
+    ('ground_control_points', 'ground_control_points.geojson'),
+    ('media', None)
+])
+
+# Features are sorted by the Morton (Z-order) code of their
+# tile at this zoom level, so that any tile at a lower zoom level
+# maps to a contiguous range of the index
+INDEX_ZOOM = 24
+
+EXTENT = 4096
+BUFFER = 64
+
+# At most one feature per cell of a 2^THIN_LEVELS x 2^THIN_LEVELS grid
+# is kept in each tile (one feature every 4 pixels at 256px)
+THIN_LEVELS = 6
+
+MAX_LOADED_INDEXES = 16
+
+_loaded_lock = threading.Lock()
+_loaded = OrderedDict() # (path, mtime, size) --> index
+
+
+def get_index_path(task):
+    return task.data_path(INDEX_FILE)
+
+
+def lonlat_to_mercator(lon, lat):
+    """
+    :return: (x, y) web mercator coordinates normalized to 0-1,
+        with the origin at the top left
+    """
+    lat = max(-85.0511287798, min(85.0511287798, lat))
+    x = (lon + 180.0) / 360.0
+    s = math.sin(math.radians(lat))
+    y = 0.5 - math.log((1 + s) / (1 - s)) / (4 * math.pi)
+    return min(max(x, 0.0), 1.0), min(max(y, 0.0), 1.0)
+
+
+def interleave(x, y):
+    """
+    :return: Morton code of tile x, y (INDEX_ZOOM bits each)
+    """
+    code = 0
+    for i in range(INDEX_ZOOM):
+        code |= ((x >> i) & 1) << (2 * i) | ((y >> i) & 1) << (2 * i + 1)
+    return code
+
+
+def get_code(mx, my):
+    n = 1 << INDEX_ZOOM
+    return interleave(min(int(mx * n), n - 1), min(int(my * n), n - 1))
+
+
+def get_point(geometry):
+    if not isinstance(geometry, dict) or geometry.get('type') != 'Point':
+        return None
+    coords = geometry.get('coordinates')
+    if not isinstance(coords, (list, tuple)) or len(coords) < 2:
+        return None
+    return float(coords[0]), float(coords[1])
+
+
+def read_geojson_features(path):
+    """
+    :return: list of (lon, lat, properties) tuples for the point features of a GeoJSON file
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        geojson = json.load(f)
+
+    result = []
+    for feature in geojson.get('features', []):
+        point = get_point(feature.get('geometry'))
+        if point is not None:
+            result.append((point[0], point[1], feature.get('properties') or {}))
+    return result
+
+
+def read_media_features(task):
+    result = []
+    for entry in (task.media or []):
+        geo = entry.get('geolocation')
+        if not geo:
+            continue
+        result.append((float(geo[0]), float(geo[1]), {k: v for k, v in entry.items() if k != 'geolocation'}))
+    return result
+
+
+def build_layer(features):
+    """
+    :param features: list of (lon, lat, properties) tuples
+    :return: list of [code, x, y, id, properties] lists sorted by code
+    """
+    result = []
+    for i, (lon, lat, properties) in enumerate(features):
+        mx, my = lonlat_to_mercator(lon, lat)
+        result.append([get_code(mx, my), mx, my, i + 1, properties])
+    result.sort(key=lambda f: f[0])
+    return result
+
+
+def read_index(task):
+    try:
+        with open(get_index_path(task), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_index(task, index):
+    index_path = get_index_path(task)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(index_path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+    except:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def generate(task, layers=None):
+    """
+    Build the spatial index of the point layers of a task
+    :param layers: list of layer names to (re)build, all layers by default
+    """
+    index = read_index(task) if layers is not None else {}
+
+    for layer in (layers or LAYERS.keys()):
+        try:
+            asset = LAYERS[layer]
+            if asset is None:
+                features = read_media_features(task)
+            else:
+                path = task.get_asset_download_path(asset)
+                features = read_geojson_features(path) if os.path.isfile(path) else []
+
+            index[layer] = build_layer(features)
+        except Exception as e:
+            logger.warning("Cannot index {} for {}: {}".format(layer, task, str(e)))
+            index.pop(layer, None)
+
+    write_index(task, index)
+    logger.info("Indexed {} for {}".format(", ".join("{} {}".format(len(v), k) for k, v in index.items()), task))
+
+
+def load_index(task):
+    """
+    Read the spatial index of a task, building it if needed.
+    Indexes are kept in memory until they change on disk.
+    :return: dictionary of layer name --> (list of codes, list of features)
+    """
+    index_path = get_index_path(task)
+    if not os.path.isfile(index_path):
+        generate(task)
+
+    st = os.stat(index_path)
+    key = (index_path, st.st_mtime_ns, st.st_size)
+    with _loaded_lock:
+        index = _loaded.get(key)
+        if index is not None:
+            _loaded.move_to_end(key)
+            return index
+
+    index = {layer: ([f[0] for f in features], features) for layer, features in read_index(task).items()}
+
+    with _loaded_lock:
+        _loaded[key] = index
+        while len(_loaded) > MAX_LOADED_INDEXES:
+            _loaded.popitem(last=False)
+
+    return index
+
+
+def query(codes, features, z, x, y):
+    """
+    :return: features within tile z/x/y (and its buffer), thinned
+        to at most one feature per grid cell
+    """
+    shift = 2 * (INDEX_ZOOM - z)
+    n = 1 << z
+    buffer = BUFFER / EXTENT
+    thin_shift = max(0, shift - 2 * THIN_LEVELS)
+
+    result = []
+    for ty in range(y - 1, y + 2):
+        for tx in range(x - 1, x + 2):
+            if tx < 0 or ty < 0 or tx >= n or ty >= n:
+                continue
+
+            start = interleave(tx, ty) << shift
+            end = (interleave(tx, ty) + 1) << shift
+            last_cell = None
+            for i in range(bisect_left(codes, start), bisect_left(codes, end)):
+                code, mx, my, fid, properties = features[i]
+                cell = code >> thin_shift
+                if cell == last_cell:
+                    continue
+
+                px = mx * n - x
+                py = my * n - y
+                if -buffer <= px <= 1 + buffer and -buffer <= py <= 1 + buffer:
+                    result.append((int(round(px * EXTENT)), int(round(py * EXTENT)), fid, properties))
+                    last_cell = cell
+
+    return result
+
+
+def get_tile(task, z, x, y, layers=None):
+    """
+    :param layers: list of layer names, all layers by default
+    :return: Mapbox Vector Tile (bytes)
+    """
+    index = load_index(task)
+    tile = []
+    for layer in (layers or LAYERS.keys()):
+        if layer in index:
+            features = query(index[layer][0], index[layer][1], z, x, y)
+            if len(features) > 0:
+                tile.append(encode_layer(layer, features))
+    return b"".join(tile)
+
+
+# Protocol buffers encoding (https://github.com/mapbox/vector-tile-spec/tree/master/2.1)
+
+def varint(value):
+    result = bytearray()
+    while True:
+        b = value & 0x7f
+        value >>= 7
+        if value:
+            result.append(b | 0x80)
+        else:
+            result.append(b)
+            return bytes(result)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def field(number, wire_type, payload):
+    if wire_type == 2:
+        return varint(number << 3 | 2) + varint(len(payload)) + payload
+    return varint(number << 3 | wire_type) + payload
+
+
+def encode_value(value):
+    if isinstance(value, bool):
+        return field(7, 0, varint(int(value)))
+    elif isinstance(value, int) and -(1 << 63) <= value < (1 << 63):
+        if value >= 0:
+            return field(5, 0, varint(value))
+        return field(6, 0, varint(zigzag(value)))
+    elif isinstance(value, float):
+        return field(3, 1, struct.pack("<d", value))
+    elif isinstance(value, str):
+        return field(1, 2, value.encode('utf-8'))
+    else:
+        # Lists and objects are encoded as JSON strings
+        return field(1, 2, json.dumps(value).encode('utf-8'))
+
+
+def encode_layer(name, features):
+    """
+    :param features: list of (x, y, id, properties) tuples, in tile coordinates
+    :return: encoded layer message (including its tag)
+    """
+    keys = OrderedDict()
+    values = OrderedDict()
+    encoded = []
+
+    for px, py, fid, properties in features:
+        tags = bytearray()
+        for k, v in properties.items():
+            if v is None:
+                continue
+            value = encode_value(v)
+            tags += varint(keys.setdefault(k, len(keys)))
+            tags += varint(values.setdefault(value, len(values)))
+
+        # MoveTo(1) command with a single point
+        geometry = varint(9) + varint(zigzag(px)) + varint(zigzag(py))
+        encoded.append(field(2, 2, field(1, 0, varint(fid)) +
+                                   (field(2, 2, bytes(tags)) if len(tags) > 0 else b"") +
+                                   field(3, 0, varint(1)) +
+                                   field(4, 2, geometry)))
+
+    layer = field(15, 0, varint(2)) + field(1, 2, name.encode('utf-8')) + b"".join(encoded)
+    layer += b"".join(field(3, 2, k.encode('utf-8')) for k in keys)
+    layer += b"".join(field(4, 2, v) for v in values)
+    layer += field(5, 0, varint(EXTENT))
+
+    return field(3, 2, layer)
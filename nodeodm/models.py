@@ -12,8 +12,10 @@ from django.utils.translation import gettext_lazy as _
 from webodm import settings
 
 import json
+import requests
 from pyodm import Node
 from pyodm import exceptions
+from app import remotezip
 from django.db.models import signals
 from datetime import timedelta
 import logging
@@ -189,6 +191,35 @@ class ProcessingNode(models.Model):
         task = api_client.get_task(uuid)
         return task.download_zip(destination, progress_callback, parallel_downloads=parallel_downloads)
 
+    def extract_task_assets(self, uuid, destination, progress_callback, parallel_downloads=16):
+        """
+        Downloads and extracts the assets archive of a task one member at a time,
+        without storing the archive (requires HTTP range requests support)
+        :return: list of extracted paths
+        """
+        api_client = self.api_client()
+        url = api_client.url('/task/{}/download/all.zip'.format(uuid))
+        return remotezip.extract(url, destination, progress_callback, parallel_downloads=parallel_downloads, timeout=api_client.timeout)
+
+    def download_task_assets_resumable(self, uuid, output, progress_callback, parallel_downloads=16):
+        """
+        Downloads the assets archive of a task to output, resuming a previous
+        partial download of it if available (requires HTTP range requests support)
+        :return: output
+        """
+        api_client = self.api_client()
+        url = api_client.url('/task/{}/download/all.zip'.format(uuid))
+        try:
+            return remotezip.download(url, output, progress_callback, parallel_downloads=parallel_downloads, timeout=api_client.timeout)
+        except Exception as e:
+            if remotezip.is_transient_error(e):
+                # The download is resumed at the next attempt
+                raise exceptions.NodeConnectionError(str(e))
+            elif isinstance(e, requests.exceptions.RequestException):
+                # e.g. the task is no longer available
+                raise exceptions.NodeResponseError(str(e))
+            raise
+
     def restart_task(self, uuid, options = None):
         """
         Restarts a task that was previously canceled or that had failed to process
@@ -397,6 +397,30 @@ CLEANUP_EMPTY_PROJECTS = None
 # Maximum number of threads that a worker should use for processing
 WORKERS_MAX_THREADS = 2
 
+# Maximum number of post-processing steps (COG conversion, EPT, statistics, ...)
+# that run concurrently when a task completes
+POSTPROCESS_MAX_THREADS = 4
+
+# Extract the results of processing nodes while they are downloaded
+# (one archive member at a time, using HTTP range requests) instead of
+# downloading all.zip first. Falls back to all.zip if the node doesn't support it
+STREAM_TASK_ASSETS = False
+
+# Download all.zip in chunks and keep track of the downloaded chunks,
+# so that interrupted or corrupted downloads (and downloads stopped by
+# a worker restart) only fetch the missing or corrupted parts
+RESUMABLE_TASK_DOWNLOADS = True
+
+# Encoding profile used when converting assets to Cloud Optimized GeoTIFFs
+# (see COG_PROFILES in app/cogeo.py). "multispectral" applies to orthophotos
+# that are not 8-bit RGB. Run "manage.py benchmark --kernels cogeo" to compare them
+COG_ASSET_PROFILES = {
+    'orthophoto': 'default',
+    'multispectral': 'default',
+    'dsm': 'default',
+    'dtm': 'default'
+}
+
 # Maximum number of seconds a worker task should take before being terminated
 WORKERS_MAX_TIME_LIMIT = None
 
@@ -413,10 +437,83 @@ DOCS_LINK = "https://docs.webodm.org"
 # Link to task options docs
 TASK_OPTIONS_DOCS_LINK = ""
 
-# Whether to display onboarding instructions and 
+# Whether to display onboarding instructions and
 # automatically create a first project on first login
 DASHBOARD_ONBOARDING = True
 
+# Cache rendered map tiles on disk (in MEDIA_CACHE)
+TILE_CACHE = True
+
+# Maximum size of the tiles cache in megabytes. Least recently
+# used tiles are evicted when the cache grows past this size
+TILE_CACHE_MAX_SIZE = 2048
+
+# Number of seconds rendered tiles are also kept in redis,
+# in front of the disk cache (0 to disable)
+TILE_CACHE_REDIS_TTL = 0
+
+# Pre-render map tiles (with default styling) into the tile cache
+# in the background when a task completes
+TILE_SEED = False
+
+# Number of zoom levels, starting from the minimum zoom
+# level of each raster, to pre-render
+TILE_SEED_ZOOM_LEVELS = 4
+
+# Maximum number of tiles to pre-render for each task
+TILE_SEED_MAX_TILES = 1000
+
+# Maximum number of tiles that can be requested
+# at once via the tiles batch API
+TILE_BATCH_MAX_TILES = 64
+
+# Maximum number of task layers that are composited
+# in a project mosaic tile
+MOSAIC_MAX_TASKS = 32
+
+# Maximum number of tiles that can be rendered
+# in a MBTiles export
+TILE_EXPORT_MAX_TILES = 100000
+
+# Reuse the results of identical export requests (same asset
+# and options), stored in MEDIA_CACHE
+EXPORT_CACHE = True
+
+# Maximum size of the export cache in megabytes. Least recently
+# used exports are evicted when the cache grows past this size
+EXPORT_CACHE_MAX_SIZE = 4096
+
+# Number of seconds finished export jobs can be reused by identical
+# requests (must not exceed the celery result expiration, 1 day by default).
+# Afterwards new jobs still reuse the cached files
+EXPORT_CACHE_JOB_TTL = 60 * 60 * 12
+
+# Maximum number of items in a batch export and
+# number of items that are exported concurrently
+EXPORT_BATCH_MAX_ITEMS = 16
+EXPORT_BATCH_CONCURRENCY = 4
+
+# Number of seconds browsers and proxies can use map tiles
+# without revalidating them (ETags are always sent)
+TILE_HTTP_MAX_AGE = 60 * 60
+
+# Measure the duration of each stage of tile and metadata requests.
+# Durations are sent in a Server-Timing header and aggregated in
+# histograms (see /api/admin/tiler/metrics)
+TILER_TIMINGS = False
+
+# Maximum number of idle raster handles (COG readers) that
+# each process keeps open between requests (0 to disable pooling)
+RASTER_POOL_SIZE = 16
+
+# Number of seconds raster statistics computed for cropped
+# or boundary-restricted areas are memoized (0 to disable)
+METADATA_CACHE_TTL = 60 * 60 * 24
+
+# Maximum number of memoized raster statistics
+# that each process keeps in memory
+METADATA_CACHE_MAX_ENTRIES = 128
+
 if TESTING or FLUSHING:
     CELERY_TASK_ALWAYS_EAGER = True
     EXTERNAL_AUTH_ENDPOINT = 'http://0.0.0.0:5555/auth'
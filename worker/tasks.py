@@ -6,11 +6,13 @@ import json
 import requests
 
 import time
-from threading import Event, Thread
+from threading import Event, Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
 from celery.utils.log import get_task_logger
 from django.core.exceptions import ObjectDoesNotExist
 from django.db.models import Count
 from django.db.models import Q
+from django.dispatch import receiver
 from app.models import Profile
 
 from app.models import Project
@@ -22,6 +24,8 @@ import worker
 from .celery import app
 from app.raster_utils import export_raster as export_raster_sync, extension_for_export_format
 from app.pointcloud_utils import export_pointcloud as export_pointcloud_sync
+from app import tilecache, exportcache
+from app.plugins import signals as plugin_signals
 from django.utils import timezone
 from datetime import timedelta
 import redis
@@ -114,6 +118,64 @@ def cleanup_cache_directory():
 
                 logger.info('Cleaned up: %s (%s)' % (filepath, modified))
 
+@app.task(ignore_result=True)
+def cleanup_tile_cache():
+    removed, freed = tilecache.evict()
+    if removed > 0:
+        logger.info('Evicted %s tiles (%.1f MB) from the tile cache' % (removed, freed / 1024 / 1024))
+
+@app.task(ignore_result=True)
+def cleanup_export_cache():
+    removed, freed = exportcache.evict()
+    if removed > 0:
+        logger.info('Evicted %s exports (%.1f MB) from the export cache' % (removed, freed / 1024 / 1024))
+
+# Seeding runs in small batches at the lowest priority,
+# so that it doesn't hold up other work
+SEED_BATCH_SIZE = 50
+SEED_PRIORITY = 9
+
+@app.task(ignore_result=True, time_limit=settings.WORKERS_MAX_TIME_LIMIT)
+def seed_tiles(task_id, offset=0):
+    # app.api.tiler imports this module
+    from app.api.tiler import get_seed_tiles, render_tile
+    from rest_framework.exceptions import APIException
+
+    def is_cancelled():
+        # Task was deleted or is being re-processed
+        return not Task.objects.filter(pk=task_id, status=status_codes.COMPLETED).exists()
+
+    task = Task.objects.filter(pk=task_id, status=status_codes.COMPLETED).first()
+    if task is None:
+        return
+
+    tiles = get_seed_tiles(task, settings.TILE_SEED_ZOOM_LEVELS, settings.TILE_SEED_MAX_TILES)
+    batch = tiles[offset:offset + SEED_BATCH_SIZE]
+
+    for i, (tile_type, z, x, y, query_params) in enumerate(batch):
+        if i > 0 and i % 10 == 0 and is_cancelled():
+            logger.info("Cancelled tile seeding for {}".format(task))
+            return
+
+        try:
+            render_tile(task, tile_type, z, x, y, query_params=query_params, accept_webp=True)
+        except APIException:
+            # Outside of bounds
+            pass
+        except Exception as e:
+            logger.warning("Cannot seed {} tile {}/{}/{} for {}: {}".format(tile_type, z, x, y, task, str(e)))
+
+    if offset + len(batch) < len(tiles):
+        seed_tiles.apply_async(args=[task_id, offset + len(batch)], priority=SEED_PRIORITY)
+    else:
+        logger.info("Seeded {} tiles for {}".format(len(tiles), task))
+
+# Tasks complete in the worker processes, which load this module
+@receiver(plugin_signals.task_completed, dispatch_uid="seed_tiles_on_task_completed")
+def seed_tiles_on_task_completed(sender, task_id, **kwargs):
+    if settings.TILE_SEED and settings.TILE_CACHE:
+        seed_tiles.apply_async(args=[str(task_id)], priority=SEED_PRIORITY)
+
 # Based on https://stackoverflow.com/questions/22498038/improve-current-implementation-of-a-setinterval-python/22498708#22498708
 def setInterval(interval, func, *args):
     stopped = Event()
@@ -192,19 +254,63 @@ def process_pending_tasks():
         process_task.delay(task_id)
 
 
-@app.task(bind=True, time_limit=settings.WORKERS_MAX_TIME_LIMIT)
-def export_raster(self, input, **opts):
-    try:
+def run_export_raster(input, cache_key=None, progress_callback=None, **opts):
+    """
+    :return: path of the exported raster
+    """
+    extension = extension_for_export_format(opts.get('format', 'gtiff'))
+    file = exportcache.get(cache_key, extension)
+
+    if file is None:
         logger.info("Exporting raster {} with options: {}".format(input, json.dumps(opts)))
-        tmpfile = tempfile.mktemp('_raster.{}'.format(extension_for_export_format(opts.get('format', 'gtiff'))), dir=settings.MEDIA_TMP)
-        def progress_callback(status, perc):
-            self.update_state(state="PROGRESS", meta={"status": status, "progress": perc})
-        
+        tmpfile = tempfile.mktemp('_raster.{}'.format(extension), dir=settings.MEDIA_TMP)
         export_raster_sync(input, tmpfile, progress_callback=progress_callback, **opts)
-        result = {'file': tmpfile}
+        file = exportcache.store(cache_key, tmpfile) if cache_key is not None else tmpfile
+
+    return file
+
+def run_export_tiles(task_id, tile_type, cache_key=None, progress_callback=None, **opts):
+    """
+    :return: path of the exported MBTiles archive
+    """
+    # app.api.tiler imports this module
+    from app.mbtiles import export_mbtiles
+
+    file = exportcache.get(cache_key, 'mbtiles')
+
+    if file is None:
+        logger.info("Exporting {} tiles of {} with options: {}".format(tile_type, task_id, json.dumps(opts)))
+        task = Task.objects.get(pk=task_id)
+        tmpfile = tempfile.mktemp('_tiles.mbtiles', dir=settings.MEDIA_TMP)
+        export_mbtiles(task, tile_type, tmpfile, progress_callback=progress_callback, **opts)
+        file = exportcache.store(cache_key, tmpfile) if cache_key is not None else tmpfile
+
+    return file
+
+def run_export_pointcloud(input, cache_key=None, progress_callback=None, **opts):
+    """
+    :return: path of the exported point cloud
+    """
+    extension = opts.get('format', 'laz')
+    file = exportcache.get(cache_key, extension)
+
+    if file is None:
+        logger.info("Exporting point cloud {} with options: {}".format(input, json.dumps(opts)))
+        tmpfile = tempfile.mktemp('_pointcloud.{}'.format(extension), dir=settings.MEDIA_TMP)
+        export_pointcloud_sync(input, tmpfile, **opts)
+        file = exportcache.store(cache_key, tmpfile) if cache_key is not None else tmpfile
+
+    return file
+
+def run_export_task(task, export, *args, **opts):
+    try:
+        def progress_callback(status, perc):
+            task.update_state(state="PROGRESS", meta={"status": status, "progress": perc})
+
+        result = {'file': export(*args, progress_callback=progress_callback, **opts)}
 
         if settings.TESTING:
-            TestSafeAsyncResult.set(self.request.id, result)
+            TestSafeAsyncResult.set(task.request.id, result)
 
         return result
     except Exception as e:
@@ -213,12 +319,67 @@ def export_raster(self, input, **opts):
         return {'error': str(e)}
 
 @app.task(bind=True, time_limit=settings.WORKERS_MAX_TIME_LIMIT)
-def export_pointcloud(self, input, **opts):
+def export_raster(self, input, cache_key=None, **opts):
+    return run_export_task(self, run_export_raster, input, cache_key=cache_key, **opts)
+
+@app.task(bind=True, time_limit=settings.WORKERS_MAX_TIME_LIMIT)
+def export_tiles(self, task_id, tile_type, cache_key=None, **opts):
+    return run_export_task(self, run_export_tiles, task_id, tile_type, cache_key=cache_key, **opts)
+
+@app.task(bind=True, time_limit=settings.WORKERS_MAX_TIME_LIMIT)
+def export_pointcloud(self, input, cache_key=None, **opts):
+    return run_export_task(self, run_export_pointcloud, input, cache_key=cache_key, **opts)
+
+EXPORT_JOBS = {
+    export_raster.name: run_export_raster,
+    export_tiles.name: run_export_tiles,
+    export_pointcloud.name: run_export_pointcloud
+}
+
+@app.task(bind=True, time_limit=settings.WORKERS_MAX_TIME_LIMIT)
+def export_batch(self, items):
+    """
+    Run multiple exports concurrently
+    :param items: list of {'filename', 'file'} (assets that are exported as-is)
+        or {'filename', 'job', 'args', 'opts', 'cache_key'} dictionaries
+    :return: {'files': [{'filename', 'file'}, ...]}
+    """
     try:
-        logger.info("Exporting point cloud {} with options: {}".format(input, json.dumps(opts)))
-        tmpfile = tempfile.mktemp('_pointcloud.{}'.format(opts.get('format', 'laz')), dir=settings.MEDIA_TMP)
-        export_pointcloud_sync(input, tmpfile, **opts)
-        result = {'file': tmpfile}
+        # Identical items are exported once
+        jobs = {}
+        for item in items:
+            if item.get('file') is None:
+                jobs.setdefault(item.get('cache_key') or id(item), item)
+
+        concurrency = max(1, min(len(jobs), settings.EXPORT_BATCH_CONCURRENCY))
+
+        # Split the worker threads between the concurrent exports
+        threads = max(1, settings.WORKERS_MAX_THREADS // concurrency)
+
+        lock = Lock()
+        progress = {k: 0 for k in jobs}
+
+        def run(k, item):
+            def progress_callback(status, perc):
+                with lock:
+                    progress[k] = perc
+                    total = sum(progress.values()) / len(progress)
+                    self.update_state(state="PROGRESS", meta={"status": status, "progress": total})
+
+            opts = dict(item['opts'])
+            if item['job'] != export_pointcloud.name:
+                opts['threads'] = threads
+
+            return EXPORT_JOBS[item['job']](*item['args'], cache_key=item.get('cache_key'), progress_callback=progress_callback, **opts)
+
+        files = {}
+        if len(jobs) > 0:
+            logger.info("Exporting {} items".format(len(jobs)))
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = {k: executor.submit(run, k, item) for k, item in jobs.items()}
+                files = {k: f.result() for k, f in futures.items()}
+
+        result = {'files': [{'filename': item['filename'], 'file': item['file'] if item.get('file') is not None else files[item.get('cache_key') or id(item)]} for item in items]}
 
         if settings.TESTING:
             TestSafeAsyncResult.set(self.request.id, result)